@@ -14,106 +14,125 @@ import argparse
 import os
 import numpy as np
 import pandas as pd
-from networkx.algorithms import bipartite
+from joblib import Parallel, delayed
 
-def to_csv(project='', data_dir='./graph_data/'):
+def to_csv(project='', data_dir='./graph_data/', chunksize=1000000, workers=1):
     '''
     Five kinds of datasets from different resources are transformed into a unifed graph format: CTDNE, NEOTG, JODIE, NGCF, Aminer
+
+    Raw files are streamed in chunks of `chunksize` rows, and `workers` files are converted in parallel processes.
     '''
     if project not in dirmap.keys():
         raise NotImplementedError(
             "{} dataset is not supported.".format(project))
     project_func, project_name = dirmap[project]
     project_dir = os.path.join(data_dir, project_name)
-    project_func(project_dir, './format_data/', project)
+    jobs = project_func(project_dir, './format_data/', project, chunksize)
+    Parallel(n_jobs=workers)(delayed(func)(*params) for func, params in jobs)
+
+
+def _ctdne_reader(f, chunksize):
+    # Skip `%` comments and detect whether the file is separated by commas or spaces.
+    with open(f, 'r') as fp:
+        line = next(l for l in fp if l.strip() and not l.startswith('%'))
+    sep = ',' if ',' in line else r'\s+'
+    ncols = len(line.split(',') if sep == ',' else line.split())
+    header = ['from_node_id', 'to_node_id', 'timestamp']
+    header2 = ['from_node_id', 'to_node_id', 'weight', 'timestamp']
+    names = header if ncols == 3 else header2
+    return pd.read_csv(f, header=None, names=names, sep=sep, comment='%',
+                       chunksize=chunksize)
 
 
-def ctdne_transf(project_dir, store_dir, project):
+def ctdne_transf(project_dir, store_dir, project, chunksize=1000000):
     config = pd.read_csv(f'{project_dir}/README.config')
     bipartite = {row.dataset: row.bipartite for row in config.itertuples()}
     fname = [f for f in os.listdir(project_dir) if f.endswith('.edges')]
     files = [os.path.join(project_dir, f) for f in fname]
-    header = ['from_node_id', 'to_node_id', 'timestamp']
-    header2 = ['from_node_id', 'to_node_id', 'weight', 'timestamp']
+    jobs = []
     for f, name in zip(files, fname):
         if name.find('.') != -1:
             name = name[:name.find('.')]
-        print('*****{}*****'.format(name))
         if name not in bipartite:
             raise NotImplementedError(name)
-
-        skiprows = sum([line.startswith('%') for line in open(f, 'r').readlines()])
-        df = pd.read_csv(f, header=None, skiprows=skiprows)
-        if len(df.columns) < 3:
-            # Read non-standard csv files separated by space.
-            df = pd.read_csv(f, header=None, skiprows=skiprows, sep='\s+')
-        if len(df.columns) == 3:
-            df.columns = header
-        else:
-            df.columns = header2
-
-        edges = pd.DataFrame(columns=edges_cols)
-        edges[header] = df[header]
-        edges['state_label'] = 0
-
-        from_nodes = df['from_node_id'].tolist()
-        to_nodes = df['to_node_id'].tolist()
-        if bipartite[name]:
-            max_from = np.max(from_nodes) + 1
-            min_to = np.min(to_nodes)
-            to_nodes = np.array(to_nodes) - min_to + max_from
-            to_nodes = list(to_nodes)
-
-            roles = [0] * len(np.unique(from_nodes)) + [1] * len(np.unique(to_nodes))
-        else:
-            roles = 0
-
-        edges['to_node_id'] = to_nodes
-        edges.to_csv('{}/{}.edges'.format(store_dir, name), index=None)
-
-        nodes_id = sorted(set(from_nodes + to_nodes))
-        
-
-        nodes = pd.DataFrame(columns=nodes_cols)
-        nodes['node_id'] = nodes_id
-        nodes['id_map'] = list(range(len(nodes_id)))
-        nodes['role'] = roles
-        nodes['label'] = 0
-        nodes.to_csv('{}/{}.nodes'.format(store_dir, name), index=None)
-
-
-def jodie_transf(project_dir, store_dir, project):
+        jobs.append((_ctdne_file, (f, name, store_dir, bipartite[name], chunksize)))
+    return jobs
+
+
+def _ctdne_file(f, name, store_dir, is_bipartite, chunksize):
+    print('*****{}*****'.format(name))
+    # The first pass collects node ids, which bounds the memory by the number of nodes.
+    from_nodes = np.array([], dtype=np.int64)
+    to_nodes = np.array([], dtype=np.int64)
+    for df in _ctdne_reader(f, chunksize):
+        from_nodes = np.union1d(from_nodes, df['from_node_id'].unique())
+        to_nodes = np.union1d(to_nodes, df['to_node_id'].unique())
+
+    if is_bipartite:
+        max_from = np.max(from_nodes) + 1
+        min_to = np.min(to_nodes)
+        shift = max_from - min_to
+        to_nodes = to_nodes + shift
+        roles = [0] * len(from_nodes) + [1] * len(to_nodes)
+    else:
+        shift = 0
+        roles = 0
+
+    # The second pass writes the shifted edges incrementally.
+    with open('{}/{}.edges'.format(store_dir, name), 'w') as out:
+        for i, df in enumerate(_ctdne_reader(f, chunksize)):
+            df['to_node_id'] = df['to_node_id'] + shift
+            df['state_label'] = 0
+            df[edges_cols].to_csv(out, index=None, header=(i == 0))
+
+    nodes_id = np.union1d(from_nodes, to_nodes)
+    nodes = pd.DataFrame(columns=nodes_cols)
+    nodes['node_id'] = nodes_id
+    nodes['id_map'] = list(range(len(nodes_id)))
+    nodes['role'] = roles
+    nodes['label'] = 0
+    nodes.to_csv('{}/{}.nodes'.format(store_dir, name), index=None)
+
+
+def jodie_transf(project_dir, store_dir, project, chunksize=1000000):
     fname = [f for f in os.listdir(project_dir)]
     files = [os.path.join(project_dir, f) for f in fname]
-    header = ['from_node_id', 'to_node_id', 'timestamp', 'state_label']
+    jobs = []
     for f, name in zip(files, fname):
         if name.find('.') != -1:
             name = name[:name.find('.')]
-        print('*****{}*****'.format(name))
-        df = pd.read_csv(f, header=None, skiprows=1)
-        headers = header + ['feat{0}'.format(i)
-                            for i in range(len(df.columns) - 4)]
-        df.columns = headers
-
-        # concat user_id and item_id into a unified id
-        # user_id = df['from_node_id'].tolist()
-        max_user_id = df.from_node_id.max() + 1
-        df["to_node_id"] = df["to_node_id"] + max_user_id
-        # item_id = df['to_node_id'].apply(lambda x: x + max_user_id).tolist()
-        # df['to_node_id'] = item_id
-        df.to_csv('{}/{}-{}.edges'.format(store_dir, project, name), index=None)
-
-        user_id = set(df["from_node_id"])
-        item_id = set(df["to_node_id"])
-        nodes_id = sorted(user_id.union(item_id))
-        print(len(nodes_id), len(user_id), len(item_id))
-        nodes = pd.DataFrame(columns=nodes_cols)
-        nodes['node_id'] = nodes_id
-        nodes['id_map'] = list(range(len(nodes_id)))
-        nodes['role'] = ['user'] * len(user_id) + ['item'] * len(item_id)
-        nodes['label'] = 0
-        nodes.to_csv('{}/{}-{}.nodes'.format(store_dir,
-                                             project, name), index=None)
+        jobs.append((_jodie_file, (f, name, store_dir, project, chunksize)))
+    return jobs
+
+
+def _jodie_file(f, name, store_dir, project, chunksize):
+    print('*****{}*****'.format(name))
+    header = ['from_node_id', 'to_node_id', 'timestamp', 'state_label']
+    user_id = np.array([], dtype=np.int64)
+    item_id = np.array([], dtype=np.int64)
+    for df in pd.read_csv(f, header=None, skiprows=1, chunksize=chunksize):
+        user_id = np.union1d(user_id, df[0].unique())
+        item_id = np.union1d(item_id, df[1].unique())
+
+    # concat user_id and item_id into a unified id
+    max_user_id = user_id.max() + 1
+    item_id = item_id + max_user_id
+    with open('{}/{}-{}.edges'.format(store_dir, project, name), 'w') as out:
+        for i, df in enumerate(pd.read_csv(f, header=None, skiprows=1, chunksize=chunksize)):
+            df.columns = header + ['feat{0}'.format(j)
+                                   for j in range(len(df.columns) - 4)]
+            df["to_node_id"] = df["to_node_id"] + max_user_id
+            df.to_csv(out, index=None, header=(i == 0))
+
+    nodes_id = np.union1d(user_id, item_id)
+    print(len(nodes_id), len(user_id), len(item_id))
+    nodes = pd.DataFrame(columns=nodes_cols)
+    nodes['node_id'] = nodes_id
+    nodes['id_map'] = list(range(len(nodes_id)))
+    nodes['role'] = ['user'] * len(user_id) + ['item'] * len(item_id)
+    nodes['label'] = 0
+    nodes.to_csv('{}/{}-{}.nodes'.format(store_dir,
+                                         project, name), index=None)
 
 dirmap = {
     'CTDNE': (ctdne_transf, '2018-WWW-CTDNE'),
@@ -127,5 +146,9 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--dataset", "-d", type=str, required=True,
                         choices=["CTDNE", "JODIE"])
+    parser.add_argument("--chunksize", type=int, default=1000000,
+                        help="number of raw rows read at a time")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of files converted in parallel processes")
     args = parser.parse_args()
-    to_csv(args.dataset)
+    to_csv(args.dataset, chunksize=args.chunksize, workers=args.workers)
@@ -6,12 +6,14 @@ import time
 from collections import defaultdict
 from datetime import datetime, timezone
 
-import dgl
 import numpy as np
 import pandas as pd
 import torch
 
-from data_loader.data_util import _iterate_datasets, _load_data
+from data_loader.data_util import (_dataset_sha1, _iterate_datasets, append_edges,
+                                   compute_split, has_prepared_split, load_edge_columns,
+                                   load_manifest, load_split_edges, load_split_indices,
+                                   remap_ids, save_split)
 
 def set_random_seed():
     seed = 42
@@ -22,95 +24,96 @@ def set_random_seed():
 
 def data_stats(project_dir="./format_data/"):
     # nodes, edges, d_avg, d_max, timespan(days)
-    fname = [f for f in os.listdir(project_dir) if f.endswith("edges")]
-    fname = sorted(fname)
-    fpath = [os.path.join(project_dir, f) for f in fname]
-    for name, path in zip(fname, fpath):
-        name = name[:-6]
+    manifest = load_manifest(project_dir)
+    for name, stats in sorted(manifest.items()):
         print("*****{}*****".format(name))
-        edges = pd.read_csv(path)
-        nodes = pd.read_csv(os.path.join(project_dir, f"{name}.nodes"))
-        enodes = list(set(edges["from_node_id"]).union(edges["to_node_id"]))
-        assert len(nodes) == len(enodes), "The number of nodes is not the same as that of edges."
-        noint = sum([not isinstance(nid, int) for nid in enodes])
-        print("{} node ids are not integer.".format(noint))
-
-        id2idx = {row.node_id: row.id_map for row in nodes.itertuples()}
-        edges["from_node_id"] = edges["from_node_id"].map(id2idx)
-        edges["to_node_id"] = edges["to_node_id"].map(id2idx)
-        g = dgl.DGLGraph((edges["from_node_id"], edges["to_node_id"]))
-        g.add_edges(edges["to_node_id"], edges["from_node_id"])
-        degrees = g.in_degrees()
-        begin = datetime.fromtimestamp(edges["timestamp"].min(), timezone.utc)
-        end = datetime.fromtimestamp(edges["timestamp"].max(), timezone.utc)
+        assert stats["nodes"] == stats["edge_nodes"], "The number of nodes is not the same as that of edges."
+        print("{} node ids are not integer.".format(stats["noint_nodes"]))
+        begin = datetime.fromtimestamp(stats["ts_min"], timezone.utc)
+        end = datetime.fromtimestamp(stats["ts_max"], timezone.utc)
         delta = (end - begin).total_seconds() / 86400
+        n_nodes, n_edges = stats["nodes"], stats["edges"]
         print("density:{:.4f}, nodes:{} edges:{} d_max:{} d_avg:{:.2f} timestamps:{:.2f}".format(
-            len(edges) * 2.0 / (len(nodes) * len(nodes) - 1), len(nodes), len(edges), max(degrees), len(edges)/len(nodes), delta))
+            n_edges * 2.0 / (n_nodes * n_nodes - 1), n_nodes, n_edges, stats["d_max"], stats["d_avg"], delta))
 
 
 def train_test_split(args, root_dir="./"):
-    """We split the original data into three datasets along the time dimension: train, valid and test, according to `args.train_ratio` and `args.val_ratio`. Further, we remove nodes in valid and test datasets but that are unseen in train datasets. We re-index the node ids and save them in dataset.nodes files.
+    """We split the original data into three datasets along the time dimension: train, valid and test, according to `args.train_ratio` and `args.val_ratio`. Further, we remove nodes in valid and test datasets but that are unseen in train datasets. The split is cached as index arrays keyed by the content of the dataset and the ratios, see `load_split_indices`. Prepared split files in train_data/valid_data/test_data take precedence over the cached split unless `args.prepared` is False, e.g. to sweep other ratios.
     """
-    input_dir = os.path.join(root_dir, "format_data")
-    train_dir = os.path.join(root_dir, "train_data")
-    val_dir = os.path.join(root_dir, "valid_data")
-    test_dir = os.path.join(root_dir, "test_data")
+    manifest = load_manifest(os.path.join(root_dir, "format_data"))
     for name in _iterate_datasets():
-        edges, nodes = _load_data(dataset=name, mode="format_data")
         print("*****{}*****".format(name))
         start = time.time()
-        edges = edges.sort_values(by="timestamp").reset_index(drop=True)
-        ts = sorted(edges["timestamp"].unique())
-        train_ts = ts[int(args.train_ratio * len(ts))]
-        val_ts = ts[int((args.train_ratio + args.valid_ratio) * len(ts))]
-        print("Timestamp {} slots, train timestamp cut at {} slot.".format(
-            len(ts), int(args.train_ratio * len(ts))))
-        train_edges = edges[edges["timestamp"] < train_ts]
-        val_edges = edges[np.logical_and(
-            edges["timestamp"] >= train_ts, edges["timestamp"] < val_ts)]
-        test_edges = edges[edges["timestamp"] >= val_ts]
-        train_nodes = set(train_edges["from_node_id"]).union(set(train_edges["to_node_id"]))
-        print("Total {} nodes, Train/Unseen {}/{} nodes.".format(len(nodes),
-                                                                 len(train_nodes), len(nodes)-len(train_nodes)))
-        val_edges = val_edges[val_edges["from_node_id"].isin(train_nodes)]
-        val_edges = val_edges[val_edges["to_node_id"].isin(train_nodes)]
-        test_edges = test_edges[test_edges["from_node_id"].isin(train_nodes)]
-        test_edges = test_edges[test_edges["to_node_id"].isin(train_nodes)]
-        train_edges.to_csv(os.path.join(train_dir, f"{name}.edges"), index=None)
-        val_edges.to_csv(os.path.join(val_dir, f"{name}.edges"), index=None)
-        test_edges.to_csv(os.path.join(test_dir, f"{name}.edges"), index=None)
-        nodes = nodes[nodes["node_id"].isin(train_nodes)]
-        nodes["id_map"] = list(range(len(nodes)))
-        for output in [train_dir, val_dir, test_dir]:
-            nodes.to_csv(os.path.join(output, f"{name}.nodes"), index=None)
+        if has_prepared_split(dataset=name, root_dir=root_dir, prepared=args.prepared):
+            print("Read prepared split files instead of splitting format_data.")
+        train_edges, val_edges, test_edges, nodes = load_split_edges(
+            dataset=name, root_dir=root_dir, train_ratio=args.train_ratio,
+            valid_ratio=args.valid_ratio, prepared=args.prepared)
+        n_nodes = manifest[name]["nodes"]
+        print("Total {} nodes, Train/Unseen {}/{} nodes.".format(
+            n_nodes, len(nodes), n_nodes - len(nodes)))
         print("Train {} edges, valid {} edges, test {} edges.".format(
             len(train_edges), len(val_edges), len(test_edges)))
         print("Time {:.2f}".format(time.time() - start))
-    pass
 
 
-def negative_sampling(df, nodes, id2idx):
+def negative_sampling(df, nodes, id2idx, max_rounds=10):
+    """For each positive edge `(u, v, t)` in `df`, we generate a negative edge
+    `(u, v', t)`, where `v'` is uniformly sampled from `nodes` except `v`.
+    All negatives are drawn at once, and those colliding with positive edges
+    are redrawn for at most `max_rounds` rounds. The membership is tested by
+    searching the sorted keys `u * len(nodes) + index(v)` of positive edges.
+    """
     df["label"] = 1
     neg_df = df.copy().reset_index(drop=True)
     neg_df["label"] = 0
-    neg_toids = np.zeros(len(df), dtype=np.int32)
-    check_nodes = np.copy(nodes)
-    for index, row in enumerate(df.itertuples()):
-        pos_idx = id2idx[row.to_node_id]
-        # swap the positive index with the last element
-        nodes[-1], nodes[pos_idx] = nodes[pos_idx], nodes[-1]
-        neg_idx = np.random.choice(len(nodes) - 1)
-        neg_toids[index] = nodes[neg_idx]
-        # neg_test_df.loc[index, "to_node_id"] = nodes[neg_idx]
-        # swap the positive index with the last element
-        nodes[-1], nodes[pos_idx] = nodes[pos_idx], nodes[-1]
-        assert np.all(nodes == check_nodes)
-    neg_df["to_node_id"] = neg_toids
-    df = df.append(neg_df, ignore_index=True)
-    df = df.sort_values(by="timestamp")
+    num = len(nodes)
+    pos_idx = df["to_node_id"].map(id2idx).to_numpy().astype(np.int64)
+    src_codes, _ = pd.factorize(df["from_node_id"])
+    src_codes = src_codes.astype(np.int64)
+    pos_keys = np.unique(src_codes * num + pos_idx)
+
+    def draw(exclude):
+        # Uniformly sample from [0, num) except `exclude`.
+        idx = np.random.randint(num - 1, size=len(exclude))
+        idx[idx >= exclude] += 1
+        return idx
+
+    neg_idx = draw(pos_idx)
+    redraw = np.arange(len(df))
+    for _ in range(max_rounds):
+        keys = src_codes[redraw] * num + neg_idx[redraw]
+        pos = np.minimum(np.searchsorted(pos_keys, keys), len(pos_keys) - 1)
+        redraw = redraw[pos_keys[pos] == keys]
+        if len(redraw) == 0:
+            break
+        neg_idx[redraw] = draw(pos_idx[redraw])
+    neg_df["to_node_id"] = nodes[neg_idx]
+    df = pd.concat([df, neg_df], ignore_index=True)
+    df = df.sort_values(by="timestamp", kind="mergesort")
     return df
 
 
+def negative_candidates(nodes):
+    """Return the nodes from which negative destinations are sampled, and the
+    map from their ids to their positions."""
+    # If graph is bipartite, use only to_node_ids to generate negativesamples.
+    if len(nodes["role"].unique()) > 1:
+        if 'item' in set(nodes["role"]):
+            print("user-item bipartite graph")
+            mask = nodes["role"] == "item"
+        else:
+            print("0-1 bipartite graph")
+            mask = nodes["role"] == 1
+        to_node_ids = np.unique(nodes[mask]["node_id"])
+        to_nodes = nodes[nodes["node_id"].isin(to_node_ids)].copy()
+    else:
+        print("homogeneous graph")
+        to_nodes = nodes.copy()
+    id2idx = {node_id: idx for idx, node_id in enumerate(to_nodes["node_id"])}
+    return to_nodes, id2idx
+
+
 def train_test_label(args, root_dir="./"):
     # nodes, edges, d_avg, d_max, timespan(days)
     fname = _iterate_datasets()
@@ -120,27 +123,14 @@ def train_test_label(args, root_dir="./"):
     for name in fname:
         print("*****{}*****".format(name))
         start = time.time()
-        _, nodes = _load_data(dataset=name, mode="train_data")
-        # If graph is bipartite, use only to_node_ids to generate negativesamples.
-        if len(nodes["role"].unique()) > 1:
-            if 'item' in set(nodes["role"]):
-                print("user-item bipartite graph")
-                mask = nodes["role"] == "item"
-            else:
-                print("0-1 bipartite graph")
-                mask = nodes["role"] == 1
-            to_node_ids = np.unique(nodes[mask]["node_id"])
-            to_nodes = nodes[nodes["node_id"].isin(to_node_ids)].copy()
-        else:
-            print("homogeneous graph")
-            to_node_ids = nodes["node_id"].unique()
-            to_nodes = nodes.copy()
-        id2idx = {node_id: idx for idx, node_id in enumerate(to_nodes["node_id"])}
-        for indir in input_dirs:
+        *splits, nodes = load_split_edges(
+            dataset=name, root_dir=root_dir, train_ratio=args.train_ratio,
+            valid_ratio=args.valid_ratio, prepared=args.prepared)
+        to_nodes, id2idx = negative_candidates(nodes)
+        for indir, edges in zip(input_dirs, splits):
             outdir = "label_" + indir
             print("*****{}*****".format(indir))
-            edges, _ = _load_data(dataset=name, mode=indir)
-            edges = edges[columns]
+            edges = edges[columns].copy()
 
             label_df = negative_sampling(edges, to_nodes["node_id"].to_numpy(), id2idx)
             path = os.path.join(root_dir, outdir, f"{name}.edges")
@@ -151,10 +141,103 @@ def train_test_label(args, root_dir="./"):
         print("Time: {:.2f} secs".format(end - start))
 
 
+def ingest_edges(args, root_dir="./"):
+    """Append the edges in `args.input`, which are no earlier than the existing
+    edges of `args.dataset`, to the prepared dataset without a full rebuild.
+
+    The edges are appended to format_data and its columnar copy, and unknown
+    node ids are appended to dataset.nodes. The cached split keeps its cut
+    timestamps, so the new edges between train nodes extend the test split,
+    and negatives are only generated for them and appended to label_test_data.
+    Cached splits of other ratios are deleted, as the dataset changed.
+    """
+    name = args.dataset
+    columns = ["from_node_id", "to_node_id", "timestamp", "state_label"]
+    format_dir = os.path.join(root_dir, "format_data")
+    nodes_path = os.path.join(format_dir, f"{name}.nodes")
+    if has_prepared_split(dataset=name, root_dir=root_dir):
+        raise ValueError("Prepared split files are not extended by ingestion, please rebuild the dataset.")
+    split = load_split_indices(dataset=name, train_ratio=args.train_ratio,
+                               valid_ratio=args.valid_ratio, root_dir=root_dir)
+    edges = load_edge_columns(dataset=name, root_dir=root_dir, columns=["timestamp"])
+    nodes = pd.read_csv(nodes_path)
+    new_edges = pd.read_csv(args.input).sort_values(by="timestamp", kind="mergesort")
+    if new_edges["timestamp"].min() < edges["timestamp"].max():
+        raise ValueError("New edges are earlier than existing edges, please rebuild the dataset.")
+    if new_edges["timestamp"].min() < split["cuts"][1]:
+        raise ValueError("New edges fall into the train or valid split, please rebuild the dataset.")
+    print("*****{}*****".format(name))
+    start = time.time()
+
+    # extend the node table with unknown node ids
+    src = new_edges["from_node_id"].to_numpy()
+    dst = new_edges["to_node_id"].to_numpy()
+    new_ids = np.setdiff1d(np.union1d(src, dst), nodes["node_id"].to_numpy())
+    if len(new_ids) > 0:
+        if len(nodes["role"].unique()) > 1:
+            raise ValueError("Roles of new nodes in a bipartite graph are unknown, please rebuild the dataset.")
+        new_nodes = pd.DataFrame(0, index=np.arange(len(new_ids)), columns=nodes.columns)
+        new_nodes["node_id"] = new_ids
+        new_nodes["id_map"] = len(nodes) + np.arange(len(new_ids))
+        new_nodes["role"] = nodes["role"].iloc[0]
+        new_nodes.to_csv(nodes_path, mode="a", header=False, index=None)
+    append_edges(name, new_edges, root_dir=root_dir)
+
+    # extend the test split, as train nodes and cut timestamps are unchanged
+    kept = nodes.iloc[split["nodes"]].reset_index(drop=True)
+    kept["id_map"] = np.arange(len(kept))
+    mask = np.isin(src, kept["node_id"]) & np.isin(dst, kept["node_id"])
+    rows = len(edges) + np.flatnonzero(mask)
+    split["test"] = np.concatenate([split["test"], rows])
+    split["from_idx"] = np.concatenate([split["from_idx"], remap_ids(src[mask], kept)])
+    split["to_idx"] = np.concatenate([split["to_idx"], remap_ids(dst[mask], kept)])
+    # the dataset changed, so the split is saved under the key of its new
+    # content, which is hashed once here and recorded in the manifest
+    split["sha1"] = _dataset_sha1(name, root_dir)
+    save_split(split, name, args.train_ratio, args.valid_ratio, root_dir)
+
+    to_nodes, id2idx = negative_candidates(kept)
+    test_edges = new_edges[mask][columns].copy()
+    label_df = negative_sampling(test_edges, to_nodes["node_id"].to_numpy(), id2idx)
+    label_df.to_csv(os.path.join(root_dir, "label_test_data", f"{name}.edges"),
+                    mode="a", header=False, index=None)
+    print("Ingest {} edges, {} test edges, {} nodes.".format(
+        len(new_edges), len(test_edges), len(new_ids)))
+    print("Time {:.2f}".format(time.time() - start))
+    if args.verify:
+        verify_ingestion(args, root_dir=root_dir)
+
+
+def verify_ingestion(args, root_dir="./"):
+    """Check that an incrementally ingested dataset equals a full rebuild with
+    the same cut timestamps. Negatives are random, so only the positive edges
+    of label_test_data are compared.
+    """
+    name = args.dataset
+    columns = ["from_node_id", "to_node_id", "timestamp", "state_label"]
+    format_dir = os.path.join(root_dir, "format_data")
+    edges = pd.read_csv(os.path.join(format_dir, f"{name}.edges"))
+    if not edges.equals(load_edge_columns(dataset=name, root_dir=root_dir)):
+        raise ValueError("Columnar edges differ from the edges file.")
+    nodes = pd.read_csv(os.path.join(format_dir, f"{name}.nodes"))
+    split = load_split_indices(dataset=name, train_ratio=args.train_ratio,
+                               valid_ratio=args.valid_ratio, root_dir=root_dir)
+    full = compute_split(edges, nodes, split["cuts"])
+    for key, value in full.items():
+        if not np.array_equal(value, split[key]):
+            raise ValueError("Split {} differs from a full rebuild.".format(key))
+    labels = pd.read_csv(os.path.join(root_dir, "label_test_data", f"{name}.edges"))
+    pos = labels[labels["label"] == 1][columns].reset_index(drop=True)
+    test_edges = edges.iloc[split["test"]][columns].reset_index(drop=True)
+    if not np.array_equal(pos.to_numpy(), test_edges.to_numpy()):
+        raise ValueError("Positive label edges differ from the test split.")
+    print("{} equals a full rebuild.".format(name))
+
+
 def config_parser():
     parser = argparse.ArgumentParser("Configuration for a unified train-valid-test preprocesser.")
     parser.add_argument(
-        "--task", "-t", choices=["datastat", "datasplit", "datalabel"], required=True)
+        "--task", "-t", choices=["datastat", "datasplit", "datalabel", "dataingest"], required=True)
     parser.add_argument("--start", type=int, default=0, help="Datset start index.")
     parser.add_argument("--end", type=int, default=100,
                     help="Datset end index (exclusive).")
@@ -162,6 +245,12 @@ def config_parser():
                         default=0.70, help="Train dataset ratio.")
     parser.add_argument("--valid-ratio", "-vr", type=float, default=0.15,
                         help="Valid dataset ratio, and test ratio will be computed by (1-train_ratio-valid_ratio).")
+    parser.add_argument("--no-prepared", dest="prepared", action="store_false", default=True,
+                        help="Split format_data by the ratios even if prepared split files exist.")
+    parser.add_argument("--dataset", "-d", type=str, help="Dataset to ingest new edges into.")
+    parser.add_argument("--input", type=str, help="Edges file in the unified format to ingest.")
+    parser.add_argument("--verify", action="store_true", default=False,
+                        help="Whether to verify the ingested dataset against a full rebuild.")
     parser.add_argument("--label", dest="label", action="store_true", default=False,
                         help="Whether to generate negative samples for datasets. Each labeled dataset will have a suffix xxx_label.edges.")
     return parser.parse_args()
@@ -181,3 +270,5 @@ if __name__ == "__main__":
         train_test_split(args)
     elif args.task == "datalabel":
         train_test_label(args)
+    elif args.task == "dataingest":
+        ingest_edges(args)
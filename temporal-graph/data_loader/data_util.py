@@ -1,6 +1,9 @@
+import hashlib
+import json
 import numpy as np
 import os
 import pandas as pd
+import re
 from random import shuffle
 
 
@@ -22,17 +25,107 @@ def load_data(dataset="ia-contact", mode="format", root_dir="./"):
     return _load_data(dataset=dataset, mode=mode, root_dir=root_dir)
 
 
+MANIFEST = "manifest.json"
+
+
+def _file_digest(path, block_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(block_size), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def _signatures(data_dir, dataset, exts=("edges", "nodes")):
+    return np.array([[sig["size"], sig["mtime"]] for sig in (
+        _file_signature(os.path.join(data_dir, f"{dataset}.{ext}"))
+        for ext in exts)], dtype=np.float64)
+
+
+def _dataset_stats(edges_path, nodes_path, chunksize=1000000):
+    """Compute the statistics of a dataset in a streaming pass over its edges.
+    Degrees are counted on the bidirected graph, so a node's degree is the
+    number of its occurrences in `from_node_id` and `to_node_id`.
+    """
+    degrees = pd.Series(dtype=np.int64)
+    n_edges, ts_min, ts_max = 0, np.inf, -np.inf
+    for df in pd.read_csv(edges_path, chunksize=chunksize,
+                          usecols=["from_node_id", "to_node_id", "timestamp"]):
+        n_edges += len(df)
+        ts_min = min(ts_min, df["timestamp"].min())
+        ts_max = max(ts_max, df["timestamp"].max())
+        counts = pd.concat([df["from_node_id"], df["to_node_id"]]).value_counts()
+        degrees = degrees.add(counts, fill_value=0)
+    n_nodes = 0
+    for df in pd.read_csv(nodes_path, chunksize=chunksize, usecols=["node_id"]):
+        n_nodes += len(df)
+    noint = sum(not isinstance(nid, (int, np.integer)) for nid in degrees.index)
+    return {"edges": n_edges, "nodes": n_nodes, "edge_nodes": len(degrees),
+            "noint_nodes": int(noint),
+            "ts_min": float(ts_min), "ts_max": float(ts_max),
+            "d_max": int(degrees.max()) if len(degrees) else 0,
+            "d_avg": n_edges / max(n_nodes, 1)}
+
+
+def load_manifest(data_dir="./format_data/", names=None):
+    """Return a dict mapping dataset names in `data_dir` to their statistics.
+
+    The statistics are cached in `data_dir/manifest.json`, and only computed
+    for the datasets in `names`, or all datasets by default, on request.
+    Datasets without a nodes file are skipped. An entry is only recomputed
+    when the size or mtime of its edges or nodes file changes and the content
+    hash differs from the recorded one.
+    """
+    path = os.path.join(data_dir, MANIFEST)
+    manifest = {}
+    if os.path.exists(path):
+        with open(path, "r") as fp:
+            manifest = json.load(fp)
+    updated = False
+    if names is None:
+        names = sorted(f[:-6] for f in os.listdir(data_dir) if f.endswith(".edges"))
+        # forget removed datasets
+        updated = not set(manifest) <= set(names)
+        manifest = {name: manifest[name] for name in names if name in manifest}
+    names = [name for name in names
+             if os.path.exists(os.path.join(data_dir, f"{name}.nodes"))]
+    for name in names:
+        files = {"edges": os.path.join(data_dir, f"{name}.edges"),
+                 "nodes": os.path.join(data_dir, f"{name}.nodes")}
+        signature = {k: _file_signature(f) for k, f in files.items()}
+        entry = manifest.get(name, {})
+        if entry.get("signature") == signature:
+            continue
+        digest = {k: _file_digest(f) for k, f in files.items()}
+        if entry.get("sha1") != digest:
+            entry = {"stats": _dataset_stats(files["edges"], files["nodes"])}
+        entry.update(signature=signature, sha1=digest)
+        manifest[name] = entry
+        updated = True
+    if updated:
+        tmp_path = "{}.tmp{}".format(path, os.getpid())
+        with open(tmp_path, "w") as fp:
+            json.dump(manifest, fp, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+    return {name: dict(manifest[name]["stats"], sha1=manifest[name]["sha1"])
+            for name in names}
+
+
 def _iterate_datasets(dataset="all", mode="format_data", root_dir="./"):
     if dataset != "all":
         if isinstance(dataset, str):
             return [dataset]
         elif isinstance(dataset, list) and isinstance(dataset[0], str):
             return dataset
-    fname = [f for f in os.listdir(os.path.join(root_dir, mode)) if f.endswith(".edges")]
-    fpath = [os.path.join(root_dir, mode, f) for f in fname]
-    lines = [len(open(f, "r").readlines()) for f in fpath]
+    manifest = load_manifest(os.path.join(root_dir, mode))
     # sort the dataset by data size
-    forder = [f[:-6] for l, f in sorted(zip(lines, fname))]
+    forder = [name for _, name in sorted(
+        (stats["edges"], name) for name, stats in manifest.items())]
     if dataset != "all":
         if isinstance(dataset, int):
             return forder[dataset]
@@ -43,10 +136,216 @@ def _iterate_datasets(dataset="all", mode="format_data", root_dir="./"):
     return forder
 
 
-def load_split_edges(dataset="ia-contact", root_dir="./"):
-    train_edges, nodes = load_data(dataset=dataset, mode="train", root_dir=root_dir)
-    valid_edges, _ = load_data(dataset=dataset, mode="valid", root_dir=root_dir)
-    test_edges, _ = load_data(dataset=dataset, mode="test", root_dir=root_dir)
+def _save_npz(path, **arrays):
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    with open(tmp_path, "wb") as fp:
+        np.savez(fp, **arrays)
+    os.replace(tmp_path, path)
+
+
+def _edge_parts(data_dir, dataset):
+    """Return the parts of the columnar copy of dataset.edges if the last one
+    records the current signature of the CSV file, or None otherwise.
+    """
+    path = os.path.join(data_dir, f"{dataset}.columns")
+    if not os.path.isdir(path):
+        return None
+    parts = sorted(os.path.join(path, f) for f in os.listdir(path) if f.startswith("part-"))
+    if not parts:
+        return None
+    with np.load(parts[-1]) as store:
+        if np.array_equal(store["signature"], _signatures(data_dir, dataset, ["edges"])):
+            return parts
+    return None
+
+
+def _save_edge_part(data_dir, dataset, index, edges):
+    path = os.path.join(data_dir, f"{dataset}.columns")
+    os.makedirs(path, exist_ok=True)
+    _save_npz(os.path.join(path, "part-{:05d}.npz".format(index)),
+              signature=_signatures(data_dir, dataset, ["edges"]),
+              columns=np.array(edges.columns, dtype=str),
+              **{f"col{i}": edges[col].to_numpy() for i, col in enumerate(edges.columns)})
+
+
+def load_edge_columns(dataset="ia-contact", mode="format_data", root_dir="./", columns=None):
+    """Load dataset.edges, or only its `columns`, from its columnar copy in
+    dataset.columns/. The copy is a sequence of parts, one per `append_edges`,
+    and is rebuilt as a single part whenever the size or mtime of the CSV file
+    differs from the one recorded by the last part.
+    """
+    data_dir = os.path.join(root_dir, mode)
+    parts = _edge_parts(data_dir, dataset)
+    if parts is not None:
+        stores = []
+        for part in parts:
+            with np.load(part) as store:
+                names = [str(col) for col in store["columns"]]
+                stores.append({col: store[f"col{i}"] for i, col in enumerate(names)
+                               if columns is None or col in columns})
+        return pd.DataFrame({col: np.concatenate([store[col] for store in stores])
+                             for col in stores[0]})
+    edges = pd.read_csv(os.path.join(data_dir, f"{dataset}.edges"))
+    path = os.path.join(data_dir, f"{dataset}.columns")
+    if os.path.isdir(path):
+        for f in os.listdir(path):
+            os.remove(os.path.join(path, f))
+    _save_edge_part(data_dir, dataset, 0, edges)
+    return edges if columns is None else edges[columns]
+
+
+def append_edges(dataset, new_edges, root_dir="./"):
+    """Append `new_edges` to format_data/dataset.edges, and add them as a new
+    part of its columnar copy without reading or rewriting the existing rows.
+    """
+    data_dir = os.path.join(root_dir, "format_data")
+    parts = _edge_parts(data_dir, dataset)
+    if parts is None:
+        load_edge_columns(dataset=dataset, root_dir=root_dir)
+        parts = _edge_parts(data_dir, dataset)
+    with np.load(parts[-1]) as store:
+        columns = [str(col) for col in store["columns"]]
+    new_edges = new_edges[columns]
+    new_edges.to_csv(os.path.join(data_dir, f"{dataset}.edges"), mode="a", header=False, index=None)
+    _save_edge_part(data_dir, dataset, len(parts), new_edges)
+
+
+SPLIT_DIR = "split_data"
+PREPARED_MODES = ["train", "valid", "test"]
+
+
+def _dataset_sha1(dataset="ia-contact", root_dir="./"):
+    """The content hashes of the edges and nodes files from the manifest,
+    which only hashes the files again when their size or mtime changed.
+    """
+    sha1 = load_manifest(os.path.join(root_dir, "format_data"), names=[dataset])[dataset]["sha1"]
+    return np.array([sha1["edges"], sha1["nodes"]])
+
+
+def split_path(dataset="ia-contact", train_ratio=0.70, valid_ratio=0.15, root_dir="./", sha1=None):
+    """Path of the cached split, keyed by the content hashes of the dataset
+    and the ratios. `sha1` defaults to the hashes in the manifest.
+    """
+    if sha1 is None:
+        sha1 = _dataset_sha1(dataset, root_dir)
+    key = json.dumps([str(h) for h in sha1] + [train_ratio, valid_ratio])
+    key = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(root_dir, SPLIT_DIR, f"{dataset}-{key}.npz")
+
+
+def has_prepared_split(dataset="ia-contact", root_dir="./", prepared=True):
+    """Whether train_data, valid_data and test_data hold prepared split files
+    of the dataset, e.g. written by an earlier datasplit or another tool.
+    Always False with `prepared=False`, i.e., the split of format_data is used.
+    """
+    return prepared and all(
+        os.path.exists(os.path.join(root_dir, f"{mode}_data", f"{dataset}.edges"))
+        for mode in PREPARED_MODES)
+
+
+def compute_split(edges, nodes, cuts):
+    """Split edges by the cut timestamps `cuts = (train_ts, val_ts)`, see
+    `load_split_indices` for the returned arrays.
+    """
+    train_ts, val_ts = cuts
+    ts = edges["timestamp"].to_numpy()
+    order = np.argsort(ts, kind="stable")
+    sorted_ts = ts[order]
+    train = order[sorted_ts < train_ts]
+    valid = order[np.logical_and(sorted_ts >= train_ts, sorted_ts < val_ts)]
+    test = order[sorted_ts >= val_ts]
+
+    src = edges["from_node_id"].to_numpy()
+    dst = edges["to_node_id"].to_numpy()
+    train_nodes = np.union1d(src[train], dst[train])
+    valid = valid[np.isin(src[valid], train_nodes) & np.isin(dst[valid], train_nodes)]
+    test = test[np.isin(src[test], train_nodes) & np.isin(dst[test], train_nodes)]
+    node_rows = np.flatnonzero(nodes["node_id"].isin(train_nodes).to_numpy())
+    kept = nodes.iloc[node_rows].copy()
+    kept["id_map"] = np.arange(len(kept))
+    rows = np.concatenate([train, valid, test])
+    return {"train": train, "valid": valid, "test": test, "nodes": node_rows,
+            "from_idx": remap_ids(src[rows], kept),
+            "to_idx": remap_ids(dst[rows], kept),
+            "cuts": np.array(cuts)}
+
+
+def load_split_indices(dataset="ia-contact", train_ratio=0.70, valid_ratio=0.15, root_dir="./"):
+    """Split the edges of format_data along the time dimension into train,
+    valid and test edges, where valid and test edges between nodes unseen in
+    train edges are removed.
+
+    The split is stored as index arrays into the columnar edges in
+    split_data/dataset-key.npz, where key hashes the content hashes of the
+    edges and nodes files, also stored as `sha1`, and the ratios. The hashes
+    come from the manifest, so the files are only hashed again when their
+    size or mtime changed. Besides `train`, `valid` and `test` edge rows,
+    it holds the kept `nodes` rows, `from_idx` and `to_idx`, the node indices
+    (id_map + 1) of the concatenated split edges, and the cut timestamps
+    `cuts`. A split extended by `data_unify.ingest_edges` keeps the cuts of
+    the edges it was computed from.
+    """
+    sha1 = _dataset_sha1(dataset, root_dir)
+    path = split_path(dataset, train_ratio, valid_ratio, root_dir, sha1=sha1)
+    if os.path.exists(path):
+        with np.load(path) as split:
+            return dict(split)
+
+    edges = load_edge_columns(dataset=dataset, root_dir=root_dir)
+    nodes = pd.read_csv(os.path.join(root_dir, "format_data", f"{dataset}.nodes"))
+    uts = np.unique(edges["timestamp"].to_numpy())
+    cuts = (uts[int(train_ratio * len(uts))],
+            uts[int((train_ratio + valid_ratio) * len(uts))])
+    split = compute_split(edges, nodes, cuts)
+    split["sha1"] = sha1
+    save_split(split, dataset, train_ratio, valid_ratio, root_dir)
+    return split
+
+
+def save_split(split, dataset="ia-contact", train_ratio=0.70, valid_ratio=0.15, root_dir="./"):
+    """Save `split` of the dataset under the key of its `sha1`, and delete
+    the cached splits which were computed from other contents of the dataset.
+    """
+    path = split_path(dataset, train_ratio, valid_ratio, root_dir, sha1=split["sha1"])
+    split_dir = os.path.dirname(path)
+    os.makedirs(split_dir, exist_ok=True)
+    _save_npz(path, **split)
+    pattern = re.compile(re.escape(dataset) + r"-[0-9a-f]{16}\.npz")
+    for f in os.listdir(split_dir):
+        other = os.path.join(split_dir, f)
+        if other == path or not pattern.fullmatch(f):
+            continue
+        with np.load(other) as store:
+            stale = "sha1" not in store.files or not np.array_equal(
+                store["sha1"], split["sha1"])
+        if stale:
+            os.remove(other)
+
+
+def _load_split(dataset="ia-contact", root_dir="./", train_ratio=0.70, valid_ratio=0.15):
+    split = load_split_indices(dataset=dataset, train_ratio=train_ratio,
+                               valid_ratio=valid_ratio, root_dir=root_dir)
+    edges = load_edge_columns(dataset=dataset, root_dir=root_dir)
+    nodes = pd.read_csv(os.path.join(root_dir, "format_data", f"{dataset}.nodes"))
+    nodes = nodes.iloc[split["nodes"]].reset_index(drop=True)
+    nodes["id_map"] = np.arange(len(nodes))
+    dfs = [edges.iloc[split[k]].reset_index(drop=True) for k in ["train", "valid", "test"]]
+    return split, dfs, nodes
+
+
+def load_split_edges(dataset="ia-contact", root_dir="./", train_ratio=0.70, valid_ratio=0.15,
+                     prepared=True):
+    """Return train, valid and test edges, and nodes. Prepared split files are
+    read as they are, unless `prepared=False`, and the split of format_data is
+    cached otherwise, see `load_split_indices`.
+    """
+    if has_prepared_split(dataset=dataset, root_dir=root_dir, prepared=prepared):
+        train_edges, nodes = load_data(dataset=dataset, mode="train", root_dir=root_dir)
+        valid_edges, _ = load_data(dataset=dataset, mode="valid", root_dir=root_dir)
+        test_edges, _ = load_data(dataset=dataset, mode="test", root_dir=root_dir)
+        return train_edges, valid_edges, test_edges, nodes
+    _, (train_edges, valid_edges, test_edges), nodes = _load_split(
+        dataset=dataset, root_dir=root_dir, train_ratio=train_ratio, valid_ratio=valid_ratio)
     return train_edges, valid_edges, test_edges, nodes
 
 
@@ -57,33 +356,85 @@ def load_label_edges(dataset="ia-contact", root_dir="./"):
     return train_edges, valid_edges, test_edges, nodes
     
 
+def remap_ids(ids, nodes, offset=1):
+    """Map node ids to `id_map + offset` with a sort and a binary search over
+    whole columns, where `nodes` is a dataframe of node_id and id_map.
+    """
+    node_ids = nodes["node_id"].to_numpy()
+    order = np.argsort(node_ids, kind="stable")
+    sorted_ids = node_ids[order]
+    ids = np.asarray(ids)
+    pos = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+    if not np.all(sorted_ids[pos] == ids):
+        raise ValueError("Edges contain node ids which are not in nodes.")
+    return nodes["id_map"].to_numpy()[order][pos] + offset
+
+
+def _load_remapped_data(dataset="ia-contact", mode="train_data", root_dir="./"):
+    """Load dataset.edges whose node ids are remapped to `id_map + 1`. The
+    remapped columns are persisted as dataset.idmap.npz next to the edges file,
+    and are reused as long as the edges and nodes files are unchanged.
+    """
+    edges, nodes = _load_data(dataset=dataset, mode=mode, root_dir=root_dir)
+    data_dir = os.path.join(root_dir, mode)
+    signature = _signatures(data_dir, dataset)
+    path = os.path.join(data_dir, f"{dataset}.idmap.npz")
+    if os.path.exists(path):
+        with np.load(path) as cache:
+            if np.array_equal(cache["signature"], signature):
+                edges["from_node_id"] = cache["from_node_id"]
+                edges["to_node_id"] = cache["to_node_id"]
+                return edges, nodes
+    # padding node is 0, so add 1 here.
+    edges["from_node_id"] = remap_ids(edges["from_node_id"], nodes)
+    edges["to_node_id"] = remap_ids(edges["to_node_id"], nodes)
+    _save_npz(path, signature=signature,
+              from_node_id=edges["from_node_id"].to_numpy(),
+              to_node_id=edges["to_node_id"].to_numpy())
+    return edges, nodes
+
+
+def load_remapped_edges(dataset="ia-contact", prefix="", root_dir="./", prepared=True):
+    """Return train, valid and test edges with remapped node ids, and nodes.
+    Use `prefix="label_"` for the labeled datasets, and `prepared=False` for
+    the split of format_data even if prepared split files exist.
+    """
+    if not prefix and not has_prepared_split(dataset=dataset, root_dir=root_dir,
+                                             prepared=prepared):
+        # The remapped node indices are persisted with the split.
+        split, dfs, nodes = _load_split(dataset=dataset, root_dir=root_dir)
+        begin = 0
+        for df in dfs:
+            end = begin + len(df)
+            df["from_node_id"] = split["from_idx"][begin:end]
+            df["to_node_id"] = split["to_idx"][begin:end]
+            begin = end
+        return dfs[0], dfs[1], dfs[2], nodes
+    ans = [_load_remapped_data(dataset=dataset, mode=f"{prefix}{mode}_data",
+                               root_dir=root_dir)
+           for mode in PREPARED_MODES]
+    return ans[0][0], ans[1][0], ans[2][0], ans[0][1]
+
+
 def load_graph(dataset=None):
     """Concat the temporal edges, transform into nstep time slots, and return 
        edges, pivot_time.
     """
     train_edges, val_edges, test_edges, nodes = \
-        load_split_edges(dataset=dataset)
+        load_remapped_edges(dataset=dataset)
     val_time = val_edges["timestamp"].min()
     test_time = test_edges["timestamp"].min()
 
     edges = pd.concat([train_edges, val_edges, test_edges])
-    # padding node is 0, so add 1 here.
-    id2idx = {row.node_id: row.id_map + 1 for row in nodes.itertuples()}
-    edges["from_node_id"] = edges["from_node_id"].map(id2idx)
-    edges["to_node_id"] = edges["to_node_id"].map(id2idx)
     return edges, len(nodes), val_time, test_time
 
 def load_pad_graph(dataset=None, null_idx=0):
     train_edges, val_edges, test_edges, nodes = \
-        load_split_edges(dataset=dataset)
+        load_remapped_edges(dataset=dataset)
     val_time = val_edges["timestamp"].min()
     test_time = test_edges["timestamp"].min()
 
     edges = pd.concat([train_edges, val_edges, test_edges])
-    # padding node is 0, so add 1 here.
-    id2idx = {row.node_id: row.id_map + 1 for row in nodes.itertuples()}
-    edges["from_node_id"] = edges["from_node_id"].map(id2idx)
-    edges["to_node_id"] = edges["to_node_id"].map(id2idx)
     
     pad = pd.DataFrame(columns=edges.columns)
     pad.loc[0] = [0] * len(edges.columns)
@@ -94,15 +445,11 @@ def load_pad_graph(dataset=None, null_idx=0):
 
 def load_label_data(dataset=None):
     train_edges, val_edges, test_edges, nodes = \
-        load_label_edges(dataset=dataset)
+        load_remapped_edges(dataset=dataset, prefix="label_")
     pivot_time = train_edges["timestamp"].max()
 
-    # padding node is 0, so add 1 here.
-    id2idx = {row.node_id: row.id_map + 1 for row in nodes.itertuples()}
     ans = []
     for df in [train_edges, val_edges, test_edges]:
-        df["from_node_id"] = df["from_node_id"].map(id2idx)
-        df["to_node_id"] = df["to_node_id"].map(id2idx)
         df = df[["from_node_id", "to_node_id", "timestamp", "label"]]
         df.columns = ["u", "i", "ts", "label"]
         ans.append(df)
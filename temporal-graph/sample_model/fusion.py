@@ -1,11 +1,10 @@
 import logging
 
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from tgat.module import AttnModel, LSTMPool, MeanPool, TGAN
+from tgat.module import AttnModel, LSTMPool, MeanPool, TGAN, contrast_score
 
 
 # Reference: KDD 2020 AM-GCN: Adaptive Multi-channel Graph Convolutional Networks
@@ -98,17 +97,11 @@ class SamplingFusion(TGAN):
         # src_l_cut, dst_l_cut, dst_l_fake,ts_l_cut, NUM_NEIGHBORS
     def contrast(self, src_idx_l, target_idx_l, background_idx_l, cut_time_l,
                  num_neighbors):
-        src_embed, _ = self.tem_conv(src_idx_l, cut_time_l, self.num_layers,
-                                     num_neighbors)
-        target_embed, _ = self.tem_conv(target_idx_l, cut_time_l,
-                                        self.num_layers, num_neighbors)
-        background_embed, _ = self.tem_conv(background_idx_l, cut_time_l,
-                                            self.num_layers, num_neighbors)
-        pos_score = self.affinity_score(src_embed,
-                                        target_embed).squeeze(dim=-1)
-        neg_score = self.affinity_score(src_embed,
-                                        background_embed).squeeze(dim=-1)
-        return pos_score.sigmoid(), neg_score.sigmoid()
+        return contrast_score(
+            lambda idx_l, t_l: self.tem_conv(idx_l, t_l, self.num_layers,
+                                             num_neighbors)[0],
+            self.affinity_score, src_idx_l, target_idx_l, background_idx_l,
+            cut_time_l)
 
     def tem_conv(self,
                  src_idx_l,
@@ -144,36 +137,20 @@ class SamplingFusion(TGAN):
         for k, (src_ngh_node_batch, src_ngh_eidx_batch,
                 src_ngh_t_batch) in enumerate(ngh_batch):
             # Specified attention model for the k-th sampler
-            half_neighbors = num_neighbors // self.k_samplers
-
             attn_model_k = self.attn_model_list[k]
             attn_m = attn_model_k[curr_layers - 1]
 
             src_ngh_node_batch_th = torch.from_numpy(
                 src_ngh_node_batch).long().to(device)
-            src_ngh_eidx_batch = torch.from_numpy(
-                src_ngh_eidx_batch).long().to(device)
-
-            src_ngh_t_batch_delta = cut_time_l[:, np.newaxis] - src_ngh_t_batch
-            src_ngh_t_batch_th = torch.from_numpy(
-                src_ngh_t_batch_delta).float().to(device)
-
-            # get previous layer's node features
-            src_ngh_node_batch_flat = src_ngh_node_batch.flatten(
-            )  #reshape(batch_size, -1)
-            src_ngh_t_batch_flat = src_ngh_t_batch.flatten(
-            )  #reshape(batch_size, -1)
-            src_ngh_node_conv_feat, _ = self.tem_conv(
-                src_ngh_node_batch_flat,
-                src_ngh_t_batch_flat,
-                curr_layers=curr_layers - 1,
-                num_neighbors=num_neighbors)
-            src_ngh_feat = src_ngh_node_conv_feat.view(batch_size,
-                                                       half_neighbors, -1)
-
-            # get edge time features and node features
-            src_ngh_t_embed = self.time_encoder(src_ngh_t_batch_th)
-            src_ngn_edge_feat = self.edge_raw_embed(src_ngh_eidx_batch)
+
+            # get previous layer's node features, edge time features and node features
+            src_ngh_feat, src_ngh_t_embed, src_ngn_edge_feat = self.neighbor_embed(
+                lambda idx_l, t_l: self.tem_conv(idx_l,
+                                                 t_l,
+                                                 curr_layers=curr_layers - 1,
+                                                 num_neighbors=num_neighbors)[0],
+                cut_time_l, src_ngh_node_batch, src_ngh_eidx_batch,
+                src_ngh_t_batch)
 
             # attention aggregation
             mask = src_ngh_node_batch_th == 0
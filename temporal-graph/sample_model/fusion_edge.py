@@ -7,7 +7,7 @@ import os
 import sys
 import argparse
 
-from tqdm import trange
+from tqdm import tqdm, trange
 import torch
 import pandas as pd
 import numpy as np
@@ -20,9 +20,14 @@ from sklearn.metrics import roc_auc_score
 
 from data_loader.data_util import load_graph, load_label_data, load_data
 from sample_model.fusion import SamplingFusion
-from sample_model.graph import NeighborFinder, make_label_data
+from sample_model.graph import NeighborFinder, make_label_data, validate_compact
 from sample_model.gumbel_alpha import GumbelNFinder, GumbelGAN
 from sample_model.neighbor_loader import BiSamplingNFinder
+from tgat.export import ExportedEncoder, compare_encoders, export_encoder, quantized_path
+from tgat.prefetch import SamplePrefetcher
+from utils.metrics import BatchMetrics
+from utils.quantize import format_report
+from utils.time_encode import set_unique_time
 from utils.util import EarlyStopMonitor, RandEdgeSampler, get_free_gpu, set_random_seed
 
 # Argument and global variables
@@ -98,6 +103,33 @@ if True:
     parser.add_argument('--uniform',
                         action='store_true',
                         help='take uniform sampling from temporal neighbors')
+    parser.add_argument('--export',
+                        type=str,
+                        default=None,
+                        help='path to export the TorchScript encoder for CPU inference')
+    parser.add_argument('--quantize',
+                        action='store_true',
+                        help='with --export, also export an int8 encoder and report its AUC/AP deltas')
+    parser.add_argument('--packed',
+                        action='store_true',
+                        help='compute neighbor features only on real neighbors')
+    parser.add_argument('--metric_interval',
+                        type=int,
+                        default=50,
+                        help='number of batches between training metric summaries')
+    parser.add_argument('--unique_time',
+                        action='store_true',
+                        help='encode each unique delta time of a batch once')
+    parser.add_argument('--time_cache',
+                        type=int,
+                        default=0,
+                        help='with --unique_time, cache size of integer time encodings in inference')
+    parser.add_argument('--prefetch',
+                        action='store_true',
+                        help='sample the neighbors of the next batch in the background')
+    parser.add_argument('--compact',
+                        action='store_true',
+                        help='store neighbor finders in the compact int32/float32 layout')
     parser.add_argument('--alpha',
                         type=float,
                         default=1.0,
@@ -290,14 +322,19 @@ for src, dst, eidx, ts in zip(train_src_l, train_dst_l, train_e_idx_l,
                               train_ts_l):
     adj_list[src].append((dst, eidx, ts))
     adj_list[dst].append((src, eidx, ts))
-train_ngh_finder = NeighborFinder(adj_list, uniform=True)
+train_ngh_finder = NeighborFinder(adj_list, uniform=True, compact=args.compact)
 
 # # full graph with all the data for the test and validation purpose
 full_adj_list = [[] for _ in range(max_idx + 1)]
 for src, dst, eidx, ts in zip(src_l, dst_l, e_idx_l, ts_l):
     full_adj_list[src].append((dst, eidx, ts))
     full_adj_list[dst].append((src, eidx, ts))
-full_ngh_finder = NeighborFinder(full_adj_list, uniform=True)
+full_ngh_finder = NeighborFinder(full_adj_list, uniform=True, compact=args.compact)
+if args.compact:
+    full_bytes, compact_bytes = validate_compact(
+        full_ngh_finder, full_adj_list, src_l, ts_l, NUM_NEIGHBORS)
+    logger.info("Compact neighbor finder validated, CSR %d -> %d bytes.",
+                full_bytes, compact_bytes)
 
 gumbel_gnn = GumbelGAN(full_ngh_finder,
                        n_feat,
@@ -338,10 +375,13 @@ tgan = SamplingFusion(bi_finder,
                       n_head=NUM_HEADS,
                       drop_out=DROP_OUT,
                       node_dim=NODE_DIM,
-                      time_dim=TIME_DIM)
+                      time_dim=TIME_DIM,
+                      packed=args.packed)
 optimizer = torch.optim.Adam(tgan.parameters(), lr=LEARNING_RATE)
 criterion = torch.nn.BCELoss()
 tgan = tgan.to(device)
+if args.unique_time:
+    set_unique_time(tgan, cache_size=args.time_cache)
 
 num_instance = len(train_src_l)
 num_batch = math.ceil(num_instance / BATCH_SIZE)
@@ -351,19 +391,31 @@ logger.info('num of batches per epoch: {}'.format(num_batch))
 idx_list = np.arange(num_instance)
 np.random.shuffle(idx_list)
 
-early_stopper = EarlyStopMonitor()
-epoch_bar = trange(NUM_EPOCH)
-for epoch in epoch_bar:
-    # Training
-    batch_bar = trange(num_batch)
-    for k in batch_bar:
+
+def train_batches():
+    for k in range(num_batch):
         s_idx = k * BATCH_SIZE
         e_idx = min(num_instance - 1, s_idx + BATCH_SIZE)
         src_l_cut = train_src_l[s_idx:e_idx]
         dst_l_cut = train_dst_l[s_idx:e_idx]
         ts_l_cut = train_ts_l[s_idx:e_idx]
+        src_l_fake, dst_l_fake = train_rand_sampler.sample(len(src_l_cut))
+        yield src_l_cut, dst_l_cut, dst_l_fake, ts_l_cut
+
+
+prefetcher = SamplePrefetcher(tgan, NUM_NEIGHBORS) if args.prefetch else None
+metrics = BatchMetrics(args.metric_interval)
+early_stopper = EarlyStopMonitor()
+epoch_bar = trange(NUM_EPOCH)
+for epoch in epoch_bar:
+    # Training
+    metrics.reset()
+    batches = train_batches()
+    if prefetcher is not None:
+        batches = prefetcher.iterate(batches)
+    batch_bar = tqdm(batches, total=num_batch)
+    for src_l_cut, dst_l_cut, dst_l_fake, ts_l_cut in batch_bar:
         size = len(src_l_cut)
-        src_l_fake, dst_l_fake = train_rand_sampler.sample(size)
 
         with torch.no_grad():
             pos_label = torch.ones(size, dtype=torch.float, device=device)
@@ -380,17 +432,9 @@ for epoch in epoch_bar:
         loss.backward()
         optimizer.step()
         # get training results
-        with torch.no_grad():
-            tgan = tgan.eval()
-            pred_score = np.concatenate([(pos_prob).cpu().detach().numpy(),
-                                         (neg_prob).cpu().detach().numpy()])
-            pred_label = pred_score > 0.5
-            true_label = np.concatenate([np.ones(size), np.zeros(size)])
-            acc = accuracy_score(true_label, pred_label)
-            ap = average_precision_score(true_label, pred_label)
-            f1 = f1_score(true_label, pred_label)
-            auc = roc_auc_score(true_label, pred_score)
-            batch_bar.set_postfix(loss=loss.item(), acc=acc, f1=f1, auc=auc)
+        if metrics.update(loss, pos_prob, neg_prob):
+            batch_bar.set_postfix(**metrics.summary())
+    batch_bar.set_postfix(**metrics.epoch_summary())
 
     # validation phase use all information
     val_acc, val_ap, val_f1, val_auc = eval_one_epoch('val for old nodes',
@@ -427,6 +471,20 @@ logger.info('Test statistics: acc: {:.4f}, f1:{:.4f} auc: {:.4f}'.format(
 logger.info('Saving TGAN model')
 torch.save(tgan.state_dict(), MODEL_SAVE_PATH)
 logger.info('TGAN models saved')
+if args.export:
+    export_encoder(tgan, bi_finder, args.export, test_src_l[:BATCH_SIZE],
+                   test_ts_l[:BATCH_SIZE], NUM_NEIGHBORS)
+    logger.info('Encoder exported to %s', args.export)
+    if args.quantize:
+        int8_path = quantized_path(args.export)
+        export_encoder(tgan, bi_finder, int8_path, test_src_l[:BATCH_SIZE],
+                       test_ts_l[:BATCH_SIZE], NUM_NEIGHBORS, quantize=True)
+        logger.info('Int8 encoder exported to %s', int8_path)
+        report = compare_encoders(ExportedEncoder(args.export, bi_finder),
+                                  ExportedEncoder(int8_path, bi_finder),
+                                  test_src_l, test_dst_l, test_ts_l,
+                                  test_label_l, BATCH_SIZE)
+        logger.info('Int8 vs float32 on test: %s', format_report(report))
 
 res_path = "results/{}-Fusion.csv".format(DATA)
 headers = ["method", "dataset", "valid_auc", "accuracy", "f1", "auc", "params"]
@@ -21,9 +21,10 @@ from sklearn.metrics import roc_auc_score
 
 from data_loader.data_util import load_graph, load_label_data, load_data
 from sample_model.fusion import SamplingFusion
-from sample_model.graph import NeighborFinder, make_label_data
+from sample_model.graph import NeighborFinder, make_label_data, validate_compact
 from sample_model.gumbel_alpha import GumbelNFinder, GumbelGAN
 from sample_model.neighbor_loader import BiSamplingNFinder
+from utils.embed_cache import EmbedCache
 from utils.util import EarlyStopMonitor, RandEdgeSampler, get_free_gpu, set_random_seed
 
 
@@ -126,6 +127,9 @@ if True:
     parser.add_argument('--uniform',
                         action='store_true',
                         help='take uniform sampling from temporal neighbors')
+    parser.add_argument('--compact',
+                        action='store_true',
+                        help='store neighbor finders in the compact int32/float32 layout')
     parser.add_argument('--alpha',
                         type=float,
                         default=1.0,
@@ -138,6 +142,14 @@ if True:
     )
     parser.add_argument("--temp", default=1.0, type=float)
     parser.add_argument("--anneal", default=0.003, type=float)
+    parser.add_argument('--cache_capacity',
+                        type=int,
+                        default=None,
+                        help='maximum number of cached node embeddings')
+    parser.add_argument('--time_bucket',
+                        type=float,
+                        default=None,
+                        help='share cached node embeddings within time buckets')
 
 try:
     args = parser.parse_args()
@@ -295,14 +307,19 @@ for src, dst, eidx, ts in zip(train_src_l, train_dst_l, train_e_idx_l,
                               train_ts_l):
     adj_list[src].append((dst, eidx, ts))
     adj_list[dst].append((src, eidx, ts))
-train_ngh_finder = NeighborFinder(adj_list, uniform=True)
+train_ngh_finder = NeighborFinder(adj_list, uniform=True, compact=args.compact)
 
 # # full graph with all the data for the test and validation purpose
 full_adj_list = [[] for _ in range(max_idx + 1)]
 for src, dst, eidx, ts in zip(src_l, dst_l, e_idx_l, ts_l):
     full_adj_list[src].append((dst, eidx, ts))
     full_adj_list[dst].append((src, eidx, ts))
-full_ngh_finder = NeighborFinder(full_adj_list, uniform=True)
+full_ngh_finder = NeighborFinder(full_adj_list, uniform=True, compact=args.compact)
+if args.compact:
+    full_bytes, compact_bytes = validate_compact(
+        full_ngh_finder, full_adj_list, src_l, ts_l, NUM_NEIGHBORS)
+    logger.info("Compact neighbor finder validated, CSR %d -> %d bytes.",
+                full_bytes, compact_bytes)
 
 gumbel_gnn = GumbelGAN(full_ngh_finder,
                        n_feat,
@@ -371,14 +388,27 @@ lr_criterion = torch.nn.BCELoss()
 lr_criterion_eval = torch.nn.BCELoss()
 
 
+# The encoder is not trained by the node classifier, so its embeddings are
+# computed once and reused by all epochs.
+embed_cache = EmbedCache(capacity=args.cache_capacity, bucket=args.time_bucket)
+
+
+def node_embed(tgan, src_l_cut, dst_l_cut, ts_l_cut):
+    conv = lambda node_l, t_l: tgan.tem_conv(node_l, t_l, NODE_LAYER)[0]
+    src_embed = embed_cache.get_or_compute(src_l_cut, ts_l_cut, conv)
+    if BINARY:
+        dst_embed = embed_cache.get_or_compute(dst_l_cut, ts_l_cut, conv)
+        src_embed = torch.cat([src_embed, dst_embed], dim=-1)
+    return src_embed
+
+
 def eval_epoch(src_l,
                dst_l,
                ts_l,
                label_l,
                batch_size,
                lr_model,
-               tgan,
-               num_layer=NODE_LAYER):
+               tgan):
     pred_prob = np.zeros(len(src_l))
     loss = 0
     num_instance = len(src_l)
@@ -394,10 +424,7 @@ def eval_epoch(src_l,
             ts_l_cut = ts_l[s_idx:e_idx]
             label_l_cut = label_l[s_idx:e_idx]
             size = len(src_l_cut)
-            src_embed, _ = tgan.tem_conv(src_l_cut, ts_l_cut, num_layer)
-            if BINARY:
-                dst_embed, _ = tgan.tem_conv(dst_l_cut, ts_l_cut, NODE_LAYER)
-                src_embed = torch.cat([src_embed, dst_embed], dim=-1)
+            src_embed = node_embed(tgan, src_l_cut, dst_l_cut, ts_l_cut)
             src_label = torch.from_numpy(label_l_cut).float().to(device)
             lr_prob = lr_model(src_embed).sigmoid()
             loss += lr_criterion_eval(lr_prob, src_label).item()
@@ -439,31 +466,6 @@ def sample_positive(src_l_cut,
     return new_src_cut, new_dst_cut, new_ts_cut, new_label_cut
 
 
-class EmbedCache(object):
-    PRECISION = 5
-
-    def __init__(self) -> None:
-        super().__init__()
-        self.cache = {}
-
-    def update_cache(self, src_l_cut, ts_l_cut, src_emb):
-        for i, (node, ts) in enumerate(zip(src_l_cut, ts_l_cut)):
-            key = (node, ts)
-            if key not in self.cache:
-                self.cache[key] = src_emb[i]
-
-    def check_cache(self, src_l_cut, ts_l_cut):
-        ans = []
-        for i, (node, ts) in enumerate(zip(src_l_cut, ts_l_cut)):
-            key = (node, ts)
-            if key not in self.cache:
-                return None
-            ans.append(self.cache.get(key))
-        return torch.stack(ans)
-
-
-embed_cache = EmbedCache()
-
 early_stopper = EarlyStopMonitor(max_round=10)
 epoch_bar = trange(NUM_EPOCH)
 for epoch in epoch_bar:
@@ -487,16 +489,7 @@ for epoch in epoch_bar:
 
         lr_optimizer.zero_grad()
         with torch.no_grad():
-            if epoch == 0:
-                src_embed, _ = tgan.tem_conv(src_l_cut, ts_l_cut, NODE_LAYER)
-                if BINARY:
-                    dst_embed, _ = tgan.tem_conv(dst_l_cut, ts_l_cut,
-                                                 NODE_LAYER)
-                    src_embed = torch.cat([src_embed, dst_embed], dim=-1)
-
-                embed_cache.update_cache(src_l_cut, ts_l_cut, src_embed)
-            else:
-                src_embed = embed_cache.check_cache(src_l_cut, ts_l_cut)
+            src_embed = node_embed(tgan, src_l_cut, dst_l_cut, ts_l_cut)
 
         src_label = torch.from_numpy(label_l_cut).float().to(device)
         lr_prob = lr_model(src_embed).sigmoid()
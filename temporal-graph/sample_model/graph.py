@@ -1,9 +1,12 @@
 import logging
+import threading
 import numpy as np
 import torch
 from numba import jit, prange
 from joblib import Parallel, delayed
 
+from utils.crng import CounterRNG, counter_randint, counter_uniform
+
 def make_label_data(src_l, dst_l, ts_l, val_flag, rand_sampler):
     num = np.sum(val_flag)
     val_src = src_l[val_flag]
@@ -29,7 +32,7 @@ def find_before_nb(src_idx, cut_time, off_set_l, node_idx_l, node_ts_l,
     right = np.searchsorted(neighbors_ts, cut_time, side="left")
     return neighbors_idx[:right], neighbors_e_idx[:right], neighbors_ts[:right]
 
-@jit
+@jit(nogil=True)
 def get_temporal_neighbor_nb(src_idx_l,
                              cut_time_l,
                              num_neighbors,
@@ -37,13 +40,17 @@ def get_temporal_neighbor_nb(src_idx_l,
                              node_idx_l,
                              node_ts_l,
                              edge_idx_l,
-                             uniform=True):
+                             uniform=True,
+                             ts_offset=0.0,
+                             counter=False,
+                             key=np.uint64(0)):
     assert (len(src_idx_l) == len(cut_time_l))
 
     out_ngh_node_batch = np.zeros(
         (len(src_idx_l), num_neighbors)).astype(np.int32)
-    out_ngh_t_batch = np.zeros(
-        (len(src_idx_l), num_neighbors)).astype(np.float32)
+    # Timestamps are relative to `ts_offset` in the compact layout, and are
+    # restored in float64 before the cast to float32.
+    out_ngh_t_batch = np.zeros((len(src_idx_l), num_neighbors))
     out_ngh_eidx_batch = np.zeros(
         (len(src_idx_l), num_neighbors)).astype(np.int32)
 
@@ -54,14 +61,17 @@ def get_temporal_neighbor_nb(src_idx_l,
 
         if len(ngh_idx) > 0:
             if uniform:
-                sampled_idx = np.random.randint(0, len(ngh_idx), num_neighbors)
+                if counter:
+                    sampled_idx = counter_randint(key, i, len(ngh_idx), num_neighbors)
+                else:
+                    sampled_idx = np.random.randint(0, len(ngh_idx), num_neighbors)
 
                 out_ngh_node_batch[i, :] = ngh_idx[sampled_idx]
-                out_ngh_t_batch[i, :] = ngh_ts[sampled_idx]
+                out_ngh_t_batch[i, :] = ngh_ts[sampled_idx] + ts_offset
                 out_ngh_eidx_batch[i, :] = ngh_eidx[sampled_idx]
 
                 # resort based on time
-                pos = out_ngh_t_batch[i, :].argsort()
+                pos = out_ngh_t_batch[i, :].astype(np.float32).argsort()
                 out_ngh_node_batch[i, :] = out_ngh_node_batch[i, :][pos]
                 out_ngh_t_batch[i, :] = out_ngh_t_batch[i, :][pos]
                 out_ngh_eidx_batch[i, :] = out_ngh_eidx_batch[i, :][pos]
@@ -75,29 +85,126 @@ def get_temporal_neighbor_nb(src_idx_l,
                 assert (len(ngh_eidx) <= num_neighbors)
 
                 out_ngh_node_batch[i, num_neighbors - len(ngh_idx):] = ngh_idx
-                out_ngh_t_batch[i, num_neighbors - len(ngh_ts):] = ngh_ts
+                out_ngh_t_batch[i, num_neighbors - len(ngh_ts):] = ngh_ts + ts_offset
                 out_ngh_eidx_batch[i,
                                    num_neighbors - len(ngh_eidx):] = ngh_eidx
 
-    return out_ngh_node_batch, out_ngh_eidx_batch, out_ngh_t_batch
+    return out_ngh_node_batch, out_ngh_eidx_batch, out_ngh_t_batch.astype(np.float32)
+
+
+INT32_MAX = np.iinfo(np.int32).max
+
+
+def compact_csr(csr):
+    """Return CSR arrays in a compact layout and the timestamp offset. Ids
+    and offsets are int32 if they fit. Timestamps relative to the earliest one
+    are int32 if they are integers that fit, or float32 if it represents them
+    exactly, otherwise they are unchanged.
+
+    Params
+    ------
+    csr: Tuple[np.ndarray], (node_idx_l, node_ts_l, edge_idx_l, off_set_l)
+    """
+    node_idx_l, node_ts_l, edge_idx_l, off_set_l = csr
+
+    def _ids(arr):
+        if len(arr) == 0 or (arr.min() >= 0 and arr.max() <= INT32_MAX):
+            return arr.astype(np.int32)
+        return arr
+
+    ts_offset = float(node_ts_l.min()) if len(node_ts_l) > 0 else 0.0
+    rel_ts_l = node_ts_l - ts_offset
+    if np.all(rel_ts_l == np.round(rel_ts_l)) and np.all(rel_ts_l <= INT32_MAX):
+        node_ts_l = rel_ts_l.astype(np.int32)
+    elif np.all(rel_ts_l.astype(np.float32) == rel_ts_l):
+        node_ts_l = rel_ts_l.astype(np.float32)
+    else:
+        ts_offset = 0.0
+    return (_ids(node_idx_l), node_ts_l, _ids(edge_idx_l), _ids(off_set_l)), ts_offset
+
+
+def validate_compact(ngh_finder, adj_list, src_idx_l, cut_time_l, num_neighbors=20,
+                     num_queries=1000, seed=0):
+    """Check that the compact layout of `ngh_finder` samples the same
+    neighbors as `adj_list`, its source, for `num_queries` of the queries
+    spread over their time range. Return the CSR bytes of the int64/float64
+    layout and of the compact one.
+
+    Samples are drawn by a private `CounterRNG`, so the global `np.random`
+    state is untouched, and the expected samples are computed per query
+    from `adj_list` without a second copy of the CSR.
+    """
+    if ngh_finder.sampling == "exp":
+        raise ValueError("Only uniform and most recent sampling are validated.")
+    cut_time_l = np.asarray(cut_time_l, dtype=np.float64)
+    order = np.argsort(cut_time_l, kind="stable")
+    num_queries = min(num_queries, len(order))
+    idx = order[np.linspace(0, len(order) - 1, num_queries).astype(np.int64)]
+    src_idx_l = np.asarray(src_idx_l)[idx]
+    cut_time_l = cut_time_l[idx]
+
+    rng = ngh_finder.rng
+    ngh_finder.rng = CounterRNG(seed)
+    try:
+        results = ngh_finder.get_temporal_neighbor(src_idx_l, cut_time_l, num_neighbors)
+    finally:
+        ngh_finder.rng = rng
+    key = CounterRNG(seed).next_key()
+
+    for i, (src_idx, cut_time) in enumerate(zip(src_idx_l, cut_time_l)):
+        # the order of `NeighborFinder.init_off_set`
+        curr = sorted(adj_list[src_idx], key=lambda x: x[1])
+        ngh_idx = np.array([x[0] for x in curr], dtype=np.int64)
+        ngh_eidx = np.array([x[1] for x in curr], dtype=np.int64)
+        ngh_ts = np.array([x[2] for x in curr], dtype=np.float64)
+        right = np.searchsorted(ngh_ts, cut_time, side="left")
+        expected = [np.zeros(num_neighbors, dtype=np.int32),
+                    np.zeros(num_neighbors, dtype=np.int32),
+                    np.zeros(num_neighbors, dtype=np.float32)]
+        if right > 0:
+            if ngh_finder.uniform:
+                sampled = counter_randint(key, i, right, num_neighbors)
+            else:
+                sampled = np.arange(max(right - num_neighbors, 0), right)
+            for arr, src in zip(expected, [ngh_idx, ngh_eidx, ngh_ts]):
+                arr[num_neighbors - len(sampled):] = src[sampled]
+        # samples with the same timestamp may be ordered differently
+        rows = [[arr[i] for arr in results], expected]
+        for k, (nodes, eidx, ts) in enumerate(rows):
+            pos = np.lexsort((nodes, eidx, ts))
+            rows[k] = [nodes[pos], eidx[pos], ts[pos]]
+        for name, a, b in zip(["nodes", "eidx", "ts"], *rows):
+            if not np.array_equal(a, b):
+                raise ValueError("Compact layout samples different {} for node {} "
+                                 "at {}.".format(name, src_idx, cut_time))
+    full_bytes = 8 * (len(ngh_finder.node_idx_l) + len(ngh_finder.node_ts_l) +
+                      len(ngh_finder.edge_idx_l) + len(ngh_finder.off_set_l))
+    return full_bytes, ngh_finder.nbytes
 
 class NeighborFinder:
     PRECISION = 5
 
-    def __init__(self, adj_list, uniform=False, exp=False, alpha=1.0):
+    def __init__(self, adj_list, uniform=False, exp=False, alpha=1.0, csr=None, compact=False):
         """
         Params
         ------
         node_idx_l: List[int]
         node_ts_l: List[int]
         off_set_l: List[int], such that node_idx_l[off_set_l[i]:off_set_l[i + 1]] = adjacent_list[i]
+        csr: Tuple[np.ndarray], (node_idx_l, node_ts_l, edge_idx_l, off_set_l) used instead of adj_list, e.g. `SharedGraphStore.csr`
+        compact: bool, whether to store CSR arrays in the layout of `compact_csr`
         """
 
-        node_idx_l, node_ts_l, edge_idx_l, off_set_l = self.init_off_set(adj_list)
+        if csr is None:
+            csr = self.init_off_set(adj_list)
+        self.ts_offset = 0.0
+        if compact:
+            csr, self.ts_offset = compact_csr(csr)
+        node_idx_l, node_ts_l, edge_idx_l, off_set_l = csr
         self.node_idx_l = node_idx_l
         self.node_ts_l = node_ts_l
-        dt = node_ts_l.max() - node_ts_l.min()
-        self.norm_ts_l = (node_ts_l - node_ts_l.min()) / dt
+        self.ts_min = node_ts_l.min()
+        self.ts_dt = node_ts_l.max() - node_ts_l.min()
         self.edge_idx_l = edge_idx_l
 
         self.off_set_l = off_set_l
@@ -120,10 +227,23 @@ class NeighborFinder:
             self.alpha = alpha
         
         self.cache = {}
+        # the cache is shared with the thread of `tgat.prefetch.SamplePrefetcher`
+        self.cache_lock = threading.Lock()
+        # `utils.crng.CounterRNG` replacing the global `np.random` state if set
+        self.rng = None
 
         numba_logger = logging.getLogger("numba")
         numba_logger.setLevel(logging.WARNING)
 
+    @property
+    def norm_ts_l(self):
+        return (self.node_ts_l - self.ts_min) / self.ts_dt
+
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for arr in [self.node_idx_l, self.node_ts_l,
+                                          self.edge_idx_l, self.off_set_l])
+
     def init_off_set(self, adj_list):
         """
         Params
@@ -163,14 +283,16 @@ class NeighborFinder:
         """
         node_idx_l = self.node_idx_l
         node_ts_l = self.node_ts_l
-        norm_ts_l = self.norm_ts_l
         edge_idx_l = self.edge_idx_l
         off_set_l = self.off_set_l
 
         neighbors_idx = node_idx_l[off_set_l[src_idx] : off_set_l[src_idx + 1]]
         neighbors_ts = node_ts_l[off_set_l[src_idx] : off_set_l[src_idx + 1]]
-        neighbors_norm_ts = norm_ts_l[off_set_l[src_idx] : off_set_l[src_idx + 1]]
+        neighbors_norm_ts = (neighbors_ts - self.ts_min) / self.ts_dt if norm else None
         neighbors_e_idx = edge_idx_l[off_set_l[src_idx] : off_set_l[src_idx + 1]]
+        if self.ts_offset:
+            # restore absolute timestamps of the compact layout
+            neighbors_ts = neighbors_ts + self.ts_offset
 
         if len(neighbors_idx) == 0 or len(neighbors_ts) == 0:
             if norm:
@@ -182,10 +304,9 @@ class NeighborFinder:
         ngh_idx = neighbors_idx[:right]
         ngh_eidx = neighbors_e_idx[:right]
         ngh_ts = neighbors_ts[:right]
-        norm_ts = neighbors_norm_ts[:right]
 
         if norm:
-            return ngh_idx, ngh_eidx, ngh_ts, norm_ts
+            return ngh_idx, ngh_eidx, ngh_ts, neighbors_norm_ts[:right]
         else:
             return ngh_idx, ngh_eidx, ngh_ts
     
@@ -197,7 +318,7 @@ class NeighborFinder:
         if len(neighbors_ts) == 0 or len(neighbors_ts) == 0:
             return 0
 
-        right = np.searchsorted(neighbors_ts, cut_time, side="left")
+        right = np.searchsorted(neighbors_ts, cut_time - self.ts_offset, side="left")
         return right
 
     def get_temporal_neighbor(self, src_idx_l, cut_time_l, num_neighbors=20):
@@ -217,16 +338,21 @@ class NeighborFinder:
         node_ts_l = self.node_ts_l
         edge_idx_l = self.edge_idx_l
         off_set_l = self.off_set_l
-        return get_temporal_neighbor_nb(src_idx_l, cut_time_l, num_neighbors, off_set_l, node_idx_l, node_ts_l, edge_idx_l, self.uniform)
+        cut_time_l = np.asarray(cut_time_l, dtype=np.float64) - self.ts_offset
+        key = self.rng.next_key() if self.rng is not None else np.uint64(0)
+        return get_temporal_neighbor_nb(src_idx_l, cut_time_l, num_neighbors, off_set_l, node_idx_l, node_ts_l, edge_idx_l, self.uniform, self.ts_offset, self.rng is not None, key)
 
     def exp_sampling(self, src_idx_l, cut_time_l, num_neighbors=20):
+        key = self.rng.next_key() if self.rng is not None else None
         out_ngh_node_batch = np.zeros((len(src_idx_l), num_neighbors)).astype(np.int32)
         out_ngh_t_batch = np.zeros((len(src_idx_l), num_neighbors)).astype(np.float32)
         out_ngh_eidx_batch = np.zeros((len(src_idx_l), num_neighbors)).astype(np.int32)
 
         for i, (src_idx, cut_time) in enumerate(zip(src_idx_l, cut_time_l)):
             right = self.find_before_idx(src_idx, cut_time)
-            result = self.check_cache(src_idx, right)
+            # cached samples were drawn by earlier batches, so counter-based
+            # samples are always drawn from the keys of this batch
+            result = self.check_cache(src_idx, right) if key is None else None
             if result is not None:
                 out_ngh_node_batch[i] = result[0]
                 out_ngh_t_batch[i] = result[1]
@@ -251,7 +377,15 @@ class NeighborFinder:
             prob = ngh_logit / np.sum(ngh_logit)
             nonzero_num = (prob > 0).sum()
             num = min(num_neighbors, nonzero_num)
-            sampled_idx = np.random.choice(len(ngh_ts), size=num, replace=False, p=prob)
+            if key is None:
+                sampled_idx = np.random.choice(len(ngh_ts), size=num, replace=False, p=prob)
+            else:
+                # Weighted sampling without replacement by the top `num` keys
+                # log(u) / p (Efraimidis and Spirakis).
+                u = counter_uniform(key, i, len(ngh_ts))
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    score = np.where(prob > 0, np.log(u) / prob, -np.inf)
+                sampled_idx = np.argsort(-score, kind="stable")[:num]
             sampled_idx = np.sort(sampled_idx)
 
             out_ngh_node_batch[i, :num] = ngh_idx[sampled_idx]
@@ -264,8 +398,9 @@ class NeighborFinder:
             out_ngh_t_batch[i, :] = out_ngh_t_batch[i, :][pos]
             out_ngh_eidx_batch[i, :] = out_ngh_eidx_batch[i, :][pos]
 
-            result = (out_ngh_node_batch[i], out_ngh_t_batch[i], out_ngh_eidx_batch[i])
-            self.update_cache(src_idx, right, result)            
+            if key is None:
+                result = (out_ngh_node_batch[i], out_ngh_t_batch[i], out_ngh_eidx_batch[i])
+                self.update_cache(src_idx, right, result)
 
 
         return out_ngh_node_batch, out_ngh_eidx_batch, out_ngh_t_batch
@@ -302,9 +437,11 @@ class NeighborFinder:
 
     def update_cache(self, node, idx, results):
         key = (node, idx)
-        if key not in self.cache:
-            self.cache[key] = results
+        with self.cache_lock:
+            if key not in self.cache:
+                self.cache[key] = results
 
     def check_cache(self, node, idx):
         key = (node, idx)
-        return self.cache.get(key)
+        with self.cache_lock:
+            return self.cache.get(key)
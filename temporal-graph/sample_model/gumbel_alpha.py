@@ -22,6 +22,7 @@ from tgat.module import (
     MergeLayer,
     ScaledDotProductAttention,
     TGAN,
+    contrast_score,
 )
 
 
@@ -262,6 +263,13 @@ class GumbelGAN(TGAN):
         num_neighbors=20,
         gumbel=False,
     ):
+        if not gumbel:
+            return contrast_score(
+                lambda idx_l, t_l: self.tem_conv(idx_l, t_l, self.num_layers,
+                                                 num_neighbors)[0],
+                self.affinity_score, src_idx_l, target_idx_l,
+                background_idx_l, cut_time_l)
+        # gumbel_conv embeds one node per call
         src_embed, _ = self.tem_conv(src_idx_l, cut_time_l, self.num_layers,
                                      num_neighbors, gumbel)
         target_embed, _ = self.tem_conv(target_idx_l, cut_time_l,
@@ -385,8 +393,6 @@ class GumbelGAN(TGAN):
 
         device = self.n_feat_th.device
 
-        batch_size = len(src_idx_l)
-
         src_node_batch_th = torch.from_numpy(src_idx_l).long().to(device)
         cut_time_l_th = torch.from_numpy(cut_time_l).float().to(device)
 
@@ -410,29 +416,16 @@ class GumbelGAN(TGAN):
 
             src_ngh_node_batch_th = (
                 torch.from_numpy(src_ngh_node_batch).long().to(device))
-            src_ngh_eidx_batch = torch.from_numpy(
-                src_ngh_eidx_batch).long().to(device)
-
-            src_ngh_t_batch_delta = cut_time_l[:, np.newaxis] - src_ngh_t_batch
-            src_ngh_t_batch_th = (
-                torch.from_numpy(src_ngh_t_batch_delta).float().to(device))
-
-            # get previous layer's node features
-            src_ngh_node_batch_flat = (src_ngh_node_batch.flatten()
-                                       )  # reshape(batch_size, -1)
-            src_ngh_t_batch_flat = src_ngh_t_batch.flatten(
-            )  # reshape(batch_size, -1)
-            src_ngh_node_conv_feat = self.tem_conv(src_ngh_node_batch_flat,
-                                                   src_ngh_t_batch_flat,
-                                                   curr_layers=curr_layers - 1,
-                                                   num_neighbors=num_neighbors,
-                                                   gumbel=gumbel)
-            src_ngh_feat = src_ngh_node_conv_feat.view(batch_size,
-                                                       num_neighbors, -1)
 
-            # get edge time features and node features
-            src_ngh_t_embed = self.time_encoder(src_ngh_t_batch_th)
-            src_ngn_edge_feat = self.edge_raw_embed(src_ngh_eidx_batch)
+            # get previous layer's node features, edge time features and node features
+            src_ngh_feat, src_ngh_t_embed, src_ngn_edge_feat = self.neighbor_embed(
+                lambda idx_l, t_l: self.tem_conv(idx_l,
+                                                 t_l,
+                                                 curr_layers=curr_layers - 1,
+                                                 num_neighbors=num_neighbors,
+                                                 gumbel=gumbel),
+                cut_time_l, src_ngh_node_batch, src_ngh_eidx_batch,
+                src_ngh_t_batch)
 
             # attention aggregation
             mask = src_ngh_node_batch_th == 0
@@ -471,11 +464,12 @@ class GumbelNFinder(object):
 
     PRECISION = 5
 
-    def __init__(self, adj_list, gumbel_nn, hard="atte"):
+    def __init__(self, adj_list, gumbel_nn, hard="atte", csr=None):
         super(GumbelNFinder, self).__init__()
 
-        node_idx_l, node_ts_l, edge_idx_l, off_set_l = self.init_off_set(
-            adj_list)
+        if csr is None:
+            csr = self.init_off_set(adj_list)
+        node_idx_l, node_ts_l, edge_idx_l, off_set_l = csr
         self.node_idx_l = node_idx_l
         self.node_ts_l = node_ts_l
         self.edge_idx_l = edge_idx_l
@@ -19,8 +19,9 @@ from sklearn.metrics import f1_score
 from sklearn.metrics import roc_auc_score
 
 from data_loader.data_util import load_graph, load_label_data, load_data
-from sample_model.graph import NeighborFinder, make_label_data
+from sample_model.graph import NeighborFinder, make_label_data, validate_compact
 from sample_model.gumbel_alpha import GumbelGAN
+from utils.metrics import BatchMetrics
 from utils.util import EarlyStopMonitor, RandEdgeSampler, get_free_gpu, set_random_seed
 
 # Argument and global variables
@@ -96,6 +97,13 @@ if True:
     parser.add_argument('--uniform',
                         action='store_true',
                         help='take uniform sampling from temporal neighbors')
+    parser.add_argument('--compact',
+                        action='store_true',
+                        help='store neighbor finders in the compact int32/float32 layout')
+    parser.add_argument('--metric_interval',
+                        type=int,
+                        default=50,
+                        help='number of batches between training metric summaries')
     parser.add_argument(
         "--hard",
         default="soft",
@@ -279,14 +287,19 @@ for src, dst, eidx, ts in zip(train_src_l, train_dst_l, train_e_idx_l,
                               train_ts_l):
     adj_list[src].append((dst, eidx, ts))
     adj_list[dst].append((src, eidx, ts))
-train_ngh_finder = NeighborFinder(adj_list, uniform=True)
+train_ngh_finder = NeighborFinder(adj_list, uniform=True, compact=args.compact)
 
 # full graph with all the data for the test and validation purpose
 full_adj_list = [[] for _ in range(max_idx + 1)]
 for src, dst, eidx, ts in zip(src_l, dst_l, e_idx_l, ts_l):
     full_adj_list[src].append((dst, eidx, ts))
     full_adj_list[dst].append((src, eidx, ts))
-full_ngh_finder = NeighborFinder(full_adj_list, uniform=True)
+full_ngh_finder = NeighborFinder(full_adj_list, uniform=True, compact=args.compact)
+if args.compact:
+    full_bytes, compact_bytes = validate_compact(
+        full_ngh_finder, full_adj_list, src_l, ts_l, NUM_NEIGHBORS)
+    logger.info("Compact neighbor finder validated, CSR %d -> %d bytes.",
+                full_bytes, compact_bytes)
 
 tgan = GumbelGAN(train_ngh_finder,
                  n_feat,
@@ -318,10 +331,12 @@ np.random.shuffle(idx_list)
 # Pretraining a 1-layer GumbelGAN with uniform sampling.
 if True:
     logger.info("Pretraining a 1-layer GumberlGAN with uniform sampling.")
+    metrics = BatchMetrics(args.metric_interval)
     early_stopper = EarlyStopMonitor()
     epoch_bar = trange(NUM_EPOCH)
     for epoch in epoch_bar:
         # Training
+        metrics.reset()
         # training use only training graph
         tgan.ngh_finder = train_ngh_finder
         np.random.shuffle(idx_list)
@@ -354,21 +369,9 @@ if True:
             loss.backward()
             optimizer.step()
             # get training results
-            with torch.no_grad():
-                tgan = tgan.eval()
-                pred_score = np.concatenate([(pos_prob).cpu().detach().numpy(),
-                                             (neg_prob).cpu().detach().numpy()
-                                             ])
-                pred_label = pred_score > 0.5
-                true_label = np.concatenate([np.ones(size), np.zeros(size)])
-                acc = accuracy_score(true_label, pred_label)
-                ap = average_precision_score(true_label, pred_label)
-                f1 = f1_score(true_label, pred_label)
-                auc = roc_auc_score(true_label, pred_score)
-                batch_bar.set_postfix(loss=loss.item(),
-                                      acc=acc,
-                                      f1=f1,
-                                      auc=auc)
+            if metrics.update(loss, pos_prob, neg_prob):
+                batch_bar.set_postfix(**metrics.summary())
+        batch_bar.set_postfix(**metrics.epoch_summary())
 
         # validation phase use all information
         tgan.ngh_finder = full_ngh_finder
@@ -408,11 +411,13 @@ if True:
     ANNEAL_RATE = args.anneal
     optimizer = torch.optim.Adam(tgan.parameters(),
                                  lr=LEARNING_RATE / BATCH_SIZE)
+    metrics = BatchMetrics(args.metric_interval)
     early_stopper = EarlyStopMonitor()
     # epoch_bar = trange(NUM_EPOCH)
     epoch_bar = trange(1)
     for epoch in epoch_bar:
         # Training
+        metrics.reset()
         # training use only training graph
         tgan.ngh_finder = train_ngh_finder
         np.random.shuffle(idx_list)
@@ -461,19 +466,9 @@ if True:
                 temp = np.maximum(temp * np.exp(-ANNEAL_RATE * k), TEMP_MIN)
             tgan.anneal_temp(temp)
             # get training results
-            with torch.no_grad():
-                tgan = tgan.eval()
-                pred_score = np.concatenate([pos_prob, neg_prob])
-                pred_label = pred_score > 0.5
-                true_label = np.concatenate([np.ones(size), np.zeros(size)])
-                acc = accuracy_score(true_label, pred_label)
-                ap = average_precision_score(true_label, pred_label)
-                f1 = f1_score(true_label, pred_label)
-                auc = roc_auc_score(true_label, pred_score)
-                batch_bar.set_postfix(loss=loss.item(),
-                                      acc=acc,
-                                      f1=f1,
-                                      auc=auc)
+            if metrics.update(loss, pos_prob, neg_prob):
+                batch_bar.set_postfix(**metrics.summary())
+        batch_bar.set_postfix(**metrics.epoch_summary())
 
         # validation phase use all information
         tgan.ngh_finder = full_ngh_finder
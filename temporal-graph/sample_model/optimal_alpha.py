@@ -1,5 +1,6 @@
 import argparse
 import logging
+import os
 import resource
 import time
 from collections import defaultdict
@@ -16,6 +17,7 @@ from tqdm import trange
 from data_loader.data_util import _iterate_datasets
 from data_loader.data_util import load_graph, load_data
 from sample_model.graph import NeighborFinder
+from utils.shared_graph import SharedGraphStore
 
 
 def optimal_alpha(offset_l, node_idx_l, node_ts_l, latest=True):
@@ -26,10 +28,24 @@ def optimal_alpha(offset_l, node_idx_l, node_ts_l, latest=True):
     '''
 
     start = time.time()
+    # Workers attach to the shared arrays instead of receiving their own copies.
+    store = SharedGraphStore.publish(
+        f"optimal-alpha-{os.getpid()}",
+        {"off_set_l": offset_l, "node_idx_l": node_idx_l, "node_ts_l": node_ts_l})
+    name = store.name
 
     def _solve_alpha(k):
         soft, hard = resource.getrlimit(resource.RLIMIT_AS)
         resource.setrlimit(resource.RLIMIT_AS, (10 * (2**30), hard))
+        # Release the reference explicitly, as loky workers may be terminated
+        # without running atexit handlers.
+        with SharedGraphStore.attach(name) as shared:
+            return _solve_alpha_arrays(k, shared.arrays)
+
+    def _solve_alpha_arrays(k, arrays):
+        offset_l = arrays["off_set_l"]
+        node_idx_l = arrays["node_idx_l"]
+        node_ts_l = arrays["node_ts_l"]
 
         ALPHA = cp.Variable()
         left = offset_l[k]
@@ -65,8 +81,9 @@ def optimal_alpha(offset_l, node_idx_l, node_ts_l, latest=True):
             return a_
 
     n_node = len(offset_l) - 1
-    result = Parallel(n_jobs=30, verbose=10)(delayed(_solve_alpha)(k)
-                                             for k in range(n_node))
+    with store:
+        result = Parallel(n_jobs=30, verbose=10)(delayed(_solve_alpha)(k)
+                                                 for k in range(n_node))
     end = time.time()
     logging.info("Optimal alpha construction cost %.2f seconds.", end - start)
     return np.array(result)
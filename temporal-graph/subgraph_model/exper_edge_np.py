@@ -7,7 +7,7 @@ import os
 import sys
 import argparse
 
-from tqdm import trange
+from tqdm import tqdm, trange
 import torch
 import pandas as pd
 import numpy as np
@@ -22,6 +22,13 @@ from data_loader.data_util import load_graph, load_label_data, load_data
 from sample_model.graph import make_label_data
 from subgraph_model.subgnn_np import SubGnnNp
 from subgraph_model.graph import SubgraphNeighborFinder
+from tgat.export import ExportedEncoder, compare_encoders, export_encoder, quantized_path
+from tgat.prefetch import SamplePrefetcher
+from utils.crng import CounterRNG
+from utils.metrics import BatchMetrics
+from utils.quantize import format_report
+from utils.shared_graph import CSR_KEYS, SharedGraphStore
+from utils.time_encode import set_unique_time
 from utils.util import EarlyStopMonitor, RandEdgeSampler, get_free_gpu, set_random_seed
 
 # Argument and global variables
@@ -90,6 +97,38 @@ if True:
     parser.add_argument('--num_prop', type=int, default=2)
     parser.add_argument('--num_mlp_layers', type=int, default=2)
     parser.add_argument('--alpha', type=float, default=0.0)
+    parser.add_argument('--export',
+                        type=str,
+                        default=None,
+                        help='path to export the TorchScript encoder for CPU inference')
+    parser.add_argument('--quantize',
+                        action='store_true',
+                        help='with --export, also export an int8 encoder and report its AUC/AP deltas')
+    parser.add_argument('--packed',
+                        action='store_true',
+                        help='compute neighbor features only on real neighbors')
+    parser.add_argument('--metric_interval',
+                        type=int,
+                        default=50,
+                        help='number of batches between training metric summaries')
+    parser.add_argument('--unique_time',
+                        action='store_true',
+                        help='encode each unique delta time of a batch once')
+    parser.add_argument('--time_cache',
+                        type=int,
+                        default=0,
+                        help='with --unique_time, cache size of integer time encodings in inference')
+    parser.add_argument('--prefetch',
+                        action='store_true',
+                        help='sample the neighbors of the next batch in the background')
+    parser.add_argument('--crng',
+                        type=int,
+                        default=None,
+                        help='seed of counter-based random sampling, keyed by epoch and batch')
+    parser.add_argument('--shared_graph',
+                        type=str,
+                        default=None,
+                        help='name of a shared memory graph store, which parallel runs on the same data attach to instead of building their own')
 
 try:
     args = parser.parse_args()
@@ -179,6 +218,8 @@ def eval_one_epoch(hint, tgan, src, dst, ts, label):
             src_l_cut = src[s_idx:e_idx]
             dst_l_cut = dst[s_idx:e_idx]
             ts_l_cut = ts[s_idx:e_idx]
+            if rng is not None:
+                rng.set_batch(0, k, CounterRNG.EVAL)
             prob_score = tgan.forward(src_l_cut, dst_l_cut, ts_l_cut, NUM_NEIGHBORS)
             scores.extend(list(prob_score.cpu().numpy()))
         pred_label = np.array(scores) > 0.5
@@ -268,18 +309,41 @@ if True:
     else:
         raise NotImplementedError(TASK)
 
-# full graph with all the data for the test and validation purpose
-full_adj_list = [[] for _ in range(max_idx + 1)]
-for src, dst, eidx, ts in zip(src_l, dst_l, e_idx_l, ts_l):
-    full_adj_list[src].append((dst, eidx, ts))
-    full_adj_list[dst].append((src, eidx, ts))
-# full_ngh_finder = NeighborFinder(full_adj_list, uniform=UNIFORM)
-ngh_finder = SubgraphNeighborFinder(full_adj_list,
-                                    ts_l,
-                                    graph_type="numpy",
-                                    task=TASK,
-                                    dataset=DATA,
-                                    uniform=UNIFORM)
+def build_ngh_finder(csr=None):
+    # full graph with all the data for the test and validation purpose
+    full_adj_list = None
+    if csr is None:
+        full_adj_list = [[] for _ in range(max_idx + 1)]
+        for src, dst, eidx, ts in zip(src_l, dst_l, e_idx_l, ts_l):
+            full_adj_list[src].append((dst, eidx, ts))
+            full_adj_list[dst].append((src, eidx, ts))
+    # full_ngh_finder = NeighborFinder(full_adj_list, uniform=UNIFORM)
+    return SubgraphNeighborFinder(full_adj_list,
+                                  ts_l,
+                                  graph_type="numpy",
+                                  task=TASK,
+                                  dataset=DATA,
+                                  uniform=UNIFORM,
+                                  csr=csr)
+
+
+def build_shared_csr():
+    finder = build_ngh_finder()
+    return dict(zip(CSR_KEYS, (finder.node_idx_l, finder.node_ts_l,
+                               finder.edge_idx_l, finder.off_set_l)))
+
+
+if args.shared_graph is None:
+    ngh_finder = build_ngh_finder()
+else:
+    # the finder keeps the shared arrays mapped until the run ends
+    with SharedGraphStore.open(args.shared_graph, build_shared_csr) as store:
+        ngh_finder = build_ngh_finder(csr=store.csr)
+rng = None
+if args.crng is not None:
+    rng = CounterRNG(args.crng)
+    ngh_finder.rng = rng
+    train_sampler.rng = rng
 
 # Model initialize
 # os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
@@ -294,11 +358,14 @@ tgan = SubGnnNp(ngh_finder,
                 num_mlp_layers=NUM_MLP_LAYERS,
                 alpha=ALPHA,
                 n_head=NUM_HEADS,
-                drop_out=DROP_OUT)
+                drop_out=DROP_OUT,
+                packed=args.packed)
 
 optimizer = torch.optim.Adam(tgan.parameters(), lr=LEARNING_RATE)
 criterion = torch.nn.BCELoss()
 tgan = tgan.to(device)
+if args.unique_time:
+    set_unique_time(tgan, cache_size=args.time_cache)
 
 num_instance = len(train_src_l)
 num_batch = math.ceil(num_instance / BATCH_SIZE)
@@ -308,20 +375,34 @@ logger.info('num of batches per epoch: {}'.format(num_batch))
 idx_list = np.arange(num_instance)
 np.random.shuffle(idx_list)
 
-early_stopper = EarlyStopMonitor()
-epoch_bar = trange(NUM_EPOCH)
-for epoch in epoch_bar:
-    # Training
-    np.random.shuffle(idx_list)
-    batch_bar = trange(num_batch)
-    for k in batch_bar:
+
+def train_batches(epoch):
+    for k in range(num_batch):
         s_idx = k * BATCH_SIZE
         e_idx = min(num_instance, s_idx + BATCH_SIZE)
         src_l_cut = train_src_l[s_idx:e_idx]
         dst_l_cut = train_dst_l[s_idx:e_idx]
         ts_l_cut = train_ts_l[s_idx:e_idx]
+        if rng is not None:
+            rng.set_batch(epoch, k)
+        src_l_fake, dst_l_fake = train_sampler.sample(len(src_l_cut))
+        yield src_l_cut, dst_l_cut, dst_l_fake, ts_l_cut
+
+
+prefetcher = SamplePrefetcher(tgan, NUM_NEIGHBORS) if args.prefetch else None
+metrics = BatchMetrics(args.metric_interval)
+early_stopper = EarlyStopMonitor()
+epoch_bar = trange(NUM_EPOCH)
+for epoch in epoch_bar:
+    # Training
+    metrics.reset()
+    np.random.shuffle(idx_list)
+    batches = train_batches(epoch)
+    if prefetcher is not None:
+        batches = prefetcher.iterate(batches)
+    batch_bar = tqdm(batches, total=num_batch)
+    for src_l_cut, dst_l_cut, dst_l_fake, ts_l_cut in batch_bar:
         size = len(src_l_cut)
-        src_l_fake, dst_l_fake = train_sampler.sample(size)
 
         with torch.no_grad():
             pos_label = torch.ones(size, dtype=torch.float, device=device)
@@ -338,17 +419,9 @@ for epoch in epoch_bar:
         loss.backward()
         optimizer.step()
         # get training results
-        with torch.no_grad():
-            tgan = tgan.eval()
-            pred_score = np.concatenate([(pos_prob).cpu().detach().numpy(),
-                                         (neg_prob).cpu().detach().numpy()])
-            pred_label = pred_score > 0.5
-            true_label = np.concatenate([np.ones(size), np.zeros(size)])
-            acc = accuracy_score(true_label, pred_label)
-            ap = average_precision_score(true_label, pred_label)
-            f1 = f1_score(true_label, pred_label)
-            auc = roc_auc_score(true_label, pred_score)
-            batch_bar.set_postfix(loss=loss.item(), acc=acc, f1=f1, auc=auc)
+        if metrics.update(loss, pos_prob, neg_prob):
+            batch_bar.set_postfix(**metrics.summary())
+    batch_bar.set_postfix(**metrics.epoch_summary())
 
     val_acc, val_ap, val_f1, val_auc = eval_one_epoch('val for old nodes',
                                                       tgan, val_src_l,
@@ -384,6 +457,20 @@ logger.info('Test statistics: acc: {:.4f}, f1:{:.4f} auc: {:.4f}'.format(
 logger.info('Saving Subgraph model')
 torch.save(tgan.state_dict(), MODEL_SAVE_PATH)
 logger.info('Subgraph models saved')
+if args.export:
+    export_encoder(tgan, ngh_finder, args.export, test_src_l[:BATCH_SIZE],
+                   test_ts_l[:BATCH_SIZE], NUM_NEIGHBORS)
+    logger.info('Encoder exported to %s', args.export)
+    if args.quantize:
+        int8_path = quantized_path(args.export)
+        export_encoder(tgan, ngh_finder, int8_path, test_src_l[:BATCH_SIZE],
+                       test_ts_l[:BATCH_SIZE], NUM_NEIGHBORS, quantize=True)
+        logger.info('Int8 encoder exported to %s', int8_path)
+        report = compare_encoders(ExportedEncoder(args.export, ngh_finder),
+                                  ExportedEncoder(int8_path, ngh_finder),
+                                  test_src_l, test_dst_l, test_ts_l,
+                                  test_label_l, BATCH_SIZE)
+        logger.info('Int8 vs float32 on test: %s', format_report(report))
 
 res_path = "results/{}-Subgraph.csv".format(DATA)
 headers = ["method", "dataset", "valid_auc", "accuracy", "f1", "auc", "params"]
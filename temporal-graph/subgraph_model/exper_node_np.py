@@ -14,6 +14,7 @@ from data_loader.data_util import load_data, load_graph, load_label_data
 from sklearn.metrics import (accuracy_score, average_precision_score, f1_score,
                              roc_auc_score)
 from tqdm import tqdm, trange
+from utils.embed_cache import EmbedCache
 from utils.util import (EarlyStopMonitor, RandEdgeSampler, get_free_gpu,
                         set_random_seed)
 
@@ -113,6 +114,14 @@ if True:
     parser.add_argument('--num_prop', type=int, default=2)
     parser.add_argument('--num_mlp_layers', type=int, default=2)
     parser.add_argument('--alpha', type=float, default=0.0)
+    parser.add_argument('--cache_capacity',
+                        type=int,
+                        default=None,
+                        help='maximum number of cached node embeddings')
+    parser.add_argument('--time_bucket',
+                        type=float,
+                        default=None,
+                        help='share cached node embeddings within time buckets')
 
 try:
     args = parser.parse_args()
@@ -309,14 +318,27 @@ lr_criterion = torch.nn.BCELoss()
 lr_criterion_eval = torch.nn.BCELoss()
 
 
+# The encoder is not trained by the node classifier, so its embeddings are
+# computed once and reused by all epochs.
+embed_cache = EmbedCache(capacity=args.cache_capacity, bucket=args.time_bucket)
+
+
+def node_embed(tgan, src_l_cut, dst_l_cut, ts_l_cut):
+    conv = lambda node_l, t_l: tgan.tem_conv(node_l, t_l, NODE_LAYER)
+    src_embed = embed_cache.get_or_compute(src_l_cut, ts_l_cut, conv)
+    if BINARY:
+        dst_embed = embed_cache.get_or_compute(dst_l_cut, ts_l_cut, conv)
+        src_embed = torch.cat([src_embed, dst_embed], dim=-1)
+    return src_embed
+
+
 def eval_epoch(src_l,
                dst_l,
                ts_l,
                label_l,
                batch_size,
                lr_model,
-               tgan,
-               num_layer=NODE_LAYER):
+               tgan):
     pred_prob = np.zeros(len(src_l))
     loss = 0
     num_instance = len(src_l)
@@ -332,16 +354,7 @@ def eval_epoch(src_l,
             ts_l_cut = ts_l[s_idx:e_idx]
             label_l_cut = label_l[s_idx:e_idx]
             size = len(src_l_cut)
-
-            cache_embed = embed_cache.check_cache(src_l_cut, ts_l_cut)
-            if cache_embed is None:
-                src_embed = tgan.tem_conv(src_l_cut, ts_l_cut, num_layer)
-                if BINARY:
-                    dst_embed = tgan.tem_conv(dst_l_cut, ts_l_cut, NODE_LAYER)
-                    src_embed = torch.cat([src_embed, dst_embed], dim=-1)
-                embed_cache.update_cache(src_l_cut, ts_l_cut, src_embed)
-            else:
-                src_embed = cache_embed
+            src_embed = node_embed(tgan, src_l_cut, dst_l_cut, ts_l_cut)
 
             src_label = torch.from_numpy(label_l_cut).float().to(device)
             lr_prob = lr_model(src_embed).sigmoid()
@@ -384,31 +397,6 @@ def sample_positive(src_l_cut,
     return new_src_cut, new_dst_cut, new_ts_cut, new_label_cut
 
 
-class EmbedCache(object):
-    PRECISION = 5
-
-    def __init__(self) -> None:
-        super().__init__()
-        self.cache = {}
-
-    def update_cache(self, src_l_cut, ts_l_cut, src_emb):
-        for i, (node, ts) in enumerate(zip(src_l_cut, ts_l_cut)):
-            key = (node, round(ts, self.PRECISION))
-            if key not in self.cache:
-                self.cache[key] = src_emb[i]
-
-    def check_cache(self, src_l_cut, ts_l_cut):
-        ans = []
-        for i, (node, ts) in enumerate(zip(src_l_cut, ts_l_cut)):
-            key = (node, round(ts, self.PRECISION))
-            if key not in self.cache:
-                return None
-            ans.append(self.cache.get(key))
-        return torch.stack(ans)
-
-
-embed_cache = EmbedCache()
-
 early_stopper = EarlyStopMonitor(max_round=10)
 epoch_bar = trange(NUM_EPOCH)
 for epoch in epoch_bar:
@@ -432,16 +420,7 @@ for epoch in epoch_bar:
 
         lr_optimizer.zero_grad()
         with torch.no_grad():
-            if epoch == 0:
-                src_embed = tgan.tem_conv(src_l_cut, ts_l_cut, NODE_LAYER)
-                if BINARY:
-                    dst_embed = tgan.tem_conv(dst_l_cut, ts_l_cut,
-                                                 NODE_LAYER)
-                    src_embed = torch.cat([src_embed, dst_embed], dim=-1)
-
-                embed_cache.update_cache(src_l_cut, ts_l_cut, src_embed)
-            else:
-                src_embed = embed_cache.check_cache(src_l_cut, ts_l_cut)
+            src_embed = node_embed(tgan, src_l_cut, dst_l_cut, ts_l_cut)
 
         src_label = torch.from_numpy(label_l_cut).float().to(device)
         lr_prob = lr_model(src_embed).sigmoid()
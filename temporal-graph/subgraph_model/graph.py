@@ -10,6 +10,7 @@ import time
 from tqdm import trange
 
 from subgraph_model.preprocess import load_data_var, init_adj, interaction2subgraph, subgraph_np, subgraph_dgl
+from utils.crng import counter_randint
 
 
 @jit
@@ -23,7 +24,7 @@ def find_before_nb(src_idx, cut_time, off_set_l, node_idx_l, node_ts_l,
     return neighbors_idx[:right], neighbors_e_idx[:right], neighbors_ts[:right]
 
 
-@jit
+@jit(nogil=True)
 def get_temporal_neighbor_nb(src_idx_l,
                              cut_time_l,
                              num_neighbors,
@@ -31,7 +32,9 @@ def get_temporal_neighbor_nb(src_idx_l,
                              node_idx_l,
                              node_ts_l,
                              edge_idx_l,
-                             uniform=True):
+                             uniform=True,
+                             counter=False,
+                             key=np.uint64(0)):
     assert (len(src_idx_l) == len(cut_time_l))
 
     out_ngh_node_batch = np.zeros(
@@ -48,7 +51,10 @@ def get_temporal_neighbor_nb(src_idx_l,
 
         if len(ngh_idx) > 0:
             if uniform:
-                sampled_idx = np.random.randint(0, len(ngh_idx), num_neighbors)
+                if counter:
+                    sampled_idx = counter_randint(key, i, len(ngh_idx), num_neighbors)
+                else:
+                    sampled_idx = np.random.randint(0, len(ngh_idx), num_neighbors)
 
                 out_ngh_node_batch[i, :] = ngh_idx[sampled_idx]
                 out_ngh_t_batch[i, :] = ngh_ts[sampled_idx]
@@ -139,18 +145,21 @@ class SubgraphNeighborFinder:
                  graph_type="numpy",
                  task="edge",
                  dataset="ia-contact",
-                 uniform=False):
+                 uniform=False,
+                 csr=None):
         """
         Params
         ------
         node_idx_l: List[int]
         node_ts_l: List[int]
         off_set_l: List[int], such that node_idx_l[off_set_l[i]:off_set_l[i + 1]] = adjacent_list[i]
+        csr: Tuple[np.ndarray], (node_idx_l, node_ts_l, edge_idx_l, off_set_l) used instead of adj_list, e.g. `SharedGraphStore.csr`
         """
 
         self.ts_l = ts_l
-        node_idx_l, node_ts_l, edge_idx_l, off_set_l = self.init_off_set(
-            adj_list)
+        if csr is None:
+            csr = self.init_off_set(adj_list)
+        node_idx_l, node_ts_l, edge_idx_l, off_set_l = csr
         self.node_idx_l = node_idx_l
         self.node_ts_l = node_ts_l
         self.edge_idx_l = edge_idx_l
@@ -164,6 +173,8 @@ class SubgraphNeighborFinder:
         self._ngh_cache = {}
         self._off_cache = {}
         self.uniform = uniform
+        # `utils.crng.CounterRNG` replacing the global `np.random` state if set
+        self.rng = None
 
         numba_logger = logging.getLogger('numba')
         numba_logger.setLevel(logging.WARNING)
@@ -260,9 +271,11 @@ class SubgraphNeighborFinder:
         edge_idx_l = self.edge_idx_l
         off_set_l = self.off_set_l
 
+        key = self.rng.next_key() if self.rng is not None else np.uint64(0)
         return get_temporal_neighbor_nb(src_idx_l, cut_time_l, num_neighbors,
                                         off_set_l, node_idx_l, node_ts_l,
-                                        edge_idx_l, self.uniform)
+                                        edge_idx_l, self.uniform,
+                                        self.rng is not None, key)
     
     def batch_interaction2subgraph(self, src_idx_l, cut_time_l, num_neighbors=20):
         ngh_node_batch, ngh_eidx_batch, ngh_t_batch = self.get_temporal_neighbor(
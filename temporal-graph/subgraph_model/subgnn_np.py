@@ -8,7 +8,7 @@ import torch.nn.functional as F
 
 from subgraph_model.graph import batch_interaction2subgraph
 from subgraph_model.mlp import MLP
-from tgat.module import TimeEncode, MapBasedMultiHeadAttention, MultiHeadAttention, TGAN, MergeLayer
+from tgat.module import TimeEncode, MapBasedMultiHeadAttention, MultiHeadAttention, TGAN, MergeLayer, PackedNeighbors, contrast_score
 
 
 class SimpleAttention(torch.nn.Module):
@@ -159,12 +159,15 @@ class SubGnnNp(nn.Module):
                  alpha=0.2,
                  n_head=1,
                  null_idx=0,
-                 drop_out=0.1):
+                 drop_out=0.1,
+                 packed=False):
         super(SubGnnNp, self).__init__()
 
         self.num_layers = num_layers
         self.ngh_finder = ngh_finder
         self.null_idx = null_idx
+        # compute neighbor features only on real neighbors
+        self.packed = packed
         self.logger = logging.getLogger(__name__)
 
         self.n_feat_th = torch.nn.Parameter(
@@ -241,17 +244,11 @@ class SubGnnNp(nn.Module):
                  background_idx_l,
                  cut_time_l,
                  num_neighbors=20):
-        src_embed = self.tem_conv(src_idx_l, cut_time_l, self.num_layers,
-                                  num_neighbors)
-        target_embed = self.tem_conv(target_idx_l, cut_time_l, self.num_layers,
-                                     num_neighbors)
-        background_embed = self.tem_conv(background_idx_l, cut_time_l,
-                                         self.num_layers, num_neighbors)
-        pos_score = self.affinity_score(src_embed,
-                                        target_embed).squeeze(dim=-1)
-        neg_score = self.affinity_score(src_embed,
-                                        background_embed).squeeze(dim=-1)
-        return pos_score.sigmoid(), neg_score.sigmoid()
+        return contrast_score(
+            lambda idx_l, t_l: self.tem_conv(idx_l, t_l, self.num_layers,
+                                             num_neighbors),
+            self.affinity_score, src_idx_l, target_idx_l, background_idx_l,
+            cut_time_l)
 
     def tem_conv(self, src_idx_l, cut_time_l, curr_layers, num_neighbors=20):
         assert (curr_layers >= 0)
@@ -296,12 +293,29 @@ class SubGnnNp(nn.Module):
                                num_neighbors,
                                axis=1).flatten()
 
-        src_ngh_conv_feat = self.tem_conv(flat_ngh_nid,
-                                          flat_ngh_t,
-                                          curr_layers=curr_layers - 1,
-                                          num_neighbors=num_neighbors)
-        src_ngh_conv_feat = src_ngh_conv_feat.view(batch_size, num_neighbors,
-                                                   -1)
+        if self.packed:
+            # Null slots of a query are node `null_idx` at its cut time.
+            packed = PackedNeighbors(batch_nid, self.null_idx)
+            pad_feat = self.tem_conv(np.full(batch_size, self.null_idx),
+                                     cut_time_l,
+                                     curr_layers=curr_layers - 1,
+                                     num_neighbors=num_neighbors)
+            if len(packed) > 0:
+                src_ngh_conv_feat = self.tem_conv(packed.pack(flat_ngh_nid),
+                                                  packed.pack(flat_ngh_t),
+                                                  curr_layers=curr_layers - 1,
+                                                  num_neighbors=num_neighbors)
+            else:
+                src_ngh_conv_feat = pad_feat[:0]
+            src_ngh_conv_feat = packed.unpack(src_ngh_conv_feat,
+                                              pad_feat.unsqueeze(1))
+        else:
+            src_ngh_conv_feat = self.tem_conv(flat_ngh_nid,
+                                              flat_ngh_t,
+                                              curr_layers=curr_layers - 1,
+                                              num_neighbors=num_neighbors)
+            src_ngh_conv_feat = src_ngh_conv_feat.view(batch_size, num_neighbors,
+                                                       -1)
 
         th_ngh_nid = torch.from_numpy(batch_nid).long().to(device)
         th_ngh_eid = torch.from_numpy(batch_eid).long().to(device)
@@ -1,5 +1,7 @@
 import grpc
 from rpc_client import *
+import os
+import sys
 import time
 
 import numpy as np
@@ -14,6 +16,9 @@ else:
 from typing import *
 from nebula_util import QueryGraphChannel
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.crng import CounterRNG, counter_randint
+
 
 def to_pd(table) -> pd.DataFrame:
     data = {}
@@ -58,9 +63,16 @@ def streaming_run_iter(token: str, args_lst: List[List[str]]):
         )
 
 
+def sample_index(key, query, high, size):
+    # 计数器随机数: 结果只由(key, query)决定, 与执行顺序和线程无关; key为None时使用全局随机数
+    if key is None:
+        return np.random.randint(0, high, size)
+    return counter_randint(key, query, high, size)
+
+
 class MyMultiLayerSampler:   
     def __init__(self, fanouts, num_nodes, client_address = "192.168.1.11:6066", \
-        cpp_file = "./sampler.wasm", graph_name='DBLPV13'):
+        cpp_file = "./sampler.wasm", graph_name='DBLPV13', seed=None):
         with open(cpp_file, "rb") as f: # 获取编译好的wasm字节码
             program = f.read()
 
@@ -80,8 +92,17 @@ class MyMultiLayerSampler:
         self.fanouts = fanouts
         self.num_layer = len(fanouts)
         self.num_nodes = num_nodes
+        self.rng = None if seed is None else CounterRNG(seed)
 
         self.clear_resp_metrics()
+
+    def set_batch(self, epoch, batch):
+        # 每个batch开始前调用, 每次采样调用取下一个stream
+        if self.rng is not None:
+            self.rng.set_batch(epoch, batch)
+
+    def next_key(self):
+        return None if self.rng is None else self.rng.next_key()
     
     def clear_resp_metrics(self):
         self.resp_start_times = []
@@ -100,6 +121,7 @@ class MyMultiLayerSampler:
         src_l, tgt_l, ts_l = [], [], []
         seed_nodes = seed_nodes.tolist() if isinstance(seed_nodes, torch.Tensor) else seed_nodes
         args = [ [str(item)] for item in seed_nodes]
+        key = self.next_key()
         cnt = 0
         print('Sampling {} nodes.'.format(len(seed_nodes)))
         for i, resp in enumerate(self.stub.StreamingRun(streaming_run_iter(self.token, args))):
@@ -125,7 +147,7 @@ class MyMultiLayerSampler:
             ts = np.array(df['time_stamp'])
 
             if fanout < len(srcs):
-                idx = np.random.randint(0, len(srcs), fanout)
+                idx = sample_index(key, cnt - 1, len(srcs), fanout)
                 srcs, tgts, ts = srcs[idx], tgts[idx], ts[idx]
 
             src_l.append(srcs)
@@ -164,7 +186,7 @@ class MyMultiLayerSampler:
 
 
 class NeublaMultiLayerSampler:
-    def __init__(self, fanouts, num_nodes, client_address="192.168.1.11:9669", graph_name='DBLPV13'):
+    def __init__(self, fanouts, num_nodes, client_address="192.168.1.11:9669", graph_name='DBLPV13', seed=None):
         self.channel = QueryGraphChannel([client_address])
         self.params = [
             {
@@ -180,9 +202,18 @@ class NeublaMultiLayerSampler:
         self.fanouts = fanouts
         self.num_layer = len(fanouts)
         self.num_nodes = num_nodes
+        self.rng = None if seed is None else CounterRNG(seed)
 
         self.clear_resp_metrics()
 
+    def set_batch(self, epoch, batch):
+        # 每个batch开始前调用, 每次采样调用取下一个stream
+        if self.rng is not None:
+            self.rng.set_batch(epoch, batch)
+
+    def next_key(self):
+        return None if self.rng is None else self.rng.next_key()
+
     def clear_resp_metrics(self):
         self.resp_start_times = []
         self.resp_end_times = []
@@ -261,6 +292,7 @@ class NeublaMultiLayerSampler:
         src_edge, tgt_edge, ts_edata = src_edge.tolist(), tgt_edge.tolist(), ts_edata.tolist()
         src_lst, tgt_lst, tsp_lst = [src_edge[0]], [tgt_edge[0]], [ts_edata[0]]
         source, target, timesp = [], [], []
+        key = self.next_key()
         
         for i in range(1, nn):
             src, tgt, tsp = src_edge[i], tgt_edge[i], ts_edata[i]
@@ -272,7 +304,7 @@ class NeublaMultiLayerSampler:
                 srcs, tgts, tsps = torch.tensor(src_lst), torch.tensor(tgt_lst), torch.tensor(tsp_lst)
                 src_lst, tgt_lst, tsp_lst = [src], [tgt], [tsp]
                 if len(srcs) > fanout:
-                    idx = np.random.randint(0, len(srcs), fanout)
+                    idx = sample_index(key, len(source), len(srcs), fanout)
                     srcs, tgts, tsps = srcs[idx], tgts[idx], tsps[idx]
                 source.append(srcs)
                 target.append(tgts)
@@ -41,7 +41,12 @@ def train_model(args, model, train_loader, features, opt):
         batch_bar = train_loader
         epoch_start = time.time()
         batch_start = time.time()
-        for step, (input_nodes, pos_graph, neg_graph, history_blocks) in enumerate(batch_bar):
+        batches = iter(batch_bar)
+        for step in range(len(batch_bar)):
+            # 采样在取batch时进行, 因此先设置该batch的随机数
+            if hasattr(train_loader.sampler, 'set_batch'):
+                train_loader.sampler.set_batch(epoch, step)
+            input_nodes, pos_graph, neg_graph, history_blocks = next(batches)
             history_inputs = [nfeat[nodes].to(args.device) for nfeat, nodes in zip(features, input_nodes)]
             # batch_inputs = nfeats[input_nodes].to(device)
             pos_graph = pos_graph.to(args.device)
@@ -138,6 +143,7 @@ def config2args(config, args):
     args.named_feats = 'all' #[ord(s.lower())-ord('a') for s in txt if ord('A') <= ord(s) <=ord('z')] if txt!='all' else 'all'
     args.dgl_sampler = config['dgl_sampler']
     args.old_sampler = config['old_sampler']
+    args.seed = config.get('seed')
     # args.root_dir = config['dataPath']
 
     args.timespan_end += 1 # [] -> [), range left close right close -> left close right open
@@ -0,0 +1,70 @@
+"""Throughput of temporal neighbor sampling with in-memory and memory-mapped
+CSR arrays on a synthetic graph.
+
+    python -m tgat.bench_sampling --n-nodes 1000000 --n-edges 20000000
+"""
+import argparse
+import logging
+import time
+
+import numpy as np
+
+from tgat.sampling import MmapNeighborFinder, NeighborFinder, build_csr, save_csr
+
+
+def synthetic_edges(n_nodes, n_edges, seed=0):
+    """Edges with power-law node popularity and increasing timestamps."""
+    rng = np.random.default_rng(seed)
+    weights = 1.0 / np.arange(1, n_nodes + 1)
+    weights /= weights.sum()
+    src_l = rng.choice(n_nodes, size=n_edges, p=weights)
+    dst_l = rng.choice(n_nodes, size=n_edges, p=weights)
+    ts_l = np.sort(rng.random(n_edges)).astype(np.float32)
+    e_idx_l = np.arange(1, n_edges + 1)
+    return src_l, dst_l, e_idx_l, ts_l
+
+
+def throughput(ngh_finder, src_l, ts_l, batch_size, num_neighbors, n_layers):
+    """Return the number of sampled queries per second."""
+    start = time.time()
+    for left in range(0, len(src_l), batch_size):
+        ngh_finder.find_k_hop(n_layers, src_l[left:left + batch_size],
+                              ts_l[left:left + batch_size], num_neighbors)
+    return len(src_l) / (time.time() - start)
+
+
+def bench_args():
+    parser = argparse.ArgumentParser("Neighbor sampling benchmark.")
+    parser.add_argument("--n-nodes", type=int, default=100000)
+    parser.add_argument("--n-edges", type=int, default=2000000)
+    parser.add_argument("--n-queries", type=int, default=200000)
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--num-neighbors", type=int, default=20)
+    parser.add_argument("--n-layers", type=int, default=2)
+    parser.add_argument("--path", type=str, default="./sample_cache/bench_csr")
+    parser.add_argument("--uniform", action="store_true", default=False)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = bench_args()
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger()
+    src_l, dst_l, e_idx_l, ts_l = synthetic_edges(args.n_nodes, args.n_edges)
+    csr = build_csr(src_l, dst_l, e_idx_l, ts_l, args.n_nodes)
+    queries = np.random.randint(0, len(src_l), args.n_queries)
+    q_src_l, q_ts_l = src_l[queries], ts_l[queries]
+
+    finders = {"memory": NeighborFinder(None, uniform=args.uniform, csr=csr)}
+    for order in [None, "degree"]:
+        path = "{}-{}".format(args.path, order or "id")
+        save_csr(path, csr, order=order)
+        finders["mmap-{}".format(order or "id")] = MmapNeighborFinder(path, uniform=args.uniform)
+    # warm up numba compilation
+    for ngh_finder in finders.values():
+        throughput(ngh_finder, q_src_l[:args.batch_size], q_ts_l[:args.batch_size],
+                   args.batch_size, args.num_neighbors, args.n_layers)
+    for name, ngh_finder in finders.items():
+        qps = throughput(ngh_finder, q_src_l, q_ts_l, args.batch_size,
+                         args.num_neighbors, args.n_layers)
+        logger.info("%s: %.0f queries/sec", name, qps)
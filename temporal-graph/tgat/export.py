@@ -0,0 +1,274 @@
+"""Export temporal attention models as TorchScript encoders for CPU inference.
+
+Inference is split into two steps: NumPy neighbor sampling by `sample_hops`,
+and a pure-tensor encoder from the sampled hops to node embeddings. The
+encoder of a trained TGAN, SamplingFusion or SubGnnNp is traced, frozen and
+saved by `export_encoder`. Another process loads it without the training
+scripts, and only needs a neighbor finder of the same kind.
+
+    export_encoder(tgan, ngh_finder, "tgan.pt", src_l[:200], ts_l[:200], 20)
+    # in the inference process
+    encoder = ExportedEncoder("tgan.pt", ngh_finder)
+    prob = encoder.score(src_l, dst_l, ts_l)
+
+With `quantize=True`, linear layers of the encoder are exported in int8 by
+dynamic quantization, and `compare_encoders` reports the AUC/AP deltas of the
+int8 encoder against the float32 one.
+"""
+import copy
+import json
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from utils.quantize import linear_bytes, quantization_report, quantize_linear
+from utils.time_encode import set_unique_time
+
+ATTN, SUBGRAPH = "attn", "subgraph"
+_META = "meta.json"
+
+
+def model_kind(model):
+    """SubGnnNp aggregates subgraphs, and the TGAN family neighbor blocks."""
+    return SUBGRAPH if hasattr(model, "graph_conv_list") else ATTN
+
+
+def sample_hops(ngh_finder, kind, src_idx_l, cut_time_l, num_layers,
+                num_neighbors):
+    """Sample the neighbors of each hop as the inputs of an encoder.
+
+    For the hop h, the M = B * N ** (h - 1) queries get arrays of shape
+    [M, N]: the neighbor nodes, edges and time deltas for the TGAN family,
+    and the subgraph nodes, n2n, e2n, edges and time deltas for SubGnnNp.
+    """
+    node_l, time_l = src_idx_l, cut_time_l
+    hops = []
+    for _ in range(num_layers):
+        if kind == SUBGRAPH:
+            ngh_t, (n2n, nid, e2n, eid) = ngh_finder.batch_interaction2subgraph(
+                node_l, time_l, num_neighbors=num_neighbors)
+            hops.extend([nid, n2n, e2n, eid, time_l[:, np.newaxis] - ngh_t])
+            node_l, time_l = nid.flatten(), np.repeat(time_l, nid.shape[1])
+            continue
+        out = ngh_finder.get_temporal_neighbor(node_l,
+                                               time_l,
+                                               num_neighbors=num_neighbors)
+        if isinstance(out[0], tuple):
+            # a block of each sampler, as BiSamplingNFinder for SamplingFusion
+            out = [np.hstack(arrs) for arrs in zip(*out)]
+        ngh_node, ngh_eidx, ngh_t = out
+        hops.extend([ngh_node, ngh_eidx, time_l[:, np.newaxis] - ngh_t])
+        node_l, time_l = ngh_node.flatten(), ngh_t.flatten()
+    return hops
+
+
+def hops_to_tensors(src_idx_l, hops):
+    tensors = [torch.from_numpy(np.asarray(src_idx_l)).long()]
+    for arr in hops:
+        th = torch.from_numpy(np.ascontiguousarray(arr))
+        tensors.append(th.float() if th.is_floating_point() else th.long())
+    return tuple(tensors)
+
+
+class AttnEncoder(nn.Module):
+    """Pure-tensor encoder of TGAN and SamplingFusion from sampled hops."""
+    def __init__(self, model):
+        super(AttnEncoder, self).__init__()
+        self.num_layers = model.num_layers
+        self.node_raw_embed = model.node_raw_embed
+        self.edge_raw_embed = model.edge_raw_embed
+        self.time_encoder = model.time_encoder
+        self.affinity_score = model.affinity_score
+        if hasattr(model, "fusion_layer_list"):
+            self.k_samplers = model.k_samplers
+            self.attn_model_list = model.attn_model_list
+            self.fusion_layer_list = model.fusion_layer_list
+        else:
+            self.k_samplers = 1
+            self.attn_model_list = nn.ModuleList([model.attn_model_list])
+            self.fusion_layer_list = None
+
+    def forward(self, src_idx, *hops):
+        # node features of each depth at layer 0
+        feats = [self.node_raw_embed(src_idx)]
+        for h in range(self.num_layers):
+            feats.append(self.node_raw_embed(hops[3 * h].flatten()))
+        for layer in range(1, self.num_layers + 1):
+            feats = [
+                self.aggregate(layer, feats[d], feats[d + 1],
+                               *hops[3 * d:3 * d + 3])
+                for d in range(self.num_layers - layer + 1)
+            ]
+        return feats[0]
+
+    def aggregate(self, layer, src_feat, ngh_feat, ngh_node, ngh_eidx,
+                  ngh_t_delta):
+        # query node always has the start time -> time span == 0
+        src_t_embed = self.time_encoder(src_feat.new_zeros(src_feat.shape[0], 1))
+        ngh_feat = ngh_feat.view(ngh_node.shape[0], ngh_node.shape[1], -1)
+        ngh_t_embed = self.time_encoder(ngh_t_delta)
+        ngh_edge_feat = self.edge_raw_embed(ngh_eidx)
+        mask = ngh_node == 0
+
+        width = ngh_node.shape[1] // self.k_samplers
+        local_feats = []
+        for k in range(self.k_samplers):
+            cols = slice(k * width, (k + 1) * width)
+            attn_m = self.attn_model_list[k][layer - 1]
+            local, _ = attn_m(src_feat, src_t_embed, ngh_feat[:, cols],
+                              ngh_t_embed[:, cols], ngh_edge_feat[:, cols],
+                              mask[:, cols])
+            local_feats.append(local)
+        if self.fusion_layer_list is None:
+            return local_feats[0]
+        return self.fusion_layer_list[layer - 1](local_feats)[0]
+
+    def score(self, src_embed, target_embed):
+        return self.affinity_score(src_embed,
+                                   target_embed).squeeze(dim=-1).sigmoid()
+
+
+class SubgraphEncoder(nn.Module):
+    """Pure-tensor encoder of SubGnnNp from sampled hops."""
+    def __init__(self, model):
+        super(SubgraphEncoder, self).__init__()
+        self.num_layers = model.num_layers
+        self.node_raw_embed = model.node_raw_embed
+        self.edge_raw_embed = model.edge_raw_embed
+        self.time_encoder = model.time_encoder
+        self.affinity_score = model.affinity_score
+        self.graph_conv_list = model.graph_conv_list
+        self.attn_model_list = model.attn_model_list
+        self.fusion_layer = model.fusion_layer
+
+    def forward(self, src_idx, *hops):
+        feats = [self.node_raw_embed(src_idx)]
+        for h in range(self.num_layers):
+            feats.append(self.node_raw_embed(hops[5 * h].flatten()))
+        for layer in range(1, self.num_layers + 1):
+            feats = [
+                self.aggregate(layer, feats[d], feats[d + 1],
+                               *hops[5 * d:5 * d + 5])
+                for d in range(self.num_layers - layer + 1)
+            ]
+        return feats[0]
+
+    def aggregate(self, layer, src_feat, ngh_feat, nid, n2n, e2n, eid,
+                  t_delta):
+        ngh_feat = ngh_feat.view(nid.shape[0], nid.shape[1], -1)
+        efeat = torch.cat([self.time_encoder(t_delta),
+                           self.edge_raw_embed(eid)],
+                          dim=-1)  # (B, K, Dt + De)
+        ngh_feats = self.graph_conv_list[layer - 1](n2n, ngh_feat, e2n, efeat)
+        mask = nid == 0
+        src_feats = [
+            attn_m(src_feat, feat, mask)[0]
+            for attn_m, feat in zip(self.attn_model_list[layer - 1], ngh_feats)
+        ]
+        return self.fusion_layer[layer - 1](src_feats)[0]
+
+    def score(self, src_embed, target_embed):
+        return self.affinity_score(src_embed,
+                                   target_embed).squeeze(dim=-1).sigmoid()
+
+
+def quantized_path(path):
+    """The path of the int8 encoder next to the float32 one at `path`."""
+    root, ext = os.path.splitext(path)
+    return root + ".int8" + (ext or ".pt")
+
+
+def export_encoder(model, ngh_finder, path, src_idx_l, cut_time_l,
+                   num_neighbors=20, quantize=False):
+    """Trace the encoder of `model` on CPU with example queries, freeze it
+    and save it to `path` with its sampling settings. With `quantize`, the
+    linear layers are int8 dynamic-quantized before tracing.
+    """
+    kind = model_kind(model)
+    encoder = (SubgraphEncoder if kind == SUBGRAPH else AttnEncoder)(model)
+    # copy the encoder only, as the model holds its neighbor finder
+    encoder = copy.deepcopy(encoder).cpu().eval()
+    # tracing keeps no data-dependent branches of unique time encodings
+    set_unique_time(encoder, unique=False)
+    if quantize:
+        encoder = quantize_linear(encoder, inplace=True)
+    hops = sample_hops(ngh_finder, kind, src_idx_l, cut_time_l,
+                       model.num_layers, num_neighbors)
+    inputs = hops_to_tensors(src_idx_l, hops)
+    with torch.no_grad():
+        embed = encoder(*inputs)
+        traced = torch.jit.trace_module(encoder, {
+            "forward": inputs,
+            "score": (embed, embed)
+        })
+    traced = torch.jit.freeze(traced, preserved_attrs=["score"])
+    meta = dict(kind=kind,
+                num_layers=model.num_layers,
+                num_neighbors=num_neighbors,
+                quantized=quantize,
+                linear_bytes=linear_bytes(encoder))
+    torch.jit.save(traced, path, _extra_files={_META: json.dumps(meta)})
+    return traced
+
+
+class ExportedEncoder(object):
+    """Run an exported encoder with a neighbor finder in another process."""
+    def __init__(self, path, ngh_finder, num_threads=None):
+        extra_files = {_META: ""}
+        self.encoder = torch.jit.load(path,
+                                      map_location="cpu",
+                                      _extra_files=extra_files)
+        self.meta = json.loads(extra_files[_META])
+        self.ngh_finder = ngh_finder
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+    def inputs(self, src_idx_l, cut_time_l):
+        hops = sample_hops(self.ngh_finder, self.meta["kind"], src_idx_l,
+                           cut_time_l, self.meta["num_layers"],
+                           self.meta["num_neighbors"])
+        return hops_to_tensors(src_idx_l, hops)
+
+    @torch.no_grad()
+    def embed(self, src_idx_l, cut_time_l):
+        return self.encoder(*self.inputs(src_idx_l, cut_time_l))
+
+    @torch.no_grad()
+    def score(self, src_idx_l, target_idx_l, cut_time_l):
+        batch_size = len(src_idx_l)
+        embed = self.embed(np.concatenate([src_idx_l, target_idx_l]),
+                           np.concatenate([cut_time_l, cut_time_l]))
+        return self.encoder.score(embed[:batch_size], embed[batch_size:])
+
+
+@torch.no_grad()
+def compare_encoders(fp32, int8, src_idx_l, target_idx_l, cut_time_l, label_l,
+                     batch_size=200):
+    """Score the edges by the float32 and int8 `ExportedEncoder`s on the same
+    sampled neighbors, and report the AUC/AP deltas, the encoder seconds and
+    the bytes of linear weights of both.
+    """
+    probs = {"fp32": [], "int8": []}
+    seconds = {"fp32": 0.0, "int8": 0.0}
+    for s_idx in range(0, len(src_idx_l), batch_size):
+        src_l_cut = src_idx_l[s_idx:s_idx + batch_size]
+        ts_l_cut = cut_time_l[s_idx:s_idx + batch_size]
+        inputs = fp32.inputs(
+            np.concatenate([src_l_cut, target_idx_l[s_idx:s_idx + batch_size]]),
+            np.concatenate([ts_l_cut, ts_l_cut]))
+        for name, exported in [("fp32", fp32), ("int8", int8)]:
+            start = time.time()
+            embed = exported.encoder(*inputs)
+            prob = exported.encoder.score(embed[:len(src_l_cut)],
+                                          embed[len(src_l_cut):])
+            seconds[name] += time.time() - start
+            probs[name].append(prob.numpy())
+    report = quantization_report(label_l, np.concatenate(probs["fp32"]),
+                                 np.concatenate(probs["int8"]))
+    for name, exported in [("fp32", fp32), ("int8", int8)]:
+        report[name + "_sec"] = seconds[name]
+        report[name + "_linear_mb"] = exported.meta.get("linear_bytes", 0) / 2**20
+    return report
@@ -6,6 +6,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+# fused attention kernels of torch >= 2.0
+HAS_SDPA = hasattr(F, "scaled_dot_product_attention")
+
 
 class MergeLayer(torch.nn.Module):
     def __init__(self, dim1, dim2, dim3, dim4):
@@ -82,7 +85,12 @@ class MultiHeadAttention(nn.Module):
 
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, q, k, v, mask=None):
+    def forward(self, q, k, v, mask=None, need_weights=True):
+        """With `need_weights=False` the fused attention kernel is used where
+        available, and the returned attention weights are None.
+        """
+        if not need_weights and HAS_SDPA:
+            return self.fused_forward(q, k, v, mask), None
 
         d_k, d_v, n_head = self.d_k, self.d_v, self.n_head
 
@@ -118,6 +126,40 @@ class MultiHeadAttention(nn.Module):
 
         return output, attn
 
+    def fused_forward(self, q, k, v, mask=None):
+        d_k, d_v, n_head = self.d_k, self.d_v, self.n_head
+
+        sz_b, len_q, _ = q.size()
+        sz_b, len_k, _ = k.size()
+        sz_b, len_v, _ = v.size()
+
+        residual = q
+
+        q = self.w_qs(q).view(sz_b, len_q, n_head, d_k).transpose(1, 2)  # b x n x lq x dk
+        k = self.w_ks(k).view(sz_b, len_k, n_head, d_k).transpose(1, 2)  # b x n x lk x dk
+        v = self.w_vs(v).view(sz_b, len_v, n_head, d_v).transpose(1, 2)  # b x n x lv x dv
+
+        attn_mask = None
+        if mask is not None:
+            mask = mask.unsqueeze(1)  # b x 1 x lq x lk, broadcast over heads
+            # Rows without any valid key attend uniformly as with masked_fill,
+            # instead of the NaN of an all-false boolean mask.
+            empty = mask.all(dim=-1, keepdim=True)
+            q = q.masked_fill(empty, 0)
+            attn_mask = ~(mask & ~empty)  # true values take part in attention
+
+        dropout_p = self.attention.dropout.p if self.training else 0.0
+        output = F.scaled_dot_product_attention(q, k, v,
+                                                attn_mask=attn_mask,
+                                                dropout_p=dropout_p)
+        output = output.transpose(1, 2).reshape(sz_b, len_q,
+                                                -1)  # b x lq x (n*dv)
+
+        output = self.dropout(self.fc(output))
+        output = self.layer_norm(output + residual)
+
+        return output
+
 
 class MapBasedMultiHeadAttention(nn.Module):
     ''' Multi-Head Attention module '''
@@ -165,25 +207,20 @@ class MapBasedMultiHeadAttention(nn.Module):
 
         q = q.permute(2, 0, 1, 3).contiguous().view(-1, len_q,
                                                     d_k)  # (n*b) x lq x dk
-        q = torch.unsqueeze(q, dim=2)  # [(n*b), lq, 1, dk]
-        q = q.expand(q.shape[0], q.shape[1], len_k,
-                     q.shape[3])  # [(n*b), lq, lk, dk]
-
         k = k.permute(2, 0, 1, 3).contiguous().view(-1, len_k,
                                                     d_k)  # (n*b) x lk x dk
-        k = torch.unsqueeze(k, dim=1)  # [(n*b), 1, lk, dk]
-        k = k.expand(k.shape[0], len_q, k.shape[2],
-                     k.shape[3])  # [(n*b), lq, lk, dk]
-
         v = v.permute(2, 0, 1, 3).contiguous().view(-1, len_v,
                                                     d_v)  # (n*b) x lv x dv
 
         mask = mask.repeat(n_head, 1, 1)  # (n*b) x lq x lk
 
         ## Map based Attention
-        #output, attn = self.attention(q, k, v, mask=mask)
-        q_k = torch.cat([q, k], dim=3)  # [(n*b), lq, lk, dk * 2]
-        attn = self.weight_map(q_k).squeeze(dim=3)  # [(n*b), lq, lk]
+        # weight_map([q; k]) == q . w_q + k . w_k, so q and k are scored
+        # separately and broadcast instead of concatenating all the pairs.
+        w_q, w_k = self.weight_map.weight.split(d_k, dim=1)  # [1, dk] each
+        q_score = F.linear(q, w_q)  # [(n*b), lq, 1]
+        k_score = F.linear(k, w_k)  # [(n*b), lk, 1]
+        attn = q_score + k_score.transpose(1, 2)  # [(n*b), lq, lk]
 
         if mask is not None:
             attn = attn.masked_fill(mask, -1e10)
@@ -206,6 +243,84 @@ class MapBasedMultiHeadAttention(nn.Module):
         return output, attn
 
 
+class PackedNeighbors(object):
+    """Real neighbors of a padded [B, N] neighbor block, where null slots hold
+    `null_idx`. Per-neighbor computations run on the packed real neighbors,
+    and `unpack` scatters their results back into the dense block.
+    """
+    def __init__(self, ngh_node_batch, null_idx=0):
+        self.shape = ngh_node_batch.shape
+        self.index = np.flatnonzero(ngh_node_batch.reshape(-1) != null_idx)
+
+    def __len__(self):
+        return len(self.index)
+
+    def pack(self, arr):
+        """[B, N] numpy array -> [M] values of the real neighbors."""
+        return arr.reshape(-1)[self.index]
+
+    def unpack(self, packed, pad):
+        """Scatter `packed` [M, D] into a dense [B, N, D] tensor, whose null
+        slots take `pad`, broadcastable to [B, N, D].
+        """
+        batch_size, num_neighbors = self.shape
+        dense = pad.expand(batch_size, num_neighbors, packed.shape[-1])
+        dense = dense.reshape(batch_size * num_neighbors, -1)
+        if len(self.index) > 0:
+            index = torch.from_numpy(self.index).to(packed.device)
+            dense = dense.index_copy(0, index, packed)
+        return dense.view(batch_size, num_neighbors, -1)
+
+
+def contrast_queries(src_idx_l, target_idx_l, background_idx_l, cut_time_l):
+    """The unique (node, time) queries of a batch, and the index of each
+    source, target and negative query into them.
+    """
+    batch_size = len(src_idx_l)
+    background_idx_l = np.asarray(background_idx_l)
+    n_neg = background_idx_l.size // batch_size
+    idx_l = np.concatenate([
+        src_idx_l, target_idx_l,
+        background_idx_l.reshape(batch_size, n_neg).T.reshape(-1)
+    ])
+    time_l = np.tile(cut_time_l, n_neg + 2)
+
+    # queries of a positive share its cut time, and repeated (node, time)
+    # pairs across sources, targets and negatives are embedded once
+    pairs = np.stack([idx_l, time_l], axis=1).astype(np.float64)
+    uniq, inverse = np.unique(pairs, axis=0, return_inverse=True)
+    return (uniq[:, 0].astype(idx_l.dtype), uniq[:, 1].astype(time_l.dtype),
+            inverse.reshape(-1))
+
+
+def contrast_score(embed, affinity_score, src_idx_l, target_idx_l,
+                   background_idx_l, cut_time_l):
+    """Positive and negative probabilities of a batch, embedding all its
+    queries by one `embed(idx_l, cut_time_l)` call.
+
+    background_idx_l is of shape [B], or [B, K] for K negatives of each
+    positive, and the negative probabilities have the same shape.
+    """
+    batch_size = len(src_idx_l)
+    background_idx_l = np.asarray(background_idx_l)
+    n_neg = background_idx_l.size // batch_size
+    uniq_idx_l, uniq_time_l, inverse = contrast_queries(
+        src_idx_l, target_idx_l, background_idx_l, cut_time_l)
+    uniq_embed = embed(uniq_idx_l, uniq_time_l)
+    inverse = torch.from_numpy(inverse).to(uniq_embed.device)
+    all_embed = uniq_embed[inverse]
+
+    src_embed = all_embed[:batch_size]
+    target_embed = all_embed[batch_size:2 * batch_size]
+    background_embed = all_embed[2 * batch_size:]
+    pos_score = affinity_score(src_embed, target_embed).squeeze(dim=-1)
+    neg_score = affinity_score(src_embed.repeat(n_neg, 1),
+                               background_embed).squeeze(dim=-1)
+    neg_score = neg_score.view(n_neg, batch_size).t().reshape(
+        background_idx_l.shape)
+    return pos_score.sigmoid(), neg_score.sigmoid()
+
+
 def expand_last_dim(x, num):
     view_size = list(x.size()) + [1]
     expand_size = list(x.size()) + [num]
@@ -222,6 +337,8 @@ class TimeEncode(torch.nn.Module):
         self.basis_freq = torch.nn.Parameter(
             (torch.from_numpy(1 / 10**np.linspace(0, 9, time_dim))).float())
         self.phase = torch.nn.Parameter(torch.zeros(time_dim).float())
+        # a UniqueHarmonic to encode unique times only, see `set_unique_time`
+        self.unique_time = None
 
         #self.dense = torch.nn.Linear(time_dim, expand_dim, bias=False)
 
@@ -229,6 +346,8 @@ class TimeEncode(torch.nn.Module):
 
     def forward(self, ts):
         # ts: [N, L]
+        if self.unique_time is not None:
+            return self.unique_time(ts, self.basis_freq, self.phase)
         batch_size = ts.size(0)
         seq_len = ts.size(1)
 
@@ -325,7 +444,8 @@ class AttnModel(torch.nn.Module):
                  time_dim,
                  attn_mode='prod',
                  n_head=2,
-                 drop_out=0.1):
+                 drop_out=0.1,
+                 fused=True):
         """
         args:
           feat_dim: dim for the node features
@@ -334,6 +454,8 @@ class AttnModel(torch.nn.Module):
           attn_mode: choose from 'prod' and 'map'
           n_head: number of heads in attention
           drop_out: probability of dropping a neural.
+          fused: use the fused attention kernel for 'prod', without returning
+            attention weights.
         """
         super(AttnModel, self).__init__()
 
@@ -352,6 +474,7 @@ class AttnModel(torch.nn.Module):
         assert (self.model_dim % n_head == 0)
         self.logger = logging.getLogger(__name__)
         self.attn_mode = attn_mode
+        self.fused = fused and attn_mode == 'prod' and HAS_SDPA
 
         if attn_mode == 'prod':
             self.multi_head_target = MultiHeadAttention(
@@ -360,7 +483,8 @@ class AttnModel(torch.nn.Module):
                 d_k=self.model_dim // n_head,
                 d_v=self.model_dim // n_head,
                 dropout=drop_out)
-            self.logger.info('Using scaled prod attention')
+            self.logger.info('Using %s scaled prod attention',
+                             'fused' if self.fused else 'unfused')
 
         elif attn_mode == 'map':
             self.multi_head_target = MapBasedMultiHeadAttention(
@@ -387,7 +511,7 @@ class AttnModel(torch.nn.Module):
           output, weight
 
           output: float Tensor of shape [B, D]
-          weight: float Tensor of shape [B, N]
+          weight: float Tensor of shape [B, N], None with the fused attention
         """
 
         src_ext = torch.unsqueeze(src, dim=1)  # src [B, 1, D]
@@ -402,11 +526,16 @@ class AttnModel(torch.nn.Module):
         mask = mask.permute([0, 2, 1])  #mask [B, 1, N]
 
         # # target-attention
-        output, attn = self.multi_head_target(
-            q=q, k=k, v=k,
-            mask=mask)  # output: [B, 1, D + Dt], attn: [B, 1, N]
+        if self.fused:
+            output, attn = self.multi_head_target(
+                q=q, k=k, v=k, mask=mask,
+                need_weights=False)  # output: [B, 1, D + Dt], attn: None
+        else:
+            output, attn = self.multi_head_target(
+                q=q, k=k, v=k,
+                mask=mask)  # output: [B, 1, D + Dt], attn: [B, 1, N]
+            attn = attn.squeeze(1)
         output = output.squeeze(1)  # When B is 1, an error occurs here.
-        attn = attn.squeeze(1)
 
         output = self.merger(output, src)
         return output, attn
@@ -428,12 +557,15 @@ class TGAN(torch.nn.Module):
                  null_idx=0,
                  num_heads=1,
                  drop_out=0.1,
-                 seq_len=None):
+                 seq_len=None,
+                 packed=False):
         super(TGAN, self).__init__()
 
         self.num_layers = num_layers
         self.ngh_finder = ngh_finder
         self.null_idx = null_idx
+        # compute neighbor features only on real neighbors, see `neighbor_embed`
+        self.packed = packed
         self.logger = logging.getLogger(__name__)
         self.n_feat_th = torch.nn.Parameter(
             torch.from_numpy(n_feat.astype(np.float32)))
@@ -518,25 +650,17 @@ class TGAN(torch.nn.Module):
                  background_idx_l,
                  cut_time_l,
                  num_neighbors=20):
-        src_embed = self.tem_conv(src_idx_l, cut_time_l, self.num_layers,
-                                  num_neighbors)
-        target_embed = self.tem_conv(target_idx_l, cut_time_l, self.num_layers,
-                                     num_neighbors)
-        background_embed = self.tem_conv(background_idx_l, cut_time_l,
-                                         self.num_layers, num_neighbors)
-        pos_score = self.affinity_score(src_embed,
-                                        target_embed).squeeze(dim=-1)
-        neg_score = self.affinity_score(src_embed,
-                                        background_embed).squeeze(dim=-1)
-        return pos_score.sigmoid(), neg_score.sigmoid()
+        return contrast_score(
+            lambda idx_l, t_l: self.tem_conv(idx_l, t_l, self.num_layers,
+                                             num_neighbors),
+            self.affinity_score, src_idx_l, target_idx_l, background_idx_l,
+            cut_time_l)
 
     def tem_conv(self, src_idx_l, cut_time_l, curr_layers, num_neighbors=20):
         assert (curr_layers >= 0)
 
         device = self.n_feat_th.device
 
-        batch_size = len(src_idx_l)
-
         src_node_batch_th = torch.from_numpy(src_idx_l).long().to(device)
         cut_time_l_th = torch.from_numpy(cut_time_l).float().to(device)
 
@@ -558,28 +682,15 @@ class TGAN(torch.nn.Module):
 
             src_ngh_node_batch_th = torch.from_numpy(
                 src_ngh_node_batch).long().to(device)
-            src_ngh_eidx_batch = torch.from_numpy(
-                src_ngh_eidx_batch).long().to(device)
-
-            src_ngh_t_batch_delta = cut_time_l[:, np.newaxis] - src_ngh_t_batch
-            src_ngh_t_batch_th = torch.from_numpy(
-                src_ngh_t_batch_delta).float().to(device)
-
-            # get previous layer's node features
-            src_ngh_node_batch_flat = src_ngh_node_batch.flatten(
-            )  #reshape(batch_size, -1)
-            src_ngh_t_batch_flat = src_ngh_t_batch.flatten(
-            )  #reshape(batch_size, -1)
-            src_ngh_node_conv_feat = self.tem_conv(src_ngh_node_batch_flat,
-                                                   src_ngh_t_batch_flat,
-                                                   curr_layers=curr_layers - 1,
-                                                   num_neighbors=num_neighbors)
-            src_ngh_feat = src_ngh_node_conv_feat.view(batch_size,
-                                                       num_neighbors, -1)
-
-            # get edge time features and node features
-            src_ngh_t_embed = self.time_encoder(src_ngh_t_batch_th)
-            src_ngn_edge_feat = self.edge_raw_embed(src_ngh_eidx_batch)
+
+            # get previous layer's node features, edge time features and node features
+            src_ngh_feat, src_ngh_t_embed, src_ngn_edge_feat = self.neighbor_embed(
+                lambda idx_l, t_l: self.tem_conv(idx_l,
+                                                 t_l,
+                                                 curr_layers=curr_layers - 1,
+                                                 num_neighbors=num_neighbors),
+                cut_time_l, src_ngh_node_batch, src_ngh_eidx_batch,
+                src_ngh_t_batch)
 
             # attention aggregation
             mask = src_ngh_node_batch_th == 0
@@ -589,3 +700,51 @@ class TGAN(torch.nn.Module):
                                    src_ngh_feat, src_ngh_t_embed,
                                    src_ngn_edge_feat, mask)
             return local
+
+    def neighbor_embed(self, conv, cut_time_l, ngh_node_batch, ngh_eidx_batch,
+                       ngh_t_batch):
+        """Previous layer's node features, time encodings and edge features of
+        a padded [B, N] neighbor block, each of shape [B, N, *].
+
+        `conv(idx_l, t_l)` returns the previous layer's features of nodes at
+        times. With `self.packed`, they are computed only for real neighbors.
+        Null slots, i.e. node `null_idx` of edge 0 at time 0, are filled with
+        their features computed once, so the outputs equal the dense block.
+        """
+        device = self.n_feat_th.device
+        batch_size, num_neighbors = ngh_node_batch.shape
+
+        ngh_t_delta = cut_time_l[:, np.newaxis] - ngh_t_batch
+        if not self.packed:
+            ngh_feat = conv(ngh_node_batch.flatten(), ngh_t_batch.flatten())
+            ngh_feat = ngh_feat.view(batch_size, num_neighbors, -1)
+            ngh_t_th = torch.from_numpy(ngh_t_delta).float().to(device)
+            ngh_eidx_th = torch.from_numpy(ngh_eidx_batch).long().to(device)
+            return ngh_feat, self.time_encoder(ngh_t_th), self.edge_raw_embed(
+                ngh_eidx_th)
+
+        packed = PackedNeighbors(ngh_node_batch, self.null_idx)
+        pad_feat = conv(np.array([self.null_idx]), np.zeros(1, ngh_t_batch.dtype))
+        if len(packed) > 0:
+            ngh_feat = conv(packed.pack(ngh_node_batch), packed.pack(ngh_t_batch))
+        else:
+            ngh_feat = pad_feat[:0]
+        ngh_feat = packed.unpack(ngh_feat, pad_feat.view(1, 1, -1))
+
+        if isinstance(self.time_encoder, PosEncode):
+            # positions depend on the whole row
+            ngh_t_embed = self.time_encoder(
+                torch.from_numpy(ngh_t_delta).float().to(device))
+        else:
+            # time encodings are elementwise, and null slots span `cut_time`
+            t_th = torch.from_numpy(packed.pack(ngh_t_delta)).float().to(device)
+            pad_t_th = torch.from_numpy(cut_time_l).float().to(device)
+            ngh_t_embed = packed.unpack(
+                self.time_encoder(t_th.view(1, -1)).squeeze(0),
+                self.time_encoder(pad_t_th.view(-1, 1)))
+
+        eidx_th = torch.from_numpy(packed.pack(ngh_eidx_batch)).long().to(device)
+        pad_eidx_th = torch.zeros(1, dtype=torch.long, device=device)
+        ngh_edge_feat = packed.unpack(self.edge_raw_embed(eidx_th),
+                                      self.edge_raw_embed(pad_eidx_th).view(1, 1, -1))
+        return ngh_feat, ngh_t_embed, ngh_edge_feat
@@ -0,0 +1,181 @@
+"""Prefetch the neighbor samples of the next batch while the current one trains.
+
+The neighbor queries of a forward pass depend only on the sampled neighbors,
+not on the model outputs. A background thread thus issues all the queries of
+batch k + 1 by walking the recursion of `tem_conv` without computing
+features, while batch k runs on the model. Then the model's neighbor finder
+replays the prefetched samples instead of sampling in the forward pass.
+
+    prefetcher = SamplePrefetcher(tgan, NUM_NEIGHBORS)
+    for src_l_cut, dst_l_cut, dst_l_fake, ts_l_cut in prefetcher.iterate(batches()):
+        pos_prob, neg_prob = tgan.contrast(src_l_cut, dst_l_cut, dst_l_fake,
+                                           ts_l_cut, NUM_NEIGHBORS)
+
+Queries which were not prefetched, e.g. by other models than the TGAN family
+and SubGnnNp, are sampled by the wrapped finder as before.
+
+With a counter-based `ngh_finder.rng`, each batch is sampled by a shallow copy
+of the finder with a private copy of the RNG, taken right after the batch is
+generated. The background thread thus draws the same keys as sampling in the
+forward pass would, whatever the main thread draws meanwhile.
+"""
+import copy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from tgat.export import SUBGRAPH, model_kind
+from tgat.module import PackedNeighbors, contrast_queries
+
+NEIGHBOR, SUBGRAPH_NEIGHBOR = "get_temporal_neighbor", "batch_interaction2subgraph"
+
+
+def _key(method, src_idx_l, cut_time_l, num_neighbors):
+    src_idx_l, cut_time_l = np.asarray(src_idx_l), np.asarray(cut_time_l)
+    return (method, num_neighbors, src_idx_l.dtype.str, src_idx_l.tobytes(),
+            cut_time_l.dtype.str, cut_time_l.tobytes())
+
+
+def _batch_finder(ngh_finder):
+    """`ngh_finder` drawing from a private copy of its counter-based RNG at
+    the current batch, or `ngh_finder` itself without one.
+    """
+    if getattr(ngh_finder, "rng", None) is None:
+        return ngh_finder
+    finder = copy.copy(ngh_finder)
+    finder.rng = copy.copy(ngh_finder.rng)
+    return finder
+
+
+class PrefetchedFinder(object):
+    """A neighbor finder replaying prefetched samples, keyed by the query
+    arrays. Each prefetched sample is replayed once, and other queries are
+    sampled by `ngh_finder`.
+    """
+    def __init__(self, ngh_finder):
+        self.ngh_finder = ngh_finder
+        self.samples = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        return getattr(self.ngh_finder, name)
+
+    def replay(self, method, src_idx_l, cut_time_l, num_neighbors):
+        queue = self.samples.get(_key(method, src_idx_l, cut_time_l,
+                                      num_neighbors))
+        if queue:
+            self.hits += 1
+            return queue.popleft()
+        self.misses += 1
+        return getattr(self.ngh_finder, method)(src_idx_l,
+                                                cut_time_l,
+                                                num_neighbors=num_neighbors)
+
+    def get_temporal_neighbor(self, src_idx_l, cut_time_l, num_neighbors=20):
+        return self.replay(NEIGHBOR, src_idx_l, cut_time_l, num_neighbors)
+
+    def batch_interaction2subgraph(self, src_idx_l, cut_time_l,
+                                   num_neighbors=20):
+        return self.replay(SUBGRAPH_NEIGHBOR, src_idx_l, cut_time_l,
+                           num_neighbors)
+
+
+class SamplePrefetcher(object):
+    """Params
+    ------
+    model: a TGAN, SamplingFusion or SubGnnNp trained by `model.contrast`.
+    num_neighbors: the number of neighbors of each query.
+    """
+    def __init__(self, model, num_neighbors):
+        self.model = model
+        self.num_neighbors = num_neighbors
+        self.kind = model_kind(model)
+        self.method = SUBGRAPH_NEIGHBOR if self.kind == SUBGRAPH else NEIGHBOR
+        self.packed = getattr(model, "packed", False)
+        self.null_idx = getattr(model, "null_idx", 0)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def sample(self, ngh_finder, src_idx_l, target_idx_l, background_idx_l,
+               cut_time_l):
+        """Issue the queries of `model.contrast` on a batch by `ngh_finder`,
+        and return the samples keyed by their queries.
+        """
+        idx_l, time_l, _ = contrast_queries(src_idx_l, target_idx_l,
+                                            background_idx_l, cut_time_l)
+        samples = {}
+        self._walk(ngh_finder, samples, idx_l, time_l, self.model.num_layers)
+        return samples
+
+    def _walk(self, ngh_finder, samples, src_idx_l, cut_time_l, curr_layers):
+        # the same order of queries as `tem_conv`
+        if curr_layers == 0:
+            return
+        self._walk(ngh_finder, samples, src_idx_l, cut_time_l,
+                   curr_layers - 1)
+        out = getattr(ngh_finder, self.method)(src_idx_l,
+                                               cut_time_l,
+                                               num_neighbors=self.num_neighbors)
+        key = _key(self.method, src_idx_l, cut_time_l, self.num_neighbors)
+        samples.setdefault(key, deque()).append(out)
+        for idx_l, time_l in self._next_queries(src_idx_l, cut_time_l, out):
+            self._walk(ngh_finder, samples, idx_l, time_l, curr_layers - 1)
+
+    def _next_queries(self, src_idx_l, cut_time_l, out):
+        """The (node, time) queries of the previous layer on neighbors."""
+        if self.kind == SUBGRAPH:
+            _, (_, ngh_node, _, _) = out
+            ngh_t = np.repeat(cut_time_l[:, np.newaxis],
+                              self.num_neighbors,
+                              axis=1)
+            # null slots of a query are node `null_idx` at its cut time
+            pad = (np.full(len(src_idx_l), self.null_idx), cut_time_l)
+            blocks = [(ngh_node, ngh_t, pad)]
+        else:
+            # a block of each sampler, as BiSamplingNFinder for SamplingFusion
+            blocks = out if isinstance(out[0], tuple) else [out]
+            blocks = [(ngh_node, ngh_t, (np.array([self.null_idx]),
+                                         np.zeros(1, ngh_t.dtype)))
+                      for ngh_node, _, ngh_t in blocks]
+        for ngh_node, ngh_t, pad in blocks:
+            if not self.packed:
+                yield ngh_node.flatten(), ngh_t.flatten()
+                continue
+            packed = PackedNeighbors(ngh_node, self.null_idx)
+            yield pad
+            if len(packed) > 0:
+                yield packed.pack(ngh_node), packed.pack(ngh_t)
+
+    def iterate(self, batches):
+        """Yield the (src, target, background, cut_time) batches of
+        `batches`, sampling the next batch in the background while the model
+        replays the samples of the current one.
+        """
+        ngh_finder = self.model.ngh_finder
+        finder = PrefetchedFinder(ngh_finder)
+        batches = iter(batches)
+        batch = next(batches, None)
+        if batch is None:
+            return
+        batch_finder = _batch_finder(ngh_finder)
+        future = self.executor.submit(self.sample, batch_finder, *batch)
+        self.model.ngh_finder = finder
+        try:
+            while batch is not None:
+                samples = future.result()
+                # queries which were not prefetched continue the RNG of
+                # their own batch
+                finder.ngh_finder = batch_finder
+                finder.samples = samples
+                # batches are generated in this thread, e.g. by drawing
+                # negatives, before their neighbors are sampled
+                next_batch = next(batches, None)
+                if next_batch is not None:
+                    batch_finder = _batch_finder(ngh_finder)
+                    future = self.executor.submit(self.sample, batch_finder,
+                                                  *next_batch)
+                yield batch
+                batch = next_batch
+        finally:
+            self.model.ngh_finder = ngh_finder
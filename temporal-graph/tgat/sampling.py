@@ -1,6 +1,11 @@
+import os
+
 import numpy as np
 from numba import jit
 
+from utils.crng import counter_randint
+from utils.shared_graph import CSR_KEYS
+
 
 @jit
 def find_before_nb(src_idx, cut_time, node_idx_l, node_ts_l, edge_idx_l,
@@ -24,15 +29,17 @@ def find_before_nb(src_idx, cut_time, node_idx_l, node_ts_l, edge_idx_l,
     return neighbors_idx[:right], neighbors_e_idx[:right], neighbors_ts[:right]
 
 
-@jit
+@jit(nogil=True)
 def get_temporal_neighbor_nb(src_idx_l, cut_time_l, node_idx_l, node_ts_l,
-                             edge_idx_l, off_set_l, num_neighbors, uniform):
+                             edge_idx_l, off_set_l, num_neighbors, uniform,
+                             query_l, counter=False, key=np.uint64(0)):
     """
     Params
     ------
     src_idx_l: List[int]
     cut_time_l: List[float],
     num_neighbors: int
+    query_l: List[int], query indices keying counter-based random numbers
     """
     out_ngh_node_batch = np.zeros(
         (len(src_idx_l), num_neighbors)).astype(np.int32)
@@ -54,7 +61,10 @@ def get_temporal_neighbor_nb(src_idx_l, cut_time_l, node_idx_l, node_ts_l,
             continue
 
         if uniform:
-            sampled_idx = np.random.randint(0, len(ngh_idx), num_neighbors)
+            if counter:
+                sampled_idx = counter_randint(key, query_l[i], len(ngh_idx), num_neighbors)
+            else:
+                sampled_idx = np.random.randint(0, len(ngh_idx), num_neighbors)
             sampled_idx = np.sort(sampled_idx)
 
             out_ngh_node_batch[i, :] = ngh_idx[sampled_idx]
@@ -77,17 +87,19 @@ def get_temporal_neighbor_nb(src_idx_l, cut_time_l, node_idx_l, node_ts_l,
 
 
 class NeighborFinder:
-    def __init__(self, adj_list, uniform=False):
+    def __init__(self, adj_list, uniform=False, csr=None):
         """
         Params
         ------
         node_idx_l: List[int]
         node_ts_l: List[int]
         off_set_l: List[int], such that node_idx_l[off_set_l[i]:off_set_l[i + 1]] = adjacent_list[i]
+        csr: Tuple[np.ndarray], (node_idx_l, node_ts_l, edge_idx_l, off_set_l) used instead of adj_list, e.g. `SharedGraphStore.csr`
         """
 
-        node_idx_l, node_ts_l, edge_idx_l, off_set_l = self.init_off_set(
-            adj_list)
+        if csr is None:
+            csr = self.init_off_set(adj_list)
+        node_idx_l, node_ts_l, edge_idx_l, off_set_l = csr
         self.node_idx_l = node_idx_l
         self.node_ts_l = node_ts_l
         self.edge_idx_l = edge_idx_l
@@ -95,6 +107,8 @@ class NeighborFinder:
         self.off_set_l = off_set_l
 
         self.uniform = uniform
+        # `utils.crng.CounterRNG` replacing the global `np.random` state if set
+        self.rng = None
 
     def init_off_set(self, adj_list):
         """
@@ -152,8 +166,15 @@ class NeighborFinder:
                                         self.node_ts_l,
                                         self.edge_idx_l,
                                         self.off_set_l,
-                                        num_neighbors=num_neighbors,
-                                        uniform=self.uniform)
+                                        num_neighbors,
+                                        self.uniform,
+                                        np.arange(len(src_idx_l)),
+                                        *self._counter())
+
+    def _counter(self):
+        if self.rng is None:
+            return False, np.uint64(0)
+        return True, self.rng.next_key()
 
     def find_k_hop(self, k, src_idx_l, cut_time_l, num_neighbors=20):
         """Sampling the k-hop sub graph
@@ -183,3 +204,99 @@ class NeighborFinder:
             t_records.append(out_ngh_t_batch)
         return node_records, eidx_records, t_records
 
+
+
+def build_csr(src_l, dst_l, e_idx_l, ts_l, n_nodes):
+    """Build the CSR arrays of the bidirected temporal graph, the same as
+    `NeighborFinder.init_off_set` on the adjacency list, without Python lists.
+    """
+    node = np.concatenate([src_l, dst_l])
+    ngh = np.concatenate([dst_l, src_l])
+    eidx = np.concatenate([e_idx_l, e_idx_l])
+    ts = np.concatenate([ts_l, ts_l])
+    order = np.lexsort((eidx, node))
+    off_set_l = np.zeros(n_nodes + 1, dtype=np.int64)
+    off_set_l[1:] = np.cumsum(np.bincount(node, minlength=n_nodes))
+    return ngh[order], ts[order], eidx[order], off_set_l
+
+
+def save_csr(path, csr, order=None, chunk_nodes=1 << 16):
+    """Write CSR arrays into `path` as .npy files for `MmapNeighborFinder`.
+
+    Params
+    ------
+    csr: Tuple[np.ndarray], (node_idx_l, node_ts_l, edge_idx_l, off_set_l), which may be memory-mapped
+    order: None, "degree" or np.ndarray, the on-disk order of nodes. "degree" places nodes with more neighbors first, so that hot rows share pages.
+    chunk_nodes: int, the number of rows copied at a time
+    """
+    node_idx_l, node_ts_l, edge_idx_l, off_set_l = csr
+    n_nodes = len(off_set_l) - 1
+    degrees = np.diff(off_set_l)
+    if order is None:
+        order = np.arange(n_nodes)
+    elif isinstance(order, str) and order == "degree":
+        order = np.argsort(-degrees, kind="stable")
+    rank = np.empty(n_nodes, dtype=np.int64)
+    rank[order] = np.arange(n_nodes)
+    new_off_set_l = np.zeros(n_nodes + 1, dtype=np.int64)
+    new_off_set_l[1:] = np.cumsum(degrees[order])
+
+    os.makedirs(path, exist_ok=True)
+    for key, arr in zip(CSR_KEYS[:3], [node_idx_l, node_ts_l, edge_idx_l]):
+        out = np.lib.format.open_memmap(os.path.join(path, f"{key}.npy"), mode="w+",
+                                        dtype=arr.dtype, shape=arr.shape)
+        for left in range(0, n_nodes, chunk_nodes):
+            right = min(left + chunk_nodes, n_nodes)
+            rows = order[left:right]
+            begin, end = new_off_set_l[left], new_off_set_l[right]
+            # position of each copied entry in the original arrays
+            idx = np.arange(begin, end) - np.repeat(
+                new_off_set_l[left:right] - off_set_l[rows], degrees[rows])
+            out[begin:end] = arr[idx]
+        out.flush()
+        del out
+    np.save(os.path.join(path, "off_set_l.npy"), new_off_set_l)
+    np.save(os.path.join(path, "rank.npy"), rank)
+
+
+class MmapNeighborFinder(NeighborFinder):
+    """A NeighborFinder running against CSR files written by `save_csr`, which
+    are memory-mapped instead of loaded, for graphs that do not fit in memory.
+    Only the offsets and the node order are kept in memory. Queries are sorted
+    by their on-disk rows, so neighbor slices of a batch are read sequentially.
+    With `uniform=True` and the global `np.random` state, the sorted queries
+    draw random numbers in a different order, so samples differ from the
+    in-memory finder with the same seed, unless a `CounterRNG` is set.
+    """
+    def __init__(self, path, uniform=False, sort_queries=True):
+        csr = tuple(np.load(os.path.join(path, f"{key}.npy"),
+                            mmap_mode=None if key == "off_set_l" else "r")
+                    for key in CSR_KEYS)
+        super(MmapNeighborFinder, self).__init__(None, uniform=uniform, csr=csr)
+        self.rank = np.load(os.path.join(path, "rank.npy"))
+        self.sort_queries = sort_queries
+
+    def find_before(self, src_idx, cut_time):
+        return super(MmapNeighborFinder, self).find_before(self.rank[src_idx], cut_time)
+
+    def get_temporal_neighbor(self, src_idx_l, cut_time_l, num_neighbors=20):
+        assert (len(src_idx_l) == len(cut_time_l))
+
+        rows = self.rank[np.asarray(src_idx_l)]
+        cut_time_l = np.asarray(cut_time_l)
+        if not self.sort_queries:
+            return get_temporal_neighbor_nb(rows, cut_time_l, self.node_idx_l,
+                                            self.node_ts_l, self.edge_idx_l,
+                                            self.off_set_l, num_neighbors,
+                                            self.uniform, np.arange(len(rows)),
+                                            *self._counter())
+        # Counter-based random numbers are keyed by the original query order.
+        order = np.argsort(rows, kind="stable")
+        out = get_temporal_neighbor_nb(rows[order], cut_time_l[order],
+                                       self.node_idx_l, self.node_ts_l,
+                                       self.edge_idx_l, self.off_set_l,
+                                       num_neighbors, self.uniform, order,
+                                       *self._counter())
+        inv = np.empty_like(order)
+        inv[order] = np.arange(len(order))
+        return tuple(batch[inv] for batch in out)
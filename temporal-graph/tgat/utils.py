@@ -29,11 +29,17 @@ class EarlyStopMonitor(object):
         return self.num_round >= self.max_round
 
 class RandEdgeSampler(object):
-    def __init__(self, src_list, dst_list):
+    def __init__(self, src_list, dst_list, rng=None):
         self.src_list = np.unique(src_list)
         self.dst_list = np.unique(dst_list)
+        # `utils.crng.CounterRNG` replacing the global `np.random` state if set
+        self.rng = rng
 
     def sample(self, size):
-        src_index = np.random.randint(0, len(self.src_list), size)
-        dst_index = np.random.randint(0, len(self.dst_list), size)
+        if self.rng is not None:
+            src_index = self.rng.randint(len(self.src_list), size)
+            dst_index = self.rng.randint(len(self.dst_list), size)
+        else:
+            src_index = np.random.randint(0, len(self.src_list), size)
+            dst_index = np.random.randint(0, len(self.dst_list), size)
         return self.src_list[src_index], self.dst_list[dst_index]
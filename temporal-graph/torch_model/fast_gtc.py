@@ -19,10 +19,13 @@ from sklearn.metrics import accuracy_score, f1_score, roc_auc_score
 
 from data_loader.data_util import load_data, load_split_edges, load_label_edges
 from utils.util import get_free_gpu, timeit, EarlyStopMonitor
-from torch_model.util_dgl import construct_dglgraph
+from torch_model.util_dgl import construct_dglgraph, gather_efeat
 from torch_model.layers import TemporalLinkLayer, FastTSAGEConv, TimeEncode, TimeEncodingLayer
 from torch_model.dataset import TemporalDataset
 from utils.util import set_logger, set_random_seed, write_result
+from utils.metrics import BatchMetrics
+from utils.quantize import format_report, linear_bytes, quantization_report, quantize_linear, timed
+from utils.time_encode import set_unique_time
 # Change the order so that it is the one used by "nvidia-smi" and not the
 # one used by all other programs ("FASTEST_FIRST")
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
@@ -52,10 +55,13 @@ class TGraphSAGE(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.activation = activation
 
-    def forward(self, g):
+    def forward(self, g, efeat=None):
         """In the 1st layer, we use the node features/embeddings as the features
         for each edge. In the next layers, we store the edge features in the edges,
         named `src_feat{current_layer}` and `dst_feat{current_layer}`.
+
+        `efeat` is the shared edge features of graphs constructed with
+        `share_efeat=True`.
         """
         g = g.local_var()
         tfeat = g.edata["timestamp"]
@@ -63,7 +69,8 @@ class TGraphSAGE(nn.Module):
         def combine_feats(edges):
             return {
                 "dst_feat0":
-                torch.cat([edges.dst["nfeat"], edges.data["efeat"]], dim=1)
+                torch.cat([edges.dst["nfeat"],
+                           gather_efeat(edges.data, efeat)], dim=1)
             }
 
         g.apply_edges(func=combine_feats)
@@ -87,10 +94,10 @@ class TGraphSAGE(nn.Module):
 
 
 class FastTemporalLinkTrainer(nn.Module):
-    def __init__(self, g, in_feats, edge_feats, n_hidden, args):
+    def __init__(self, g, in_feats, edge_feats, n_hidden, args, efeat=None):
         super(FastTemporalLinkTrainer, self).__init__()
         self.nfeat = g.ndata["nfeat"]
-        self.efeat = g.edata["efeat"]
+        self.efeat = g.edata["efeat"] if efeat is None else efeat
         self.logger = logging.getLogger()
         self.logger.info("nfeat: %r, efeat: %r", self.nfeat.requires_grad,
                          self.efeat.requires_grad)
@@ -119,7 +126,7 @@ class FastTemporalLinkTrainer(nn.Module):
         t = t.float()
         neg = neg.flatten()
 
-        src_feat, dst_feat = self.conv(g)
+        src_feat, dst_feat = self.conv(g, self.efeat)
         if self.norm is not None:
             src_feat, dst_feat = self.norm(src_feat), self.norm(dst_feat)
         g.edata["src_feat"] = src_feat
@@ -134,26 +141,36 @@ class FastTemporalLinkTrainer(nn.Module):
 
         return loss, pos_logits, neg_logits
 
-    def infer(self, g, batch_samples):
+    def infer(self, g, batch_samples, chunk_size=None):
+        """Score `batch_samples`. With `chunk_size`, the samples are moved to
+        the device and scored chunk by chunk into a preallocated logits
+        tensor, bounding the activations of the link layer. The convolution
+        still computes the embeddings of all the edges at once, which
+        `chunk_size` does not bound.
+        """
         self.eval()
         g = g.local_var()
         device = g.ndata["nfeat"].device
-        batch_samples = [s.to(device) for s in batch_samples]
-        src_feat, dst_feat = self.conv(g)
+        src_feat, dst_feat = self.conv(g, self.efeat)
         if self.norm is not None:
             src_feat, dst_feat = self.norm(src_feat), self.norm(dst_feat)
         g.edata["src_feat"] = src_feat
         g.edata["dst_feat"] = dst_feat
 
-        device = self.nfeat.device
         t, u, v = batch_samples
-        t = t.float()
-        logits = self.pred(g, u, v, t)
+        if chunk_size is None:
+            chunk_size = len(t)
+        logits = torch.empty(len(t), device=device)
+        for sid in range(0, len(t), chunk_size):
+            eid = sid + chunk_size
+            logits[sid:eid] = self.pred(g, u[sid:eid].to(device),
+                                        v[sid:eid].to(device),
+                                        t[sid:eid].to(device).float()).reshape(-1)
         return logits
 
 
-def prepare_dataset(dataset):
-    train, val, test, nodes = load_split_edges(dataset=dataset)
+def prepare_dataset(dataset, prepared=True):
+    train, val, test, nodes = load_split_edges(dataset=dataset, prepared=prepared)
     edges = pd.concat([train, val, test]).reset_index(drop=True)
     train_labels, val_labels, test_labels, _ = load_label_edges(dataset=dataset)
     id2idx = {row.node_id: row.id_map for row in nodes.itertuples()}
@@ -229,10 +246,19 @@ def precompute_maxeid(graph):
     return src_maxeid, dst_maxeid, src_deg, dst_deg
 
 
+def eval_chunk_size(n_hidden, mem_mb):
+    """The number of samples scored at once within `mem_mb` MB. Each sample
+    takes about 8 float32 vectors of `n_hidden` dimensions in the link layer:
+    the embeddings, time encodings, and their concatenations and outputs.
+    Activations of the full-graph convolution are not included.
+    """
+    return max(1, int(mem_mb * 2**20) // (8 * 4 * n_hidden))
+
+
 @torch.no_grad()
-def eval_linkpred(model, g, batch_samples, labels):
+def eval_linkpred(model, g, batch_samples, labels, chunk_size=None):
     model.eval()
-    logits = model.infer(g, batch_samples)
+    logits = model.infer(g, batch_samples, chunk_size)
     logits = logits.sigmoid().cpu().numpy()
     acc = accuracy_score(labels, logits >= 0.5)
     f1 = f1_score(labels, logits >= 0.5)
@@ -240,6 +266,26 @@ def eval_linkpred(model, g, batch_samples, labels):
     return acc, f1, auc
 
 
+@torch.no_grad()
+def eval_quantized(model, g, batch_samples, labels, chunk_size=None):
+    """Report the AUC/AP deltas, seconds and bytes of linear weights of the
+    int8 dynamic-quantized `model` against the float32 one on CPU.
+    """
+    model, g = model.cpu().eval(), g.to("cpu")
+    # edge features are a plain tensor unless trainable
+    model.efeat = model.efeat.cpu()
+    int8_model = quantize_linear(model)
+    probs, stats = {}, {}
+    for name, m in [("fp32", model), ("int8", int8_model)]:
+        logits, stats[name + "_sec"] = timed(m.infer, g, batch_samples,
+                                             chunk_size)
+        probs[name] = logits.sigmoid().numpy()
+        stats[name + "_linear_mb"] = linear_bytes(m) / 2**20
+    report = quantization_report(labels, probs["fp32"], probs["int8"])
+    report.update(stats)
+    return report
+
+
 def train_fastgtc(args, logger):
     set_random_seed()
     logger.info("Set random seeds.")
@@ -260,14 +306,18 @@ def train_fastgtc(args, logger):
     # Load nodes, edges, and labeled dataset for training, validation and test.
     logger.info("Dataset preparation.")
     nodes, edges, train_labels, val_labels, test_labels = prepare_dataset(
-        args.dataset)
+        args.dataset, args.prepared)
     delta = edges["timestamp"].shift(-1) - edges["timestamp"]
     # Pandas loc[low:high] includes high, so we use slice operations here instead.
     assert np.all(delta[:len(delta) - 1] >= 0)
 
     # Set DGLGraph, node_features, edge_features, and edge timestamps.
     logger.info("Construct DGLGraph.")
-    g = construct_dglgraph(edges, nodes, device, node_dim=args.n_hidden)
+    g, efeat = construct_dglgraph(edges,
+                                  nodes,
+                                  device,
+                                  node_dim=args.n_hidden,
+                                  share_efeat=True)
     t = g.edata["timestamp"]
     assert torch.all(t[1:] - t[:-1] >= 0)
     if not args.trainable:
@@ -314,10 +364,14 @@ def train_fastgtc(args, logger):
 
     logger.info("Set model config.")
     in_feat = g.ndata["nfeat"].shape[-1]
-    edge_feat = g.edata["efeat"].shape[-1]
+    edge_feat = efeat.shape[-1]
 
-    model = FastTemporalLinkTrainer(g, in_feat, edge_feat, args.n_hidden, args)
+    model = FastTemporalLinkTrainer(g, in_feat, edge_feat, args.n_hidden, args,
+                                    efeat=efeat)
+    chunk_size = eval_chunk_size(args.n_hidden, args.eval_mem_mb)
     model = model.to(device)
+    if args.unique_time:
+        set_unique_time(model, cache_size=args.time_cache)
     optimizer = torch.optim.Adam(model.parameters(),
                                     lr=args.lr,
                                     weight_decay=args.weight_decay)
@@ -330,7 +384,10 @@ def train_fastgtc(args, logger):
     num_batch = np.int(np.ceil(len(train_labels) * 0.5 / batch_size))
     epoch_bar = trange(args.epochs, disable=(not args.display))
     early_stopper = EarlyStopMonitor(max_round=5)
+    # the model outputs logits
+    metrics = BatchMetrics(args.metric_interval, threshold=0.0)
     for epoch in epoch_bar:
+        metrics.reset()
         # np.random.shuffle(train_eids)
         batch_bar = trange(num_batch, disable=(not args.display))
         for idx, batch_samples in zip(batch_bar, train_loader):
@@ -340,26 +397,12 @@ def train_fastgtc(args, logger):
             loss.backward()
             optimizer.step()
 
-            with torch.no_grad():
-                model.eval()
-                pos_prob = pos_prob.cpu().detach().numpy()
-                neg_prob = neg_prob.cpu().detach().numpy()
-                pred_score = np.stack([pos_prob, neg_prob])
-                # avoid pos_prob is a single element
-                pred_score = pred_score.flatten()
-                pred_label = pred_score > 0.5
-                pos_label = np.ones_like(pos_prob, dtype=np.int)
-                neg_label = np.zeros_like(neg_prob, dtype=np.int)
-                true_label = np.stack([pos_label, neg_label])
-                true_label = true_label.flatten()
-                acc = accuracy_score(true_label, pred_label)
-                f1 = f1_score(true_label, pred_label)
-                auc = roc_auc_score(true_label, pred_score)
-
-            batch_bar.set_postfix(loss=loss.item(), acc=acc, f1=f1, auc=auc)
+            if metrics.update(loss, pos_prob, neg_prob):
+                batch_bar.set_postfix(**metrics.summary())
+        batch_bar.set_postfix(**metrics.epoch_summary())
 
         acc, f1, auc = eval_linkpred(model, g, val_samples,
-                                     val_labels["label"])
+                                     val_labels["label"], chunk_size)
         epoch_bar.update()
         epoch_bar.set_postfix(loss=loss.item(), acc=acc, f1=f1, auc=auc)
 
@@ -382,8 +425,10 @@ def train_fastgtc(args, logger):
         else:
             torch.save(model.state_dict(), ckpt_path(epoch))
     model.eval()
-    _, _, val_auc = eval_linkpred(model, g, val_samples, val_labels["label"])
-    acc, f1, auc = eval_linkpred(model, g, test_samples, test_labels["label"])
+    _, _, val_auc = eval_linkpred(model, g, val_samples, val_labels["label"],
+                                  chunk_size)
+    acc, f1, auc = eval_linkpred(model, g, test_samples, test_labels["label"],
+                                 chunk_size)
     params = {
         "best_epoch": early_stopper.best_epoch,
         "trainable": args.trainable,
@@ -409,6 +454,10 @@ def train_fastgtc(args, logger):
     MODEL_SAVE_PATH = f'./saved_models/FastGTC-{args.dataset}-{args.agg_type}-{lr}-layer{args.n_layers}-hidden{args.n_hidden}.pth'
     model = model.cpu()
     torch.save(model.state_dict(), MODEL_SAVE_PATH)
+    if args.quantize:
+        report = eval_quantized(model, g, test_samples, test_labels["label"],
+                                chunk_size)
+        logger.info("Int8 vs float32 on test: %s", format_report(report))
 
 
 def fastgtc_args():
@@ -473,6 +522,28 @@ def fastgtc_args():
                         type=float,
                         default=5.0,
                         help="Clip gradients by value.")
+    parser.add_argument("--eval-mem-mb",
+                        type=float,
+                        default=1024,
+                        help="Memory budget (MB) of the link layer activations when scoring samples in evaluation; excludes the full-graph convolution.")
+    parser.add_argument("--unique-time",
+                        action="store_true",
+                        help="Encode each unique delta time of a batch once.")
+    parser.add_argument("--time-cache",
+                        type=int,
+                        default=0,
+                        help="With --unique-time, cache size of integer time encodings in inference.")
+    parser.add_argument("--metric-interval",
+                        type=int,
+                        default=50,
+                        help="Number of batches between training metric summaries.")
+    parser.add_argument("--quantize",
+                        action="store_true",
+                        help="Report AUC/AP deltas of int8 dynamic quantization on CPU.")
+    parser.add_argument("--no-prepared",
+                        dest="prepared",
+                        action="store_false",
+                        help="Use the cached split of format_data even if prepared split files exist.")
     parser.add_argument("--agg-type",
                         type=str,
                         default="gcn",
@@ -10,8 +10,12 @@ class TimeEncode(torch.nn.Module):
         self.basis_freq = nn.Parameter(
                 torch.linspace(0, 9, time_dim))
         self.phase = nn.Parameter(torch.zeros(time_dim).float())
+        # a UniqueHarmonic to encode unique times only, see `set_unique_time`
+        self.unique_time = None
 
     def forward(self, ts):
+        if self.unique_time is not None:
+            return self.unique_time(ts.view(-1), self.basis_freq, self.phase)
         ts = ts.view(-1, 1)
         map_ts = ts * self.basis_freq.view(1, -1)
         map_ts += self.phase.view(1, -1)
@@ -38,6 +42,8 @@ class TimeEncodingLayer(nn.Module):
         else:
             raise NotImplementedError
         self.act = nn.ReLU()
+        # a UniqueHarmonic to encode unique times only, see `set_unique_time`
+        self.unique_time = None
 
         nn.init.xavier_normal_(self.fc1.weight)
 
@@ -47,8 +53,11 @@ class TimeEncodingLayer(nn.Module):
         elif self.time_encoding == "empty":
             x = self.fc1(u)
         elif self.time_encoding == "cosine":
-            t = torch.cos(t.view(-1, 1) * self.basis_freq.view(1, -1) +
-                          self.phase.view(1, -1))
+            if self.unique_time is not None:
+                t = self.unique_time(t.view(-1), self.basis_freq, self.phase)
+            else:
+                t = torch.cos(t.view(-1, 1) * self.basis_freq.view(1, -1) +
+                              self.phase.view(1, -1))
             x = self.fc1(torch.cat([u, t], dim=-1))
         else:
             raise NotImplementedError
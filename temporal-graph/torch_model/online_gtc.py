@@ -1,7 +1,9 @@
 import argparse
+import json
 import logging
 import os
 import random
+import shutil
 import time
 from datetime import datetime
 
@@ -24,9 +26,9 @@ from utils.util import get_free_gpu, set_logger, set_random_seed, write_result
 
 from torch_model.dataset import TemporalDataset
 from torch_model.layers import TimeEncodingLayer
-from torch_model.util_dgl import construct_dglgraph
+from torch_model.util_dgl import construct_dglgraph, gather_efeat
 
-from .fast_gtc import fastgtc_args, prepare_dataset, precompute_maxeid, FastTemporalLinkTrainer
+from .fast_gtc import fastgtc_args, prepare_dataset, precompute_maxeid, FastTemporalLinkTrainer, eval_chunk_size
 
 # Change the order so that it is the one used by "nvidia-smi" and not the
 # one used by all other programs ("FASTEST_FIRST")
@@ -182,7 +184,7 @@ class OnlineSAGE(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.activation = activation
 
-    def forward(self, graph):
+    def forward(self, graph, efeat=None):
         # We modify the graph data inplace here for incremental computation.
         # Init: nfeat, last_time, efeat, timestamp
         # State: history_deg, h_edge0, history_neigh{0|1|2}, h_self{0|1|2}
@@ -195,7 +197,8 @@ class OnlineSAGE(nn.Module):
         def combine_feats(edges):
             return {
                 "h_edge":
-                torch.cat([edges.src["nfeat"], edges.data["efeat"]], dim=1)
+                torch.cat([edges.src["nfeat"],
+                           gather_efeat(edges.data, efeat)], dim=1)
             }
         g.apply_edges(func=combine_feats)
         h_edge = self.time_encoder(g.edata["h_edge"], g.edata["timestamp"])
@@ -249,10 +252,10 @@ class LinkLayer(nn.Module):
         return logits.squeeze()
 
 class OnlineGTC(nn.Module):
-    def __init__(self, g, in_feats, edge_feats, n_hidden, args) -> None:
+    def __init__(self, g, in_feats, edge_feats, n_hidden, args, efeat=None) -> None:
         super(OnlineGTC, self).__init__()
         self.nfeat = g.ndata["nfeat"]
-        self.efeat = g.edata["efeat"]
+        self.efeat = g.edata["efeat"] if efeat is None else efeat
         self.logger = logging.getLogger()
         self.conv = OnlineSAGE(in_feats, n_hidden, edge_feats, args.n_layers,
                                F.relu, args.dropout, args.agg_type)
@@ -294,7 +297,7 @@ class OnlineGTC(nn.Module):
         sg.copy_from_parent()
         sg.ndata["nfeat"] = g.ndata["nfeat"][sg.ndata[dgl.NID]]
         # compute new_neigh features
-        new_sg = self.conv(sg)
+        new_sg = self.conv(sg, self.efeat)
         # update features
         new_sg.copy_to_parent()
 
@@ -322,6 +325,108 @@ def init_graph(g, n_layers):
     g.ndata["history_deg"] = torch.zeros(nfeat.shape[0]).to(nfeat)
 
 
+def state_keys(n_layers):
+    """Names of the streaming states of OnlineGTC stored in `g.ndata`."""
+    keys = ["last_time", "history_deg", "h_self0"]
+    for i in range(n_layers):
+        keys += [f"history_neigh{i}", f"lstm_h{i}", f"lstm_c{i}",
+                 f"h_self{i + 1}"]
+    return keys
+
+
+LATEST = "latest"
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def save_snapshot(g, n_layers, snapshot_dir, cursor, keep=2):
+    """Save the streaming states in `g.ndata` and the ingestion cursor, i.e.,
+    the number of ingested edges, as a new `snapshot_dir/snapshot-{cursor}-*`.
+    Each state is a .npy file. The snapshot is written and synced under a new
+    name, and then published by atomically replacing the `latest` pointer, so
+    that a crash never leaves a partial or missing latest snapshot. Only the
+    latest `keep` snapshots are retained.
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    name = "snapshot-{:012d}-{:020d}".format(cursor, time.time_ns())
+    path = os.path.join(snapshot_dir, name)
+    tmp = os.path.join(snapshot_dir, ".tmp-" + name)
+    os.makedirs(tmp)
+    keys = [k for k in state_keys(n_layers) if k in g.ndata]
+    for k in keys:
+        with open(os.path.join(tmp, f"{k}.npy"), "wb") as f:
+            np.save(f, g.ndata[k].detach().cpu().numpy())
+            f.flush()
+            os.fsync(f.fileno())
+    meta = {"cursor": int(cursor), "n_layers": n_layers, "keys": keys}
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+    _fsync_dir(tmp)
+    os.rename(tmp, path)
+    _fsync_dir(snapshot_dir)
+
+    pointer = os.path.join(snapshot_dir, LATEST)
+    with open(pointer + ".tmp", "w") as f:
+        f.write(name)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(pointer + ".tmp", pointer)
+    _fsync_dir(snapshot_dir)
+
+    snapshots = sorted(f for f in os.listdir(snapshot_dir)
+                       if f.startswith("snapshot-"))
+    for old in snapshots[:-keep]:
+        if old != name:
+            shutil.rmtree(os.path.join(snapshot_dir, old), ignore_errors=True)
+    for f in os.listdir(snapshot_dir):
+        if f.startswith(".tmp-"):
+            shutil.rmtree(os.path.join(snapshot_dir, f), ignore_errors=True)
+    return path
+
+
+def latest_snapshot(snapshot_dir):
+    """Return the snapshot published by the `latest` pointer, or the one of
+    the largest cursor for directories without a pointer.
+    """
+    if not os.path.isdir(snapshot_dir):
+        return None
+    pointer = os.path.join(snapshot_dir, LATEST)
+    if os.path.exists(pointer):
+        with open(pointer, "r") as f:
+            path = os.path.join(snapshot_dir, f.read().strip())
+        if os.path.exists(os.path.join(path, "meta.json")):
+            return path
+    snapshots = sorted(f for f in os.listdir(snapshot_dir)
+                       if f.startswith("snapshot-") and os.path.exists(
+                           os.path.join(snapshot_dir, f, "meta.json")))
+    if len(snapshots) == 0:
+        return None
+    return os.path.join(snapshot_dir, snapshots[-1])
+
+
+def load_snapshot(g, path):
+    """Restore the streaming states saved by `save_snapshot` into `g.ndata`,
+    and return the ingestion cursor. Edges after the cursor have to be
+    ingested again by `OnlineGTC.update`.
+    """
+    with open(os.path.join(path, "meta.json"), "r") as f:
+        meta = json.load(f)
+    nfeat = g.ndata["nfeat"]
+    for k in meta["keys"]:
+        state = np.load(os.path.join(path, f"{k}.npy"))
+        assert state.shape[0] == nfeat.shape[0], k
+        g.ndata[k] = torch.from_numpy(state).to(nfeat)
+    return meta["cursor"]
+
+
 def align_data_with_graph(g, val_labels):
     # Call graph ndata, edata to forece device move.
     cpu_g = dgl.graph(g.edges())
@@ -341,8 +446,8 @@ def align_data_with_graph(g, val_labels):
     
 
 @torch.no_grad()
-def eval_fastgtc(model, g, batch_samples):
-    logits = model.infer(g, batch_samples)
+def eval_fastgtc(model, g, batch_samples, chunk_size=None):
+    logits = model.infer(g, batch_samples, chunk_size)
     logits = logits.sigmoid().cpu().numpy()
     return logits
 
@@ -418,6 +523,46 @@ def eval_online(model, g, val_labels):
     return np.array(logits)
 
 
+@torch.no_grad()
+def eval_online_grouped(model, g, val_labels):
+    """Score `val_labels` with the same results as `eval_online`. Consecutive
+    samples sharing the same ingestion frontier, i.e., the same position of
+    their timestamp in the edge timestamps, are grouped, so that the edges
+    before each group are ingested once and the group is scored in a single
+    forward pass.
+    """
+    src_l = val_labels["from_node_id"].to_numpy()
+    dst_l = val_labels["to_node_id"].to_numpy()
+    ts_l = val_labels["timestamp"].to_numpy()
+    t_th = g.edata["timestamp"].cpu().numpy()
+    start_eid = 0
+
+    # Init before val_labels, one update per distinct timestamp as in
+    # `eval_online`.
+    ts_train = np.unique(t_th[t_th < ts_l.min()])
+    for end_eid in np.searchsorted(t_th, ts_train, side="left"):
+        if start_eid < end_eid:
+            model.update(g, np.arange(start_eid, end_eid))
+            start_eid = end_eid
+
+    # Using float32 to avoid information leakage due to the float precision.
+    ts_l = np.float32(ts_l)
+    end_eids = np.searchsorted(t_th, ts_l, side="left")
+    bounds = np.flatnonzero(end_eids[1:] != end_eids[:-1]) + 1
+    bounds = np.concatenate([[0], bounds, [len(ts_l)]])
+    logits = np.zeros(len(ts_l), dtype=np.float32)
+    for idx in trange(len(bounds) - 1):
+        sid, eid = bounds[idx], bounds[idx + 1]
+        end_eid = end_eids[sid]
+        if start_eid < end_eid:
+            model.update(g, np.arange(start_eid, end_eid))
+            start_eid = end_eid
+        prob = model(g, (src_l[sid:eid], dst_l[sid:eid], ts_l[sid:eid]))
+        logits[sid:eid] = prob.reshape(-1).cpu().numpy()
+
+    return logits
+
+
 @torch.no_grad()
 def speed_online(model, g, val_samples, batch_size=128):
     # We assume the model has been updated.
@@ -463,14 +608,18 @@ def test_online(args, logger):
     # Load nodes, edges, and labeled dataset for training, validation and test.
     logger.info("Dataset preparation.")
     nodes, edges, train_labels, val_labels, test_labels = prepare_dataset(
-        args.dataset)
+        args.dataset, args.prepared)
     delta = edges["timestamp"].shift(-1) - edges["timestamp"]
     # Pandas loc[low:high] includes high, so we use slice operations here instead.
     assert np.all(delta[:len(delta) - 1] >= 0)
 
     # Set DGLGraph, node_features, edge_features, and edge timestamps.
     logger.info("Construct DGLGraph.")
-    g = construct_dglgraph(edges, nodes, device, node_dim=args.n_hidden)
+    g, efeat = construct_dglgraph(edges,
+                                  nodes,
+                                  device,
+                                  node_dim=args.n_hidden,
+                                  share_efeat=True)
     t = g.edata["timestamp"]
     assert torch.all(t[1:] - t[:-1] >= 0)
     src_maxeid, dst_maxeid, src_deg, dst_deg = precompute_maxeid(g)
@@ -488,21 +637,24 @@ def test_online(args, logger):
     ckpt_state = torch.load(MODEL_SAVE_PATH)
 
     in_feat = g.ndata["nfeat"].shape[-1]
-    edge_feat = g.edata["efeat"].shape[-1]
-    gtc = FastTemporalLinkTrainer(g, in_feat, edge_feat, args.n_hidden, args)
+    edge_feat = efeat.shape[-1]
+    gtc = FastTemporalLinkTrainer(g, in_feat, edge_feat, args.n_hidden, args,
+                                  efeat=efeat)
     gtc.load_state_dict(ckpt_state)
     gtc = gtc.to(device)
-    online = OnlineGTC(g, in_feat, edge_feat, args.n_hidden, args)
+    online = OnlineGTC(g, in_feat, edge_feat, args.n_hidden, args, efeat=efeat)
     online.load_state_dict(ckpt_state)
     online = online.to(device)
+    online.eval()
     
     test_samples = align_data_with_graph(g, test_labels)
-    logits = eval_fastgtc(gtc, g, test_samples)
+    logits = eval_fastgtc(gtc, g, test_samples,
+                          eval_chunk_size(args.n_hidden, args.eval_mem_mb))
     acc, f1, auc = eval_logit(test_labels["label"], logits)
     logger.info("acc: %.3f, f1: %.3f, auc: %.3f", acc, f1, auc)
 
     init_graph(g, args.n_layers)
-    logits = eval_online(online, g, test_labels)    
+    logits = eval_online_grouped(online, g, test_labels)
     acc, f1, auc = eval_logit(test_labels["label"], logits)
     metrics = {"accuracy": acc, "f1": f1, "auc": auc}
     write_result({"valid_auc": 0.0},
@@ -0,0 +1,586 @@
+"""Serve OnlineGTC as a long-running local process.
+
+The server accepts newline-delimited JSON requests on a localhost socket:
+    {"id": 0, "op": "ingest", "rows": [...]}
+    {"id": 1, "op": "score", "src": [...], "dst": [...], "ts": [...]}
+    {"id": 2, "op": "stats"}
+where `rows` index the (timestamp ordered) edges of the prepared dataset, and
+`src`, `dst`, `ts` are node indices and scaled timestamps as returned by
+`prepare_dataset`. Malformed requests, e.g., with node indices or rows out of
+range, are answered with {"id": ..., "error": ...} without stopping the
+server. Requests are coalesced into micro-batches within a latency
+budget: consecutive ingests are applied by one `OnlineGTC.update`, and
+consecutive scores are answered by one forward pass. The server periodically
+logs p50/p95/p99 latency and throughput, and optionally snapshots the
+streaming states with the ingestion cursor, so that a restarted server only
+ingests the edges after the cursor of the latest snapshot (`--restore`).
+
+The load generator replays the test period of the dataset, interleaving edge
+ingestion and link queries by timestamp, at `--speedup` times the original
+event rate. The check mode replays the test period in process, and asserts
+that the served scores equal those of `eval_online`.
+
+`python -m torch_model.online_serve --mode serve -d ia-contact`
+
+`python -m torch_model.online_serve --mode replay -d ia-contact --speedup 1e5`
+
+`python -m torch_model.online_serve --mode check -d ia-contact`
+"""
+from collections import deque
+import json
+import logging
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+import numpy as np
+import torch
+
+from data_loader.data_util import load_split_edges
+from utils.util import get_free_gpu, set_logger, set_random_seed
+from torch_model.util_dgl import construct_dglgraph
+
+from .fast_gtc import fastgtc_args, prepare_dataset
+from .online_gtc import (OnlineGTC, eval_logit, eval_online_grouped,
+                         init_graph, latest_snapshot, load_snapshot,
+                         save_snapshot)
+
+
+class LatencyRecorder(object):
+    """Latency and throughput of the latest `window` requests."""
+    def __init__(self, window=100000):
+        # (receive time, done time, number of events) of each request
+        self.records = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, t_recv, t_done, n_events):
+        with self.lock:
+            self.records.append((t_recv, t_done, n_events))
+
+    def report(self):
+        with self.lock:
+            if len(self.records) == 0:
+                return {"requests": 0, "events": 0}
+            t_recv, t_done, n_events = map(np.array, zip(*self.records))
+            lat = (t_done - t_recv) * 1000
+            duration = max(t_done.max() - t_recv.min(), 1e-6)
+            p50, p95, p99 = np.percentile(lat, [50, 95, 99])
+            return {
+                "requests": len(lat),
+                "events": int(n_events.sum()),
+                "p50_ms": float(p50),
+                "p95_ms": float(p95),
+                "p99_ms": float(p99),
+                "events_per_sec": n_events.sum() / duration
+            }
+
+
+def _n_events(request):
+    if request["op"] == "ingest":
+        return len(request["rows"])
+    elif request["op"] == "score":
+        return len(request["src"])
+    return 0
+
+
+def _is_int(v):
+    return isinstance(v, int) and not isinstance(v, bool)
+
+
+def _is_number(v):
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+
+def _check_ids(request, key, high):
+    ids = request.get(key)
+    if not isinstance(ids, list) or not all(_is_int(i) for i in ids):
+        return f"{key} is a list of integers"
+    if any(i < 0 or i >= high for i in ids):
+        return f"{key} out of range [0, {high})"
+    return None
+
+
+def check_request(request, num_nodes, num_edges):
+    """Return the error of a malformed request, or None for a valid one, so
+    that the serving loop only sees requests it can process.
+    """
+    if not isinstance(request, dict) or "op" not in request:
+        return "a request is an object with op"
+    op = request["op"]
+    if op == "ingest":
+        return _check_ids(request, "rows", num_edges)
+    elif op == "score":
+        for key in ("src", "dst"):
+            error = _check_ids(request, key, num_nodes)
+            if error is not None:
+                return error
+        ts = request.get("ts")
+        if not isinstance(ts, list) or not all(_is_number(t) for t in ts):
+            return "ts is a list of numbers"
+        if not len(request["src"]) == len(request["dst"]) == len(ts):
+            return "src, dst and ts have different lengths"
+        return None
+    elif op == "stats":
+        return None
+    return f"unknown op {op}"
+
+
+class OnlineServer(object):
+    def __init__(self, model, g, latency_budget=5.0, max_batch=1024,
+                 bidirected=True, snapshot_dir=None, snapshot_interval=0.0):
+        """
+        Params
+        ------
+        model: OnlineGTC, whose states are kept in `g`
+        latency_budget: float, milliseconds to wait for coalescing requests
+        max_batch: int, maximum number of events in a micro-batch
+        snapshot_dir: str, where to save snapshots of the streaming states
+        snapshot_interval: float, seconds between snapshots, 0 to disable
+        """
+        self.model = model
+        self.g = g
+        self.budget = latency_budget / 1000
+        self.max_batch = max_batch
+        self.bidirected = bidirected
+        self.snapshot_dir = snapshot_dir
+        self.snapshot_interval = snapshot_interval
+        # The number of ingested edges of the stream.
+        self.cursor = 0
+        self.requests = queue.Queue()
+        self.recorder = LatencyRecorder()
+        self.logger = logging.getLogger(__name__)
+
+    def submit(self, request, reply):
+        self.requests.put((time.time(), request, reply))
+
+    def check(self, request):
+        num_edges = self.g.number_of_edges()
+        if self.bidirected:
+            num_edges //= 2
+        return check_request(request, self.g.number_of_nodes(), num_edges)
+
+    def ingest_until(self, ts):
+        """Ingest all the edges from the cursor to before `ts` in the same
+        way as `eval_online` up to its first query at `ts`, and return the new
+        cursor.
+        """
+        t_th = self.g.edata["timestamp"].cpu().numpy()
+        start_eid = 2 * self.cursor if self.bidirected else self.cursor
+        t_rest = t_th[start_eid:]
+        ts_train = np.unique(t_rest[t_rest < ts])
+        # `eval_online` ingests the edges of the last timestamp before `ts`
+        # at its first query, in float32 as the queries
+        end_eids = np.searchsorted(t_th, ts_train, side="left")
+        end_eids = np.append(end_eids,
+                             np.searchsorted(t_th, np.float32(ts), side="left"))
+        for end_eid in end_eids:
+            if start_eid < end_eid:
+                self.model.update(self.g, np.arange(start_eid, end_eid))
+                start_eid = end_eid
+        self.cursor = start_eid // 2 if self.bidirected else start_eid
+        return self.cursor
+
+    def snapshot(self):
+        return save_snapshot(self.g, self.model.n_layers, self.snapshot_dir,
+                             self.cursor)
+
+    def restore(self):
+        path = latest_snapshot(self.snapshot_dir)
+        if path is None:
+            self.logger.warning("No snapshot in %s.", self.snapshot_dir)
+            return self.cursor
+        self.cursor = load_snapshot(self.g, path)
+        self.logger.info("Restored %s at cursor %d.", path, self.cursor)
+        return self.cursor
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        n_events = _n_events(batch[0][1])
+        deadline = batch[0][0] + self.budget
+        while n_events < self.max_batch:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    item = self.requests.get(timeout=timeout)
+                else:
+                    item = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            n_events += _n_events(item[1])
+        return batch
+
+    @torch.no_grad()
+    def _ingest(self, run):
+        rows = np.concatenate(
+            [np.asarray(req["rows"], dtype=np.int64) for _, req, _ in run])
+        # Edges before the cursor are already in the states, e.g., when a
+        # client resends the stream to a restored server. The states hold a
+        # prefix of the stream, so skipped rows are ingested as well.
+        rows = rows[rows >= self.cursor]
+        if len(rows) > 0:
+            end = int(rows.max()) + 1
+            if end - self.cursor > len(np.unique(rows)):
+                self.logger.warning("Ingesting skipped rows from %d to %d.",
+                                    self.cursor, end)
+            rows = np.arange(self.cursor, end)
+            self.cursor = end
+        if self.bidirected:
+            # `construct_dglgraph` stores the edge i as eids 2i and 2i + 1.
+            rows = np.stack([2 * rows, 2 * rows + 1], axis=1).flatten()
+        if len(rows) > 0:
+            self.model.update(self.g, rows)
+        return [{"ok": True} for _ in run]
+
+    @torch.no_grad()
+    def _score(self, run):
+        src = np.concatenate([req["src"] for _, req, _ in run])
+        dst = np.concatenate([req["dst"] for _, req, _ in run])
+        ts = np.float32(np.concatenate([req["ts"] for _, req, _ in run]))
+        prob = self.model(self.g, (src, dst, ts)).reshape(-1).cpu().numpy()
+        sections = np.cumsum([len(req["src"]) for _, req, _ in run])[:-1]
+        return [{"prob": p.tolist()} for p in np.split(prob, sections)]
+
+    def _process(self, batch):
+        # Keep the arrival order: coalesce runs of requests with the same op.
+        start = 0
+        while start < len(batch):
+            op = batch[start][1]["op"]
+            end = start + 1
+            while end < len(batch) and batch[end][1]["op"] == op:
+                end += 1
+            run = batch[start:end]
+            # A failed run is answered with errors instead of stopping the
+            # server; the other runs of the batch are processed as usual.
+            try:
+                if op == "ingest":
+                    responses = self._ingest(run)
+                elif op == "score":
+                    responses = self._score(run)
+                elif op == "stats":
+                    responses = [
+                        dict(self.recorder.report(), cursor=self.cursor)
+                        for _ in run
+                    ]
+                else:
+                    responses = [{"error": f"unknown op {op}"} for _ in run]
+            except Exception as e:
+                self.logger.exception("Failed to process %d %s requests.",
+                                      len(run), op)
+                responses = [{"error": f"{type(e).__name__}: {e}"}
+                             for _ in run]
+
+            for (t_recv, req, reply), resp in zip(run, responses):
+                resp["id"] = req.get("id")
+                reply(resp)
+                if op in ("ingest", "score") and "error" not in resp:
+                    self.recorder.record(t_recv, time.time(), _n_events(req))
+            start = end
+
+    def run(self, report_interval=10.0):
+        last_report = last_snapshot = time.time()
+        while True:
+            self._process(self._collect())
+            # Batches are processed by this thread only, so the states are
+            # consistent with the cursor between batches.
+            if self.snapshot_interval > 0 and \
+                    time.time() - last_snapshot > self.snapshot_interval:
+                self.snapshot()
+                last_snapshot = time.time()
+            if time.time() - last_report > report_interval:
+                self.logger.info("Serving stats: %r", self.recorder.report())
+                last_report = time.time()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        lock = threading.Lock()
+        wfile = self.wfile
+
+        def reply(response):
+            data = (json.dumps(response) + "\n").encode()
+            with lock:
+                try:
+                    wfile.write(data)
+                    wfile.flush()
+                except (OSError, ValueError):
+                    # The client has closed the connection.
+                    pass
+
+        for line in self.rfile:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                reply({"id": None, "error": f"invalid json: {e}"})
+                continue
+            error = self.server.online.check(request)
+            if error is not None:
+                rid = request.get("id") if isinstance(request, dict) else None
+                reply({"id": rid, "error": error})
+                continue
+            self.server.online.submit(request, reply)
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def load_online(args):
+    """The trained OnlineGTC, its graph with initial states, the edges and
+    the test labels.
+    """
+    if args.gpu:
+        if args.gid >= 0:
+            device = torch.device("cuda:{}".format(args.gid))
+        else:
+            device = torch.device("cuda:{}".format(get_free_gpu()))
+    else:
+        device = torch.device("cpu")
+
+    nodes, edges, _, _, test_labels = prepare_dataset(args.dataset, args.prepared)
+    g, efeat = construct_dglgraph(edges,
+                                  nodes,
+                                  device,
+                                  node_dim=args.n_hidden,
+                                  share_efeat=True)
+    lr = '%.4f' % args.lr
+    MODEL_SAVE_PATH = f'./saved_models/FastGTC-{args.dataset}-{args.agg_type}-{lr}-layer{args.n_layers}-hidden{args.n_hidden}.pth'
+    in_feat = g.ndata["nfeat"].shape[-1]
+    edge_feat = efeat.shape[-1]
+    online = OnlineGTC(g, in_feat, edge_feat, args.n_hidden, args, efeat=efeat)
+    online.load_state_dict(torch.load(MODEL_SAVE_PATH, map_location=device))
+    online = online.to(device)
+    online.eval()
+    init_graph(g, args.n_layers)
+    return online, g, edges, test_labels
+
+
+def serve_online(args, logger):
+    set_random_seed()
+    logger.info(args)
+    online, g, _, test_labels = load_online(args)
+    server = OnlineServer(online,
+                          g,
+                          args.latency_budget,
+                          args.max_batch,
+                          snapshot_dir=args.snapshot_dir,
+                          snapshot_interval=args.snapshot_interval)
+    start = time.time()
+    if args.restore:
+        server.restore()
+    cursor = server.ingest_until(test_labels["timestamp"].min())
+    logger.info("Ingested %d edges before the test period in %.2f seconds.",
+                cursor, time.time() - start)
+
+    tcp_server = _ThreadingTCPServer(("127.0.0.1", args.port), _RequestHandler)
+    tcp_server.online = server
+    threading.Thread(target=tcp_server.serve_forever, daemon=True).start()
+    logger.info("Serving OnlineGTC on 127.0.0.1:%d.", args.port)
+    try:
+        server.run(args.report_interval)
+    except KeyboardInterrupt:
+        tcp_server.shutdown()
+        logger.info("Serving stats: %r", server.recorder.report())
+
+
+def replay_requests(edges, labels, first):
+    """Merge edge ingestion from the row `first`, i.e., the cursor of the
+    server, and link queries by timestamp into requests. Queries come before
+    the edges with the same timestamp, which is the same order as
+    `eval_online`. Each request holds the events of one timestamp.
+    """
+    e_ts = edges["timestamp"].to_numpy()
+    q_ts = labels["timestamp"].to_numpy()
+    rows = np.arange(first, len(e_ts))
+    ts = np.concatenate([q_ts, e_ts[rows]])
+    op = np.concatenate([np.zeros(len(q_ts)), np.ones(len(rows))])
+    ref = np.concatenate([np.arange(len(q_ts)), rows])
+    order = np.lexsort((op, ts))
+    ts, op, ref = ts[order], op[order], ref[order]
+    bounds = np.flatnonzero((ts[1:] != ts[:-1]) | (op[1:] != op[:-1])) + 1
+    bounds = np.concatenate([[0], bounds, [len(ts)]])
+
+    src_l = labels["from_node_id"].to_numpy()
+    dst_l = labels["to_node_id"].to_numpy()
+    requests = []
+    for sid, eid in zip(bounds[:-1], bounds[1:]):
+        idx = ref[sid:eid]
+        if op[sid] == 0:
+            req = {
+                "op": "score",
+                "src": src_l[idx].tolist(),
+                "dst": dst_l[idx].tolist(),
+                "ts": q_ts[idx].tolist(),
+                "qid": idx.tolist()
+            }
+        else:
+            req = {"op": "ingest", "rows": idx.tolist()}
+        requests.append((ts[sid], req))
+    return requests
+
+
+def _raw_timestamps(dataset, prepared=True):
+    train, val, test, _ = load_split_edges(dataset=dataset, prepared=prepared)
+    return np.concatenate([e["timestamp"].to_numpy() for e in [train, val, test]])
+
+
+def replay_online(args, logger):
+    logger.info(args)
+    _, edges, _, _, test_labels = prepare_dataset(args.dataset, args.prepared)
+    # Timestamps are scaled into [0, 1] by `prepare_dataset`.
+    raw = _raw_timestamps(args.dataset, args.prepared)
+    span = raw.max() - raw.min()
+    sock = socket.create_connection(("127.0.0.1", args.port))
+    rfile = sock.makefile("rb")
+    # ingest the stream from the cursor of the server
+    sock.sendall((json.dumps({"op": "stats", "id": None}) + "\n").encode())
+    cursor = json.loads(rfile.readline())["cursor"]
+    requests = replay_requests(edges, test_labels, cursor)
+    if len(requests) == 0:
+        logger.warning("Nothing to replay from edge %d.", cursor)
+        sock.close()
+        return
+    logger.info("Replay %d requests from edge %d at %.1fx speed.",
+                len(requests), cursor, args.speedup)
+    recorder = LatencyRecorder()
+    sent = {}
+    probs = np.zeros(len(test_labels))
+    # queries of failed score requests, which are left out of the metrics
+    failed = np.zeros(len(test_labels), dtype=bool)
+    errors = []
+    done = threading.Event()
+
+    def receive():
+        received = 0
+        for line in rfile:
+            resp = json.loads(line)
+            rid = resp.get("id")
+            if not isinstance(rid, int) or not 0 <= rid < len(requests):
+                if "error" in resp:
+                    errors.append(resp["error"])
+                continue
+            _, req = requests[rid]
+            if "error" in resp:
+                errors.append(resp["error"])
+                if req["op"] == "score":
+                    failed[req["qid"]] = True
+            else:
+                recorder.record(sent[rid], time.time(), _n_events(req))
+                if req["op"] == "score":
+                    probs[req["qid"]] = resp["prob"]
+            received += 1
+            if received == len(requests):
+                break
+        done.set()
+
+    receiver = threading.Thread(target=receive, daemon=True)
+    receiver.start()
+    t0, ts0 = time.time(), requests[0][0]
+    for rid, (ts, req) in enumerate(requests):
+        delay = (ts - ts0) * span / args.speedup - (time.time() - t0)
+        if delay > 0:
+            time.sleep(delay)
+        msg = dict(req, id=rid)
+        msg.pop("qid", None)
+        sent[rid] = time.time()
+        sock.sendall((json.dumps(msg) + "\n").encode())
+    done.wait()
+    logger.info("Sending lag %.2f seconds.",
+                time.time() - t0 - (requests[-1][0] - ts0) * span / args.speedup)
+
+    sock.sendall((json.dumps({"op": "stats", "id": len(requests)}) + "\n").encode())
+    server_stats = json.loads(rfile.readline())
+    sock.close()
+
+    if len(errors) > 0:
+        logger.warning("%d requests failed, e.g., %s", len(errors), errors[0])
+    if failed.all():
+        logger.warning("No query was scored.")
+        return
+    acc, f1, auc = eval_logit(test_labels["label"].to_numpy()[~failed],
+                                probs[~failed])
+    logger.info("acc: %.3f, f1: %.3f, auc: %.3f", acc, f1, auc)
+    logger.info("Client stats: %r", recorder.report())
+    logger.info("Server stats: %r", server_stats)
+
+
+def check_online(args, logger):
+    """Replay the test period through `OnlineServer` in process, and check
+    that the served scores equal those of `eval_online`.
+    """
+    set_random_seed()
+    logger.info(args)
+    online, g, edges, test_labels = load_online(args)
+    expected = eval_online_grouped(online, g, test_labels)
+
+    init_graph(g, args.n_layers)
+    server = OnlineServer(online, g, args.latency_budget, args.max_batch)
+    cursor = server.ingest_until(test_labels["timestamp"].min())
+    requests = replay_requests(edges, test_labels, cursor)
+    probs = np.zeros(len(test_labels), dtype=np.float32)
+
+    def reply_to(req):
+        def reply(resp):
+            if "error" in resp:
+                raise RuntimeError(resp["error"])
+            if req["op"] == "score":
+                probs[req["qid"]] = resp["prob"]
+        return reply
+
+    # all the requests in one batch, where runs of ingests and scores are
+    # coalesced as between the queries of `eval_online`
+    server._process([(time.time(), req, reply_to(req)) for _, req in requests])
+    diff = np.abs(probs - expected).max()
+    logger.info("Max difference to eval_online: %.3g", diff)
+    assert np.allclose(probs, expected, atol=1e-5), diff
+
+
+def online_serve_args():
+    parser = fastgtc_args()
+    parser.add_argument("--mode",
+                        choices=["serve", "replay", "check"],
+                        default="serve")
+    parser.add_argument("--port", type=int, default=6070)
+    parser.add_argument("--latency-budget",
+                        type=float,
+                        default=5.0,
+                        help="Milliseconds to wait for coalescing requests.")
+    parser.add_argument("--max-batch",
+                        type=int,
+                        default=1024,
+                        help="Maximum number of events in a micro-batch.")
+    parser.add_argument("--report-interval",
+                        type=float,
+                        default=10.0,
+                        help="Seconds between serving stats reports.")
+    parser.add_argument("--snapshot-dir", type=str, default="./online_snapshot")
+    parser.add_argument("--snapshot-interval",
+                        type=float,
+                        default=0.0,
+                        help="Seconds between state snapshots, 0 to disable.")
+    parser.add_argument("--restore",
+                        action="store_true",
+                        help="Restore the states from the latest snapshot.")
+    parser.add_argument("--speedup",
+                        type=float,
+                        default=1000.0,
+                        help="Replay speed relative to the original stream.")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = online_serve_args()
+    args = parser.parse_args()
+    logger = set_logger()
+    if args.mode == "serve":
+        serve_online(args, logger)
+    elif args.mode == "check":
+        check_online(args, logger)
+    else:
+        replay_online(args, logger)
@@ -82,7 +82,8 @@ def construct_adj(src, dst, t, num):
     adj_ts_l = [np.array(e) for e in adj_ts_l]
     return adj_eid_l, adj_ngh_l, adj_ts_l
 
-def construct_dglgraph(edges, nodes, device, node_dim=128, bidirected=True):
+def construct_dglgraph(edges, nodes, device, node_dim=128, bidirected=True,
+                       share_efeat=False):
     ''' Edges should be a pandas DataFrame, and its columns should be columns
     comprise of  from_node_id, to_node_id, timestamp, state_label, features_separated_by_comma.
     Here `state_label` varies in edge classification tasks.
@@ -94,6 +95,13 @@ def construct_dglgraph(edges, nodes, device, node_dim=128, bidirected=True):
     edge messages for memory reduction. If `bidirected` is set `True`, we add
     the inverse edges into the DGLGraph. In this case, we retain edges in the
     increasing temporal order.
+
+    If `share_efeat` is set `True`, the edge features are stored once for
+    both directions. Instead of `g.edata["efeat"]`, we store the row of each
+    edge in `g.edata["efeat_idx"]`, and return `(g, efeat)`. The features of
+    edges are then read by `gather_efeat`. This halves the edge features held
+    by the graph, but not the peak memory of a forward pass, as the first
+    layer still gathers the features of all the edges into its input.
     '''
     src = edges["from_node_id"]
     dst = edges["to_node_id"]
@@ -107,6 +115,8 @@ def construct_dglgraph(edges, nodes, device, node_dim=128, bidirected=True):
         nfeature = nn.Parameter(nn.init.xavier_normal_(
             torch.empty(len(nodes), node_dim, device=device)))
 
+    if share_efeat:
+        efeat_idx = torch.arange(len(edges), device=device)
     if bidirected:
         # In this way, we repeat the edge one by one, remaining the increasing
         # temporal order.
@@ -114,7 +124,10 @@ def construct_dglgraph(edges, nodes, device, node_dim=128, bidirected=True):
         v = np.vstack((dst, src)).transpose().flatten()
         src, dst = u, v
         etime = etime.repeat_interleave(2)
-        efeature = efeature.repeat_interleave(2, dim=0)
+        if share_efeat:
+            efeat_idx = efeat_idx.repeat_interleave(2)
+        else:
+            efeature = efeature.repeat_interleave(2, dim=0)
     # Adding edges in the time increasing order, so that `group_apply_edges`
     # will process the neighbors temporally ascendingly. Further we store both
     # source and destionation node representations at timestamp t on the same
@@ -130,10 +143,24 @@ def construct_dglgraph(edges, nodes, device, node_dim=128, bidirected=True):
     g = dgl.DGLGraph((src, dst)).to(device)
     g.ndata["nfeat"] = nfeature  # .to(device)
     g.edata["timestamp"] = etime.to(nfeature)  # .to(device)
+    if share_efeat:
+        g.edata["efeat_idx"] = efeat_idx
+        return g, efeature.to(nfeature)
     g.edata["efeat"] = efeature.to(nfeature)  # .to(device)
     return g
 
 
+def gather_efeat(edata, efeat=None):
+    """Return the edge features of `edata`, i.e., `g.edata` or `edges.data`.
+    For graphs constructed with `share_efeat=True`, the features are gathered
+    from the shared `efeat` through `efeat_idx`, into a new tensor of a row
+    per edge.
+    """
+    if "efeat_idx" in edata:
+        return efeat[edata["efeat_idx"]]
+    return edata["efeat"]
+
+
 def prepare_mp(g):
     """
     Explicitly materialize the CSR, CSC and COO representation of the given graph
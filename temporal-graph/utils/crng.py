@@ -0,0 +1,98 @@
+"""Counter-based random numbers for reproducible parallel sampling.
+
+Random numbers are a pure function of (seed, epoch, batch, phase, stream,
+query index, draw index), hashed by splitmix64, instead of a draw from the
+global `np.random` state. Any batch can thus be regenerated independently in
+any worker or thread, and in any order.
+
+    rng = CounterRNG(seed=42)
+    ngh_finder.rng = rng
+    rand_sampler.rng = rng
+    for epoch in range(n_epoch):
+        for k in range(num_batch):
+            rng.set_batch(epoch, k)
+            ...
+
+Each sampling call within a batch takes the next stream key, so a batch is
+reproduced as long as its calls are issued in the same order.
+"""
+import numpy as np
+from numba import jit
+
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+_MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX2 = np.uint64(0x94D049BB133111EB)
+_S11 = np.uint64(11)
+_S27 = np.uint64(27)
+_S30 = np.uint64(30)
+_S31 = np.uint64(31)
+_INV_2_53 = 1.0 / 9007199254740992.0
+
+
+@jit(nopython=True)
+def splitmix64(x):
+    z = x + _GOLDEN
+    z = (z ^ (z >> _S30)) * _MIX1
+    z = (z ^ (z >> _S27)) * _MIX2
+    return z ^ (z >> _S31)
+
+
+@jit(nopython=True)
+def counter_key(seed, epoch, batch, phase, stream):
+    key = splitmix64(np.uint64(seed))
+    key = splitmix64(key ^ np.uint64(epoch))
+    key = splitmix64(key ^ np.uint64(batch))
+    key = splitmix64(key ^ np.uint64(phase))
+    return splitmix64(key ^ np.uint64(stream))
+
+
+@jit(nopython=True)
+def counter_uniform(key, query, size):
+    """`size` floats in [0, 1) of the `query`-th query under `key`."""
+    out = np.empty(size)
+    base = splitmix64(key ^ splitmix64(np.uint64(query)))
+    for j in range(size):
+        r = splitmix64(base + np.uint64(j))
+        out[j] = (r >> _S11) * _INV_2_53
+    return out
+
+
+@jit(nopython=True)
+def counter_randint(key, query, high, size):
+    """`size` integers in [0, high) of the `query`-th query under `key`."""
+    return (counter_uniform(key, query, size) * high).astype(np.int64)
+
+
+@jit(nopython=True)
+def counter_randint_queries(key, high, size):
+    """One integer in [0, high) for each of the queries 0, ..., size - 1."""
+    out = np.empty(size, dtype=np.int64)
+    for i in range(size):
+        out[i] = np.int64(counter_uniform(key, i, 1)[0] * high)
+    return out
+
+
+class CounterRNG:
+    """Stream keys of counter-based random numbers. Samplers take
+    `next_key()` once per call, and draw the numbers of query i by the
+    `counter_*` functions with that key.
+    """
+    TRAIN, EVAL = 0, 1
+
+    def __init__(self, seed=42):
+        self.seed = seed
+        self.set_batch(0, 0)
+
+    def set_batch(self, epoch, batch, phase=TRAIN):
+        self.epoch = epoch
+        self.batch = batch
+        self.phase = phase
+        self.stream = 0
+
+    def next_key(self):
+        key = counter_key(self.seed, self.epoch, self.batch, self.phase, self.stream)
+        self.stream += 1
+        return key
+
+    def randint(self, high, size):
+        return counter_randint_queries(self.next_key(), high, size)
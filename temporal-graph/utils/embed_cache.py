@@ -0,0 +1,171 @@
+"""A tensor-backed cache of node embeddings keyed by (node, time).
+
+Embeddings of a frozen encoder are computed once, and reused by all epochs of
+a downstream classifier. Lookups and inserts are vectorized over a batch.
+
+    embed_cache = EmbedCache(capacity=1000000, bucket=None)
+    src_embed = embed_cache.get_or_compute(
+        src_l_cut, ts_l_cut, lambda n, t: tgan.tem_conv(n, t, NODE_LAYER))
+"""
+import numpy as np
+import torch
+
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+class EmbedCache(object):
+    """Params
+    ------
+    capacity: the maximum number of embeddings, evicting the least recently
+        used ones when full. None for no limit.
+    bucket: the width of time buckets, where a node shares one embedding
+        within a bucket. None for exact timestamps.
+    """
+    def __init__(self, capacity=None, bucket=None):
+        assert capacity is None or capacity > 0
+        self.capacity = capacity
+        self.bucket = bucket
+        self.embeds = None  # [slots, D]
+        # sorted key hashes and the slot of each hash
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.hash_slots = np.empty(0, dtype=np.int64)
+        # keys and last used ticks of slots
+        self.nodes = np.empty(0, dtype=np.int64)
+        self.tcodes = np.empty(0, dtype=np.int64)
+        self.last_used = np.empty(0, dtype=np.int64)
+        self.free = np.empty(0, dtype=np.int64)
+        self.tick = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def _keys(self, node_l, ts_l):
+        nodes = np.asarray(node_l, dtype=np.int64)
+        ts = np.ascontiguousarray(ts_l, dtype=np.float64) + 0.0  # -0.0 -> 0.0
+        if self.bucket:
+            tcodes = np.floor(ts / self.bucket).astype(np.int64)
+        else:
+            tcodes = ts.view(np.int64)
+        hashes = (nodes.astype(np.uint64) * _MIX) ^ tcodes.astype(np.uint64)
+        return nodes, tcodes, hashes
+
+    def _find(self, nodes, tcodes, hashes):
+        """Slots of the keys, -1 for misses."""
+        if len(self.hashes) == 0:
+            return np.full(len(hashes), -1, dtype=np.int64)
+        pos = np.searchsorted(self.hashes, hashes)
+        pos = np.minimum(pos, len(self.hashes) - 1)
+        slots = self.hash_slots[pos]
+        # hash collisions of different keys are misses
+        found = (self.hashes[pos] == hashes) & (self.nodes[slots] == nodes) & (
+            self.tcodes[slots] == tcodes)
+        return np.where(found, slots, -1)
+
+    def lookup(self, node_l, ts_l):
+        """Return the boolean hit mask of the keys, and the embeddings of
+        the hits, or None if there are none.
+        """
+        slots = self._find(*self._keys(node_l, ts_l))
+        hit = slots >= 0
+        self.tick += 1
+        self.last_used[slots[hit]] = self.tick
+        if not hit.any():
+            return hit, None
+        index = torch.from_numpy(slots[hit]).to(self.embeds.device)
+        return hit, self.embeds[index]
+
+    def insert(self, node_l, ts_l, embed):
+        """Cache `embed` [B, D] of the keys, keeping the embeddings of keys
+        already cached.
+        """
+        nodes, tcodes, hashes = self._keys(node_l, ts_l)
+        new = np.flatnonzero(self._find(nodes, tcodes, hashes) < 0)
+        _, first = np.unique(hashes[new], return_index=True)
+        new = new[first]
+        new = new[~np.isin(hashes[new], self.hashes)]
+        if self.capacity is not None:
+            new = new[-self.capacity:]
+            self._evict(len(self) + len(new) - self.capacity)
+        if len(new) == 0:
+            return
+        slots = self._alloc(len(new), embed)
+        index = torch.from_numpy(new).to(embed.device)
+        self.embeds[torch.from_numpy(slots).to(self.embeds.device)] = embed[
+            index].detach().to(self.embeds)
+        self.nodes[slots] = nodes[new]
+        self.tcodes[slots] = tcodes[new]
+        self.tick += 1
+        self.last_used[slots] = self.tick
+
+        order = np.argsort(hashes[new])
+        pos = np.searchsorted(self.hashes, hashes[new][order])
+        self.hashes = np.insert(self.hashes, pos, hashes[new][order])
+        self.hash_slots = np.insert(self.hash_slots, pos, slots[order])
+
+    def get_or_compute(self, node_l, ts_l, compute):
+        """Embeddings [B, D] of the keys, where misses are computed once by
+        `compute(node_l, ts_l)` and cached.
+        """
+        node_l, ts_l = np.asarray(node_l), np.asarray(ts_l)
+        nodes, tcodes, hashes = self._keys(node_l, ts_l)
+        slots = self._find(nodes, tcodes, hashes)
+        hit = slots >= 0
+        self.tick += 1
+        self.last_used[slots[hit]] = self.tick
+        self.hits += int(hit.sum())
+        self.misses += int((~hit).sum())
+        if hit.all():
+            return self.embeds[torch.from_numpy(slots).to(self.embeds.device)]
+
+        miss = np.flatnonzero(~hit)
+        _, first, inverse = np.unique(hashes[miss],
+                                      return_index=True,
+                                      return_inverse=True)
+        miss_embed = compute(node_l[miss[first]], ts_l[miss[first]])
+        inverse = torch.from_numpy(inverse.reshape(-1)).to(miss_embed.device)
+        if hit.any():
+            out = miss_embed.new_empty((len(slots), miss_embed.shape[1]))
+            out[torch.from_numpy(miss).to(out.device)] = miss_embed[inverse]
+            # read the hits before inserting, which may reuse evicted slots
+            out[torch.from_numpy(np.flatnonzero(hit)).to(out.device)] = self.embeds[
+                torch.from_numpy(slots[hit]).to(self.embeds.device)].to(out)
+        else:
+            out = miss_embed[inverse]
+        self.insert(node_l[miss[first]], ts_l[miss[first]], miss_embed)
+        return out
+
+    def _evict(self, num):
+        """Free the `num` least recently used slots."""
+        if num <= 0:
+            return
+        lru = np.argpartition(self.last_used[self.hash_slots], num - 1)[:num]
+        keep = np.ones(len(self.hashes), dtype=bool)
+        keep[lru] = False
+        self.free = np.concatenate([self.free, self.hash_slots[lru]])
+        self.hashes = self.hashes[keep]
+        self.hash_slots = self.hash_slots[keep]
+
+    def _alloc(self, num, embed):
+        if self.embeds is None:
+            self.embeds = embed.detach().new_empty((0, embed.shape[1]))
+        slots, self.free = self.free[:num], self.free[num:]
+        extra = num - len(slots)
+        if extra > 0:
+            # grow by doubling
+            start = self.embeds.shape[0]
+            grow = max(extra, start)
+            if self.capacity is not None:
+                grow = min(grow, self.capacity - start)
+            self.embeds = torch.cat(
+                [self.embeds,
+                 self.embeds.new_empty((grow, self.embeds.shape[1]))])
+            self.nodes = np.concatenate([self.nodes, np.zeros(grow, dtype=np.int64)])
+            self.tcodes = np.concatenate([self.tcodes, np.zeros(grow, dtype=np.int64)])
+            self.last_used = np.concatenate(
+                [self.last_used, np.zeros(grow, dtype=np.int64)])
+            self.free = np.concatenate(
+                [np.arange(start + extra, start + grow), self.free])
+            slots = np.concatenate([slots, np.arange(start, start + extra)])
+        return slots
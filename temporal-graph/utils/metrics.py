@@ -0,0 +1,114 @@
+"""Training metrics of link prediction accumulated over batches.
+
+Per batch, only the loss and the number of correct predictions are summed on
+the device, and the scores are appended to a buffer without a host copy.
+Every `interval` batches, AUC/AP/F1 are computed from the buffer of the
+interval, which is then copied to the host once and cleared. The epoch
+metrics are computed in a final pass over the host copies.
+
+    metrics = BatchMetrics(interval=50)
+    for k in batch_bar:
+        ...
+        if metrics.update(loss, pos_prob, neg_prob):
+            batch_bar.set_postfix(**metrics.summary())
+    epoch_metrics = metrics.epoch_summary()
+"""
+import numpy as np
+import torch
+from sklearn.metrics import average_precision_score, f1_score, roc_auc_score
+
+
+class BatchMetrics(object):
+    """Params
+    ------
+    interval: the number of batches between two summaries, and None for a
+        summary only at the end of an epoch.
+    threshold: scores above it are positive predictions, e.g. 0.5 for
+        probabilities and 0 for logits.
+    """
+    def __init__(self, interval=None, threshold=0.5):
+        self.interval = interval
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        """Start an epoch."""
+        self.num_batch = 0
+        # loss, correct predictions, batches and samples of flushed intervals
+        self.epoch_sums = np.zeros(4)
+        self.epoch_scores = []
+        self.epoch_labels = []
+        self._reset_interval()
+
+    def _reset_interval(self):
+        self.interval_batch = 0
+        self.num_sample = 0
+        self.loss_sum = 0.0
+        self.correct = 0
+        self.scores = []
+        self.labels = []
+
+    @torch.no_grad()
+    def update(self, loss, pos_score, neg_score):
+        """Accumulate a batch, and return whether a summary is due."""
+        pos_score = torch.as_tensor(pos_score).detach().reshape(-1)
+        neg_score = torch.as_tensor(neg_score).detach().reshape(-1).to(
+            pos_score.device)
+        self.loss_sum = self.loss_sum + torch.as_tensor(loss).detach()
+        self.correct = self.correct + (pos_score > self.threshold).sum() + (
+            neg_score <= self.threshold).sum()
+        self.num_sample += len(pos_score) + len(neg_score)
+        self.scores.append(torch.cat([pos_score, neg_score]).float())
+        labels = torch.zeros(len(pos_score) + len(neg_score),
+                             dtype=torch.bool,
+                             device=pos_score.device)
+        labels[:len(pos_score)] = True
+        self.labels.append(labels)
+        self.interval_batch += 1
+        self.num_batch += 1
+        return self.interval is not None and self.num_batch % self.interval == 0
+
+    def _flush(self):
+        """Copy the interval to the host, add it to the epoch, and return its
+        (loss, correct, batches, samples) sums, scores and labels.
+        """
+        sums = np.array([float(self.loss_sum), float(self.correct),
+                         self.interval_batch, self.num_sample])
+        score = torch.cat(self.scores).cpu().numpy()
+        label = torch.cat(self.labels).cpu().numpy()
+        self.epoch_sums += sums
+        self.epoch_scores.append(score)
+        self.epoch_labels.append(label)
+        self._reset_interval()
+        return sums, score, label
+
+    def _metrics(self, sums, score, label):
+        loss_sum, correct, num_batch, num_sample = sums
+        metrics = dict(loss=loss_sum / num_batch, acc=correct / num_sample)
+        metrics["f1"] = f1_score(label, score > self.threshold)
+        if label.all() or not label.any():
+            return metrics
+        metrics["auc"] = roc_auc_score(label, score)
+        metrics["ap"] = average_precision_score(label, score)
+        return metrics
+
+    def summary(self):
+        """Mean loss and accuracy, and AUC/AP/F1 of the batches since the last
+        summary.
+        """
+        if self.interval_batch == 0:
+            return {}
+        return self._metrics(*self._flush())
+
+    def epoch_summary(self):
+        """Mean loss and accuracy, and AUC/AP/F1 of all the batches since the
+        last reset.
+        """
+        if self.interval_batch > 0:
+            self._flush()
+        if self.num_batch == 0:
+            return {}
+        self.epoch_scores = [np.concatenate(self.epoch_scores)]
+        self.epoch_labels = [np.concatenate(self.epoch_labels)]
+        return self._metrics(self.epoch_sums, self.epoch_scores[0],
+                             self.epoch_labels[0])
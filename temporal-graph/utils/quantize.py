@@ -0,0 +1,77 @@
+"""Dynamic int8 quantization of linear layers for CPU inference.
+
+Weights of linear layers are stored in int8, and activations are quantized on
+the fly per batch, so no calibration data is needed. Embeddings, time
+encodings and layers with a single output (attention maps and final scores)
+stay in float32.
+
+    int8_model = quantize_linear(model.cpu().eval())
+    report = quantization_report(label_l, fp32_prob, int8_prob)
+    logger.info(format_report(report))
+"""
+import io
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from sklearn.metrics import average_precision_score, roc_auc_score
+
+try:
+    from torch.ao.quantization import default_dynamic_qconfig, quantize_dynamic
+    import torch.ao.nn.quantized.dynamic as nnqd
+except ImportError:  # torch < 1.10
+    from torch.quantization import default_dynamic_qconfig, quantize_dynamic
+    import torch.nn.quantized.dynamic as nnqd
+
+_LINEARS = (nn.Linear, nnqd.Linear)
+
+
+def quantize_linear(model, inplace=False):
+    """Return `model` with int8 dynamic-quantized linear layers. The model
+    should be on CPU and in eval mode.
+    """
+    qconfig_spec = {
+        name: default_dynamic_qconfig
+        for name, m in model.named_modules()
+        if isinstance(m, nn.Linear) and m.out_features > 1
+    }
+    return quantize_dynamic(model,
+                            qconfig_spec,
+                            dtype=torch.qint8,
+                            inplace=inplace)
+
+
+def linear_bytes(model):
+    """Serialized size of the weights of the linear layers in `model`."""
+    buf = io.BytesIO()
+    torch.save(
+        {
+            name: m.state_dict()
+            for name, m in model.named_modules() if isinstance(m, _LINEARS)
+        }, buf)
+    return buf.tell()
+
+
+def timed(fn, *args):
+    """Return the output of `fn(*args)` and its wall time in seconds."""
+    start = time.time()
+    out = fn(*args)
+    return out, time.time() - start
+
+
+def quantization_report(label, fp32_prob, int8_prob):
+    """AUC/AP of the float32 and int8 probabilities and their deltas."""
+    fp32_prob, int8_prob = np.asarray(fp32_prob), np.asarray(int8_prob)
+    report = {}
+    for name, prob in [("fp32", fp32_prob), ("int8", int8_prob)]:
+        report[name + "_auc"] = roc_auc_score(label, prob)
+        report[name + "_ap"] = average_precision_score(label, prob)
+    report["delta_auc"] = report["int8_auc"] - report["fp32_auc"]
+    report["delta_ap"] = report["int8_ap"] - report["fp32_ap"]
+    report["max_prob_diff"] = float(np.abs(int8_prob - fp32_prob).max())
+    return report
+
+
+def format_report(report):
+    return ", ".join("{}: {:.4f}".format(k, v) for k, v in report.items())
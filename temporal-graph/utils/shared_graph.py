@@ -0,0 +1,217 @@
+"""A temporal graph store in named shared memory.
+
+One process publishes the CSR arrays of a neighbor finder, and other processes
+attach to them read-only by name instead of building their own copies, e.g.
+the joblib workers of `sample_model.optimal_alpha`, or parallel runs of
+`subgraph_model.exper_edge_np --shared-graph NAME`.
+
+    store = SharedGraphStore.publish("wiki", dict(zip(CSR_KEYS, csr)))
+    # in other processes
+    store = SharedGraphStore.attach("wiki")
+    ngh_finder = NeighborFinder(None, uniform=True, csr=store.csr)
+    store.close()
+
+The arrays keep the mapping of their block alive, so `close` only drops the
+store's own hold on it. The reference of the process is released once the
+store is closed and all its arrays, e.g. those of `ngh_finder` above, are
+garbage collected, or at exit. The shared memory and its lock file are
+unlinked with the last reference of all processes. Workers which may be
+terminated without running exit handlers, e.g. loky workers, should close
+their stores and drop their arrays explicitly. Stale segments of crashed
+processes can be removed by `SharedGraphStore.unlink(name)`.
+"""
+import ctypes
+import fcntl
+import json
+import logging
+import os
+import struct
+import tempfile
+import weakref
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# The same order as returned by `init_off_set` of neighbor finders.
+CSR_KEYS = ("node_idx_l", "node_ts_l", "edge_idx_l", "off_set_l")
+_ALIGN = 64
+_HEADER = struct.Struct("qq")  # refcount, length of the json layout
+_attached = {}
+
+
+def _open_shm(name, create=False, size=0):
+    """Open a shared memory block whose lifetime is managed by refcounts rather
+    than by the resource tracker, which would unlink it when any attached
+    process exits.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, create=create, size=size,
+                                          track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def _lock_path(name):
+    return os.path.join(tempfile.gettempdir(), f"{name}.shm.lock")
+
+
+class _FileLock:
+    def __init__(self, name):
+        self.path = _lock_path(name)
+
+    def __enter__(self):
+        self.fp = open(self.path, "a")
+        fcntl.flock(self.fp, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fp, fcntl.LOCK_UN)
+        self.fp.close()
+
+
+def _release(name, data, meta):
+    """Close the mapping of the block `name` and release its reference."""
+    with _FileLock(name):
+        refcount, length = _HEADER.unpack_from(meta.buf, 0)
+        _HEADER.pack_into(meta.buf, 0, refcount - 1, length)
+        data.close()
+        meta.close()
+        if refcount <= 1:
+            SharedGraphStore._unlink(name)
+            logging.getLogger(__name__).info("Shared graph %s is unlinked.", name)
+
+
+class _Segment:
+    """A mapped block holding a reference of the store. It is the base of all
+    the arrays viewing the block, which exposes raw addresses rather than
+    buffer exports, so the mapping is only closed and the reference released
+    once the segment and the arrays are garbage collected.
+    """
+    def __init__(self, name, data, meta):
+        ptr = ctypes.c_char.from_buffer(data.buf)
+        self.address = ctypes.addressof(ptr)
+        del ptr
+        weakref.finalize(self, _release, name, data, meta)
+
+
+class _View:
+    def __init__(self, segment, spec, readonly):
+        self.segment = segment
+        self.__array_interface__ = {
+            "shape": tuple(spec["shape"]),
+            "typestr": spec["dtype"],
+            "data": (segment.address + spec["offset"], readonly),
+            "version": 3,
+        }
+
+
+class SharedGraphStore:
+    def __init__(self, name, segment, layout, readonly=True):
+        self.name = name
+        self._segment = segment
+        self.arrays = {key: np.asarray(_View(segment, spec, readonly))
+                       for key, spec in layout.items()}
+        self.closed = False
+
+    @property
+    def csr(self):
+        """CSR arrays in the order of `CSR_KEYS`."""
+        return tuple(self.arrays[k] for k in CSR_KEYS)
+
+    @classmethod
+    def publish(cls, name, arrays):
+        """Copy `arrays`, a dict of numpy arrays, into shared memory `name`,
+        and return the store holding the first reference.
+        """
+        layout, size = {}, 0
+        for key, arr in arrays.items():
+            arr = np.ascontiguousarray(arr)
+            layout[key] = {"dtype": arr.dtype.str, "shape": arr.shape, "offset": size}
+            size += -(-arr.nbytes // _ALIGN) * _ALIGN
+        layout_bytes = json.dumps(layout).encode()
+        with _FileLock(name):
+            data = _open_shm(name, create=True, size=max(size, 1))
+            meta = _open_shm(f"{name}-meta", create=True,
+                             size=_HEADER.size + len(layout_bytes))
+            _HEADER.pack_into(meta.buf, 0, 1, len(layout_bytes))
+            meta.buf[_HEADER.size:_HEADER.size + len(layout_bytes)] = layout_bytes
+            store = cls(name, _Segment(name, data, meta), layout, readonly=False)
+            for key, arr in arrays.items():
+                store.arrays[key][...] = arr
+                store.arrays[key].flags.writeable = False
+        return store
+
+    @classmethod
+    def attach(cls, name):
+        """Attach to the published store `name` read-only. A process attaches
+        once and later calls return the same store until it is closed.
+        """
+        store = _attached.get(name)
+        if store is not None and not store.closed:
+            return store
+        with _FileLock(name):
+            meta = _open_shm(f"{name}-meta")
+            refcount, length = _HEADER.unpack_from(meta.buf, 0)
+            layout = json.loads(bytes(meta.buf[_HEADER.size:_HEADER.size + length]))
+            _HEADER.pack_into(meta.buf, 0, refcount + 1, length)
+            data = _open_shm(name)
+        store = cls(name, _Segment(name, data, meta), layout)
+        _attached[name] = store
+        return store
+
+    @classmethod
+    def open(cls, name, build):
+        """Attach to the store `name`, or publish the arrays returned by
+        `build()` if no process has published it yet.
+        """
+        try:
+            return cls.attach(name)
+        except FileNotFoundError:
+            pass
+        arrays = build()
+        try:
+            return cls.publish(name, arrays)
+        except FileExistsError:
+            # published by another process meanwhile
+            return cls.attach(name)
+
+    def close(self):
+        """Drop the hold of this store on the shared memory. Its reference is
+        released once the arrays are garbage collected too.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.arrays = {}
+        self._segment = None
+
+    @staticmethod
+    def _unlink(name):
+        for shm_name in [name, f"{name}-meta"]:
+            try:
+                shm = _open_shm(shm_name)
+            except FileNotFoundError:
+                continue
+            shm.close()
+            if not hasattr(shm, "_track"):
+                # Balance the unregister in `_open_shm` on Python < 3.13.
+                resource_tracker.register(shm._name, "shared_memory")
+            shm.unlink()
+        try:
+            os.remove(_lock_path(name))
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def unlink(cls, name):
+        """Remove the store `name` regardless of its references."""
+        with _FileLock(name):
+            cls._unlink(name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
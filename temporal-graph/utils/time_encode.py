@@ -0,0 +1,81 @@
+"""Harmonic time encodings `cos(t * basis_freq + phase)` over unique times.
+
+Delta times of a batch repeat a lot across layers, neighbors and the source,
+target and negative queries, especially with coarse integer timestamps. The
+encodings are computed once per unique value and gathered back. In inference,
+encodings of integer-valued times are also cached across calls until the
+parameters change.
+
+    set_unique_time(tgan, cache_size=100000)
+"""
+import torch
+
+
+def harmonic(ts, basis_freq, phase):
+    """[*] times -> [*, D] encodings."""
+    return torch.cos(ts.unsqueeze(-1) * basis_freq + phase)
+
+
+class UniqueHarmonic(object):
+    """Params
+    ------
+    cache_size: the maximum number of cached integer-valued times, where the
+        cache is cleared when full. 0 for no cache.
+    """
+    def __init__(self, cache_size=0):
+        self.cache_size = cache_size
+        self.keys = None  # sorted times
+        self.values = None  # [K, D]
+        self.version = None
+
+    def __call__(self, ts, basis_freq, phase):
+        uniq, inverse = torch.unique(ts.reshape(-1), return_inverse=True)
+        if self.cache_size > 0 and not torch.is_grad_enabled():
+            # cached encodings would hold stale autograd graphs in training
+            uniq_enc = self.cached(uniq, basis_freq, phase)
+        else:
+            uniq_enc = harmonic(uniq, basis_freq, phase)
+        return uniq_enc[inverse].view(*ts.shape, uniq_enc.shape[-1])
+
+    def cached(self, uniq, basis_freq, phase):
+        version = (basis_freq._version, phase._version, basis_freq.data_ptr(),
+                   phase.data_ptr(), uniq.dtype)
+        if version != self.version:
+            self.keys, self.values, self.version = None, None, version
+        is_int = uniq == uniq.round()
+        if not is_int.any():
+            return harmonic(uniq, basis_freq, phase)
+        out = torch.empty(len(uniq),
+                          len(basis_freq),
+                          dtype=basis_freq.dtype,
+                          device=uniq.device)
+        miss = torch.ones_like(is_int)
+        if self.keys is not None:
+            pos = torch.searchsorted(self.keys, uniq).clamp(max=len(self.keys) - 1)
+            hit = self.keys[pos] == uniq
+            out[hit] = self.values[pos[hit]]
+            miss = ~hit
+        out[miss] = harmonic(uniq[miss], basis_freq, phase)
+
+        new = miss & is_int
+        num_cached = 0 if self.keys is None else len(self.keys)
+        if num_cached + int(new.sum()) > self.cache_size:
+            self.keys, self.values = None, None
+            new = new & (new.cumsum(0) <= self.cache_size)
+        if new.any():
+            keys, values = uniq[new], out[new]
+            if self.keys is not None:
+                keys = torch.cat([self.keys, keys])
+                values = torch.cat([self.values, values])
+            self.keys, order = keys.sort()
+            self.values = values[order]
+        return out
+
+
+def set_unique_time(model, unique=True, cache_size=0):
+    """Encode unique times by all the harmonic time encoders in `model`, or
+    every time again with `unique=False`.
+    """
+    for module in model.modules():
+        if hasattr(module, "unique_time"):
+            module.unique_time = UniqueHarmonic(cache_size) if unique else None